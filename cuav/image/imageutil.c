@@ -108,6 +108,74 @@ struct bgr_image *allocate_bgr_image8(uint16_t height,
         return ret;
 }
 
+/*
+  create a 8 bit bgr image header with no pixel storage of its
+  own. The rows are pointed at existing pixel data with
+  bgr_image8_set_data(). Can be freed with free()
+ */
+struct bgr_image *allocate_bgr_image8_header(uint16_t height,
+                                             uint16_t width)
+{
+        struct bgr_image *ret = malloc(sizeof(struct bgr_image) +
+                                       height*sizeof(struct bgr *));
+        if (ret == NULL) {
+                return NULL;
+        }
+        ret->height = height;
+        ret->width  = width;
+        ret->data   = (struct bgr **)(ret+1);
+        memset(ret->data, 0, height*sizeof(struct bgr *));
+        return ret;
+}
+
+/*
+  point the rows of an image header at externally owned pixel
+  data. stride is the distance in bytes between rows
+ */
+void bgr_image8_set_data(struct bgr_image *img,
+                         const struct bgr *data,
+                         uint32_t stride)
+{
+        uint32_t y;
+        for (y=0; y<img->height; y++) {
+                img->data[y] = (struct bgr *)(y*stride + (const uint8_t *)data);
+        }
+}
+
+/*
+  allocate a greyscale 8 bit image header, with room for height row
+  pointers, for pointing at external data with
+  grey_image8_set_data(). Can be freed with free()
+ */
+struct grey_image8 *allocate_grey_image8_header(uint16_t height,
+                                                uint16_t width)
+{
+        struct grey_image8 *ret = malloc(sizeof(struct grey_image8) +
+                                         height*sizeof(uint8_t *));
+        if (ret == NULL) {
+                return NULL;
+        }
+        ret->height = height;
+        ret->width  = width;
+        ret->data   = (uint8_t **)(ret+1);
+        memset(ret->data, 0, height*sizeof(uint8_t *));
+        return ret;
+}
+
+/*
+  point the rows of a greyscale image header at externally owned
+  pixel data. stride is the distance in bytes between rows
+ */
+void grey_image8_set_data(struct grey_image8 *img,
+                          const uint8_t *data,
+                          uint32_t stride)
+{
+        uint32_t y;
+        for (y=0; y<img->height; y++) {
+                img->data[y] = (uint8_t *)(y*stride + data);
+        }
+}
+
 void copy_bgr_image8(const struct bgr_image *in, 
                      struct bgr_image *out)
 {
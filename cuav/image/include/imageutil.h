@@ -48,6 +48,19 @@ struct bgr_image *allocate_bgr_image8(uint16_t height,
                                       uint16_t width, 
                                       const struct bgr *data);
 
+/*
+  allocate a BGR 8 bit image header that points at external pixel data
+ */
+struct bgr_image *allocate_bgr_image8_header(uint16_t height,
+                                             uint16_t width);
+
+/*
+  point the rows of an image header at external pixel data
+ */
+void bgr_image8_set_data(struct bgr_image *img,
+                         const struct bgr *data,
+                         uint32_t stride);
+
 /*
   allocate a greyscale 8 bit image
  */
@@ -55,6 +68,19 @@ struct grey_image8 *allocate_grey_image8(uint16_t height,
                                          uint16_t width, 
                                          const uint8_t *data);
 
+/*
+  allocate a greyscale 8 bit image header that points at external pixel data
+ */
+struct grey_image8 *allocate_grey_image8_header(uint16_t height,
+                                                uint16_t width);
+
+/*
+  point the rows of a greyscale image header at external pixel data
+ */
+void grey_image8_set_data(struct grey_image8 *img,
+                          const uint8_t *data,
+                          uint32_t stride);
+
 /*
   copy image data from one image to another of same size
  */
@@ -17,6 +17,8 @@
 #include <sys/stat.h>
 #include <fcntl.h>
 #include <math.h>
+#include <pthread.h>
+#include <time.h>
 #include <numpy/arrayobject.h>
 
 #include "include/imageutil.h"
@@ -29,6 +31,11 @@
 #include <arm_neon.h>
 #endif
 
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+#define SCANNER_X86_SIMD 1
+#include <immintrin.h>
+#endif
+
 #ifndef Py_RETURN_NONE
 #define Py_RETURN_NONE return Py_INCREF(Py_None), Py_None
 #endif
@@ -47,7 +54,7 @@ static PyObject *ScannerError;
 #define MIN(a,b) ((a)<(b)?(a):(b))
 #define MAX(a,b) ((a)>(b)?(a):(b))
 
-#define MAX_REGIONS 4000
+#define MAX_SCAN_THREADS 16
 
 #ifdef __MINGW32__
     #define __LITTLE_ENDIAN 1
@@ -63,6 +70,12 @@ struct scan_params {
     uint16_t region_merge;
     bool save_intermediate;
     bool blue_emphasis;
+    // downsample factor for a coarse to fine scan, or 1 to scan at
+    // full resolution
+    uint8_t pyramid;
+    // fraction of the colour histogram carried over from earlier
+    // frames, or 0 to judge rarity within each frame alone
+    float histogram_decay;
 };
 
 static const struct scan_params scan_params_640_480 = {
@@ -73,22 +86,71 @@ static const struct scan_params scan_params_640_480 = {
         histogram_count_threshold : 50,
         region_merge : 1,
         save_intermediate : false,
-        blue_emphasis : false
+        blue_emphasis : false,
+        pyramid : 1,
+        histogram_decay : 0
+};
+
+struct region_bounds {
+	uint16_t minx, miny;
+	uint16_t maxx, maxy;
+};
+
+struct grid_entry {
+        uint32_t region;
+        int32_t next;
+};
+
+/*
+  the number and total size of the buffers allocated while scanning
+ */
+struct alloc_count {
+        uint64_t count;
+        uint64_t bytes;
 };
 
+static inline void count_alloc(struct alloc_count *c, unsigned count, size_t bytes)
+{
+        if (c != NULL) {
+                c->count += count;
+                c->bytes += bytes;
+        }
+}
+
 struct regions {
         uint16_t height;
         uint16_t width;
 	unsigned num_regions;
-	uint32_t region_size[MAX_REGIONS];
-	struct region_bounds {
-		uint16_t minx, miny;
-		uint16_t maxx, maxy;
-	} bounds[MAX_REGIONS];
-	float region_score[MAX_REGIONS];
-        // data is a 2D array of image dimensions. Each value is the
-        // assigned region number or REGION_NONE
-        int16_t **data;
+        // allocated length of the region arrays. These grow as
+        // needed and are kept between scans
+	unsigned max_regions;
+        // size of each region for the area limits. This is the area
+        // of the bounding box of each labelled region, summed when
+        // regions are merged
+	uint32_t *region_size;
+        // number of pixels in each region
+        uint32_t *pixel_count;
+	struct region_bounds *bounds;
+	float *region_score;
+        // union-find parent of each provisional label
+	uint32_t *parent;
+        // the provisional labels of the most recent rows of the
+        // image, used as a ring buffer. Each value is a label or
+        // REGION_NONE
+        int32_t *row_labels;
+        uint32_t row_labels_size;
+        // spatial grid used by merge_regions. Each cell is the head
+        // of a list of grid entries for the regions that cover it
+        int32_t *grid;
+        uint32_t grid_size;
+        struct grid_entry *grid_entries;
+        uint32_t num_grid_entries, max_grid_entries;
+        // merge candidates, as a min-heap of region numbers, and the
+        // pass in which each region was last queued
+        uint32_t *merge_queue;
+        uint32_t *merge_stamp;
+        // where the growth of these buffers is counted, or NULL
+        struct alloc_count *allocs;
 };
 
 #define SHOW_TIMING 0
@@ -155,6 +217,148 @@ static bool colour_save_pnm(const char *filename, const struct bgr_image *image)
 	return true;
 }
 
+/*
+  time spent in each stage of the last scan. Time is wall clock, so
+  the histogram stages include all their threads
+ */
+enum scan_stage {
+        STAGE_DOWNSAMPLE,
+        STAGE_QUANTISE,
+        STAGE_HISTOGRAM,
+        STAGE_LABEL,
+        STAGE_PRUNE,
+        STAGE_MERGE,
+        STAGE_SCORE,
+        STAGE_REFINE,
+        NUM_SCAN_STAGES
+};
+
+static const char *scan_stage_names[NUM_SCAN_STAGES] = {
+        "downsample", "quantise", "histogram", "label", "prune", "merge", "score", "refine"
+};
+
+struct scan_timing {
+        double seconds[NUM_SCAN_STAGES];
+        // when the current stage started
+        double start;
+};
+
+static double timing_now(void)
+{
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        return ts.tv_sec + ts.tv_nsec*1.0e-9;
+}
+
+/*
+  start timing a new scan
+ */
+static void timing_start(struct scan_timing *timing)
+{
+        memset(timing->seconds, 0, sizeof(timing->seconds));
+        timing->start = timing_now();
+}
+
+/*
+  add the time since the last mark to a stage, and start the next one
+ */
+static void timing_mark(struct scan_timing *timing, enum scan_stage stage)
+{
+        double now = timing_now();
+        timing->seconds[stage] += now - timing->start;
+        timing->start = now;
+}
+
+/*
+  start the next stage without charging the time since the last mark
+  to any stage. Used to leave out saving intermediate images
+ */
+static void timing_skip(struct scan_timing *timing)
+{
+        timing->start = timing_now();
+}
+
+/*
+  the intermediate images of one scan, kept in memory for a Scanner
+  that is capturing them. Each image is allocated during the scan and
+  handed over to python afterwards
+ */
+#define MAX_CAPTURE_STAGES 16
+
+struct stage_capture {
+        bool enabled;
+        unsigned num_stages;
+        const char *name[MAX_CAPTURE_STAGES];
+        struct bgr_image *image[MAX_CAPTURE_STAGES];
+};
+
+/*
+  see if the intermediate images of a scan are needed, either as
+  files or in memory
+ */
+static bool stages_wanted(const struct scan_params *scan_params,
+                          const struct stage_capture *capture)
+{
+        return scan_params->save_intermediate || (capture != NULL && capture->enabled);
+}
+
+/*
+  keep an intermediate image, taking ownership of it. It is saved as
+  a pnm file with the SaveIntermediate parameter, and kept in memory
+  if the scan is being captured
+ */
+static void keep_stage(const struct scan_params *scan_params,
+                       struct stage_capture *capture,
+                       const char *name, struct bgr_image *img)
+{
+        if (img == NULL) {
+                return;
+        }
+        if (scan_params->save_intermediate) {
+                char filename[32];
+                snprintf(filename, sizeof(filename), "%s.pnm", name);
+                colour_save_pnm(filename, img);
+        }
+        if (capture != NULL && capture->enabled &&
+            capture->num_stages < MAX_CAPTURE_STAGES) {
+                capture->name[capture->num_stages] = name;
+                capture->image[capture->num_stages] = img;
+                capture->num_stages++;
+                return;
+        }
+        free(img);
+}
+
+/*
+  keep a copy of an intermediate image, which may be strided
+ */
+static void save_stage(const struct scan_params *scan_params,
+                       struct stage_capture *capture,
+                       const char *name, const struct bgr_image *img)
+{
+        struct bgr_image *copy = allocate_bgr_image8(img->height, img->width, NULL);
+        uint16_t y;
+        if (copy == NULL) {
+                return;
+        }
+        for (y=0; y<img->height; y++) {
+                memcpy(copy->data[y], img->data[y], img->width*sizeof(struct bgr));
+        }
+        keep_stage(scan_params, capture, name, copy);
+}
+
+/*
+  free the captured images of a scan that were not handed over
+ */
+static void stage_capture_clear(struct stage_capture *capture)
+{
+        unsigned i;
+        for (i=0; i<capture->num_stages; i++) {
+                free(capture->image[i]);
+        }
+        capture->num_stages = 0;
+}
+
 
 #define HISTOGRAM_BITS_PER_COLOR 4
 #define HISTOGRAM_BITS (3*HISTOGRAM_BITS_PER_COLOR)
@@ -164,6 +368,22 @@ struct histogram {
 	uint16_t count[(1<<HISTOGRAM_BITS)];
 };
 
+/*
+  a colour histogram kept across frames, so rarity is judged against
+  the recent history of the terrain rather than one frame. Each new
+  frame is blended in with a weight of 1-decay. The colour bins are
+  kept for as long as the colour range of the frames stays close to
+  the range they were set from
+ */
+struct temporal_histogram {
+	bool valid;
+	// size of the images the histogram was built from
+	uint16_t height, width;
+	struct bgr min, max;
+	struct bgr bin_spacing;
+	float count[HISTOGRAM_BINS];
+};
+
 
 #ifdef __ARM_NEON__
 static void NOINLINE get_min_max_neon(const struct bgr * __restrict in,
@@ -240,22 +460,28 @@ static void get_min_max(const struct bgr * __restrict in,
 
 
 /*
-  quantise an BGR image
+  lookup tables mapping each colour value to its histogram bin
  */
-static void quantise_image(const struct scan_params *scan_params,
-                           const struct bgr *in,
-			   uint32_t size,
-			   struct bgr *out,
-			   const struct bgr *min,
-			   const struct bgr *bin_spacing)
+struct quantise_table {
+	uint8_t btab[0x100], gtab[0x100], rtab[0x100];
+};
+
+static void quantise_table_setup(struct quantise_table *t,
+				 const struct bgr *min,
+				 const struct bgr *bin_spacing)
 {
 	unsigned i;
-	uint8_t btab[0x100], gtab[0x100], rtab[0x100];
+	uint8_t *btab = t->btab, *gtab = t->gtab, *rtab = t->rtab;
 
+	/*
+	  values below min go in the lowest bin, as they do in the
+	  saturating SIMD versions. They only occur when the bins come
+	  from another image
+	 */
 	for (i=0; i<0x100; i++) {
-		btab[i] = (i - min->b) / bin_spacing->b;
-		gtab[i] = (i - min->g) / bin_spacing->g;
-		rtab[i] = (i - min->r) / bin_spacing->r;
+		btab[i] = i < min->b ? 0 : (i - min->b) / bin_spacing->b;
+		gtab[i] = i < min->g ? 0 : (i - min->g) / bin_spacing->g;
+		rtab[i] = i < min->r ? 0 : (i - min->r) / bin_spacing->r;
 		if (btab[i] >= (1<<HISTOGRAM_BITS_PER_COLOR)) {
 			btab[i] = (1<<HISTOGRAM_BITS_PER_COLOR)-1;
 		}
@@ -266,6 +492,18 @@ static void quantise_image(const struct scan_params *scan_params,
 			rtab[i] = (1<<HISTOGRAM_BITS_PER_COLOR)-1;
 		}
 	}
+}
+
+/*
+  quantise a row of a BGR image
+ */
+static void quantise_row(const struct scan_params *scan_params,
+			 const struct quantise_table *t,
+			 const struct bgr *in,
+			 uint32_t size,
+			 struct bgr *out)
+{
+	uint32_t i;
 
 	for (i=0; i<size; i++) {
             if (scan_params->blue_emphasis) {
@@ -279,9 +517,39 @@ static void quantise_image(const struct scan_params *scan_params,
                     continue;
 		}
             }
-            out[i].b = btab[in[i].b];
-            out[i].g = gtab[in[i].g];
-            out[i].r = rtab[in[i].r];
+            out[i].b = t->btab[in[i].b];
+            out[i].g = t->gtab[in[i].g];
+            out[i].r = t->rtab[in[i].r];
+	}
+}
+
+/*
+  return row y of an image with rows stride bytes apart
+ */
+static inline const struct bgr *bgr_row(const struct bgr *in, uint32_t stride, uint32_t y)
+{
+	return (const struct bgr *)(y*stride + (const uint8_t *)in);
+}
+
+/*
+  quantise an BGR image of nrows rows of width pixels. The input rows
+  are in_stride bytes apart, the output rows follow each other
+ */
+static void quantise_image(const struct scan_params *scan_params,
+                           const struct bgr *in,
+			   uint32_t in_stride,
+			   uint32_t width,
+			   uint32_t nrows,
+			   struct bgr *out,
+			   const struct bgr *min,
+			   const struct bgr *bin_spacing)
+{
+	struct quantise_table t;
+	uint32_t y;
+
+	quantise_table_setup(&t, min, bin_spacing);
+	for (y=0; y<nrows; y++) {
+		quantise_row(scan_params, &t, bgr_row(in, in_stride, y), width, out + y*width);
 	}
 }
 
@@ -345,6 +613,521 @@ static void build_histogram(const struct bgr *in,
 	}
 }
 
+/*
+  the kernels used for the per-pixel colour histogram stages. The
+  scalar versions above are always available. On x86 the SSE2 and
+  AVX2 versions are selected at load time if the CPU supports them and
+  they give the same results as the scalar versions in kernels_selftest()
+ */
+struct scan_kernels {
+	const char *name;
+	void (*get_min_max)(const struct bgr * __restrict in,
+			    uint32_t size,
+			    struct bgr *min,
+			    struct bgr *max);
+	void (*quantise_image)(const struct scan_params *scan_params,
+			       const struct bgr *in,
+			       uint32_t in_stride,
+			       uint32_t width,
+			       uint32_t nrows,
+			       struct bgr *out,
+			       const struct bgr *min,
+			       const struct bgr *bin_spacing);
+	void (*build_histogram)(const struct bgr *in,
+				uint32_t size,
+				struct histogram *out);
+};
+
+static const struct scan_kernels scalar_kernels = {
+	"scalar", get_min_max, quantise_image, build_histogram
+};
+
+#ifdef SCANNER_X86_SIMD
+/*
+  The x86 kernels work directly on the packed 24 bit pixels. A block
+  of 48 bytes (16 pixels) fills 3 SSE2 registers and a block of 96
+  bytes (32 pixels) fills 3 AVX2 registers, so each byte lane always
+  holds the same colour channel and the channels never need to be
+  separated. Pixels left over after the last whole block are handled
+  by the scalar versions
+ */
+
+/*
+  fold per-byte min and max values from n bytes of whole blocks into
+  the per-channel min and max
+ */
+static void reduce_min_max(const uint8_t *vmin, const uint8_t *vmax, unsigned n,
+			   struct bgr *min, struct bgr *max)
+{
+	uint8_t *mn = (uint8_t *)min;
+	uint8_t *mx = (uint8_t *)max;
+	unsigned i;
+
+	for (i=0; i<n; i++) {
+		mn[i%3] = MIN(mn[i%3], vmin[i]);
+		mx[i%3] = MAX(mx[i%3], vmax[i]);
+	}
+}
+
+__attribute__((target("sse2")))
+static void get_min_max_sse2(const struct bgr * __restrict in,
+			     uint32_t size,
+			     struct bgr *min,
+			     struct bgr *max)
+{
+	const uint8_t *src = (const uint8_t *)in;
+	uint32_t i, nblocks = size / 16;
+	__m128i min0, min1, min2, max0, max1, max2;
+	uint8_t vmin[48], vmax[48];
+
+	min0 = min1 = min2 = _mm_set1_epi8((char)0xFF);
+	max0 = max1 = max2 = _mm_setzero_si128();
+
+	for (i=0; i<nblocks; i++) {
+		__m128i v0 = _mm_loadu_si128((const __m128i *)(src));
+		__m128i v1 = _mm_loadu_si128((const __m128i *)(src+16));
+		__m128i v2 = _mm_loadu_si128((const __m128i *)(src+32));
+		min0 = _mm_min_epu8(min0, v0);
+		min1 = _mm_min_epu8(min1, v1);
+		min2 = _mm_min_epu8(min2, v2);
+		max0 = _mm_max_epu8(max0, v0);
+		max1 = _mm_max_epu8(max1, v1);
+		max2 = _mm_max_epu8(max2, v2);
+		src += 48;
+	}
+
+	_mm_storeu_si128((__m128i *)(vmin), min0);
+	_mm_storeu_si128((__m128i *)(vmin+16), min1);
+	_mm_storeu_si128((__m128i *)(vmin+32), min2);
+	_mm_storeu_si128((__m128i *)(vmax), max0);
+	_mm_storeu_si128((__m128i *)(vmax+16), max1);
+	_mm_storeu_si128((__m128i *)(vmax+32), max2);
+
+	get_min_max(in + nblocks*16, size - nblocks*16, min, max);
+	reduce_min_max(vmin, vmax, 48, min, max);
+}
+
+__attribute__((target("avx2")))
+static void get_min_max_avx2(const struct bgr * __restrict in,
+			     uint32_t size,
+			     struct bgr *min,
+			     struct bgr *max)
+{
+	const uint8_t *src = (const uint8_t *)in;
+	uint32_t i, nblocks = size / 32;
+	__m256i min0, min1, min2, max0, max1, max2;
+	uint8_t vmin[96], vmax[96];
+
+	min0 = min1 = min2 = _mm256_set1_epi8((char)0xFF);
+	max0 = max1 = max2 = _mm256_setzero_si256();
+
+	for (i=0; i<nblocks; i++) {
+		__m256i v0 = _mm256_loadu_si256((const __m256i *)(src));
+		__m256i v1 = _mm256_loadu_si256((const __m256i *)(src+32));
+		__m256i v2 = _mm256_loadu_si256((const __m256i *)(src+64));
+		min0 = _mm256_min_epu8(min0, v0);
+		min1 = _mm256_min_epu8(min1, v1);
+		min2 = _mm256_min_epu8(min2, v2);
+		max0 = _mm256_max_epu8(max0, v0);
+		max1 = _mm256_max_epu8(max1, v1);
+		max2 = _mm256_max_epu8(max2, v2);
+		src += 96;
+	}
+
+	_mm256_storeu_si256((__m256i *)(vmin), min0);
+	_mm256_storeu_si256((__m256i *)(vmin+32), min1);
+	_mm256_storeu_si256((__m256i *)(vmin+64), min2);
+	_mm256_storeu_si256((__m256i *)(vmax), max0);
+	_mm256_storeu_si256((__m256i *)(vmax+32), max1);
+	_mm256_storeu_si256((__m256i *)(vmax+64), max2);
+
+	get_min_max(in + nblocks*32, size - nblocks*32, min, max);
+	reduce_min_max(vmin, vmax, 96, min, max);
+}
+
+/*
+  per byte lane constants for quantising a block of 3 registers of
+  vsize bytes. The division by the bin spacing d (1 to 16) is done as
+  floor(2x * ceil(32768/d) / 65536), which is exact for all 8 bit x.
+  The multipliers are in the order of the 16 bit lanes given by
+  unpacking the low and high bytes of each 128 bit half of a register
+ */
+struct quantise_lanes {
+	uint8_t min[96];
+	uint16_t mul_lo[3][16];
+	uint16_t mul_hi[3][16];
+};
+
+static void quantise_lanes_setup(struct quantise_lanes *q, unsigned vsize,
+				 const struct bgr *min, const struct bgr *bin_spacing)
+{
+	const uint8_t *mn = (const uint8_t *)min;
+	const uint8_t *sp = (const uint8_t *)bin_spacing;
+	unsigned i, k;
+
+	for (i=0; i<3*vsize; i++) {
+		q->min[i] = mn[i%3];
+	}
+	for (k=0; k<3; k++) {
+		for (i=0; i<vsize/2; i++) {
+			unsigned lo = k*vsize + 16*(i/8) + (i%8);
+			unsigned hi = lo + 8;
+			q->mul_lo[k][i] = (32768 + sp[lo%3] - 1) / sp[lo%3];
+			q->mul_hi[k][i] = (32768 + sp[hi%3] - 1) / sp[hi%3];
+		}
+	}
+}
+
+__attribute__((target("sse2")))
+static inline __m128i quantise_sse2(__m128i v, __m128i min, __m128i mul_lo, __m128i mul_hi)
+{
+	const __m128i zero = _mm_setzero_si128();
+	__m128i d = _mm_subs_epu8(v, min);
+	__m128i lo = _mm_unpacklo_epi8(d, zero);
+	__m128i hi = _mm_unpackhi_epi8(d, zero);
+	lo = _mm_mulhi_epu16(_mm_add_epi16(lo, lo), mul_lo);
+	hi = _mm_mulhi_epu16(_mm_add_epi16(hi, hi), mul_hi);
+	return _mm_min_epu8(_mm_packus_epi16(lo, hi),
+			    _mm_set1_epi8((1<<HISTOGRAM_BITS_PER_COLOR)-1));
+}
+
+/*
+  quantise an BGR image. Blue emphasis compares channels within a
+  pixel, so it uses the scalar version
+ */
+__attribute__((target("sse2")))
+static void quantise_image_sse2(const struct scan_params *scan_params,
+				const struct bgr *in,
+				uint32_t in_stride,
+				uint32_t width,
+				uint32_t nrows,
+				struct bgr *out,
+				const struct bgr *min,
+				const struct bgr *bin_spacing)
+{
+	uint32_t i, y, nblocks = scan_params->blue_emphasis ? 0 : width / 16;
+	struct quantise_table t;
+	struct quantise_lanes q;
+	__m128i min0, min1, min2, lo0, lo1, lo2, hi0, hi1, hi2;
+
+	quantise_lanes_setup(&q, 16, min, bin_spacing);
+	min0 = _mm_loadu_si128((const __m128i *)(q.min));
+	min1 = _mm_loadu_si128((const __m128i *)(q.min+16));
+	min2 = _mm_loadu_si128((const __m128i *)(q.min+32));
+	lo0 = _mm_loadu_si128((const __m128i *)q.mul_lo[0]);
+	lo1 = _mm_loadu_si128((const __m128i *)q.mul_lo[1]);
+	lo2 = _mm_loadu_si128((const __m128i *)q.mul_lo[2]);
+	hi0 = _mm_loadu_si128((const __m128i *)q.mul_hi[0]);
+	hi1 = _mm_loadu_si128((const __m128i *)q.mul_hi[1]);
+	hi2 = _mm_loadu_si128((const __m128i *)q.mul_hi[2]);
+
+	quantise_table_setup(&t, min, bin_spacing);
+
+	for (y=0; y<nrows; y++) {
+		const uint8_t *src = (const uint8_t *)bgr_row(in, in_stride, y);
+		uint8_t *dst = (uint8_t *)(out + y*width);
+		for (i=0; i<nblocks; i++) {
+			__m128i v0 = _mm_loadu_si128((const __m128i *)(src));
+			__m128i v1 = _mm_loadu_si128((const __m128i *)(src+16));
+			__m128i v2 = _mm_loadu_si128((const __m128i *)(src+32));
+			_mm_storeu_si128((__m128i *)(dst), quantise_sse2(v0, min0, lo0, hi0));
+			_mm_storeu_si128((__m128i *)(dst+16), quantise_sse2(v1, min1, lo1, hi1));
+			_mm_storeu_si128((__m128i *)(dst+32), quantise_sse2(v2, min2, lo2, hi2));
+			src += 48;
+			dst += 48;
+		}
+		quantise_row(scan_params, &t, (const struct bgr *)src, width - nblocks*16,
+			     (struct bgr *)dst);
+	}
+}
+
+__attribute__((target("avx2")))
+static inline __m256i quantise_avx2(__m256i v, __m256i min, __m256i mul_lo, __m256i mul_hi)
+{
+	const __m256i zero = _mm256_setzero_si256();
+	__m256i d = _mm256_subs_epu8(v, min);
+	__m256i lo = _mm256_unpacklo_epi8(d, zero);
+	__m256i hi = _mm256_unpackhi_epi8(d, zero);
+	lo = _mm256_mulhi_epu16(_mm256_add_epi16(lo, lo), mul_lo);
+	hi = _mm256_mulhi_epu16(_mm256_add_epi16(hi, hi), mul_hi);
+	return _mm256_min_epu8(_mm256_packus_epi16(lo, hi),
+			       _mm256_set1_epi8((1<<HISTOGRAM_BITS_PER_COLOR)-1));
+}
+
+__attribute__((target("avx2")))
+static void quantise_image_avx2(const struct scan_params *scan_params,
+				const struct bgr *in,
+				uint32_t in_stride,
+				uint32_t width,
+				uint32_t nrows,
+				struct bgr *out,
+				const struct bgr *min,
+				const struct bgr *bin_spacing)
+{
+	uint32_t i, y, nblocks = scan_params->blue_emphasis ? 0 : width / 32;
+	struct quantise_table t;
+	struct quantise_lanes q;
+	__m256i min0, min1, min2, lo0, lo1, lo2, hi0, hi1, hi2;
+
+	quantise_lanes_setup(&q, 32, min, bin_spacing);
+	min0 = _mm256_loadu_si256((const __m256i *)(q.min));
+	min1 = _mm256_loadu_si256((const __m256i *)(q.min+32));
+	min2 = _mm256_loadu_si256((const __m256i *)(q.min+64));
+	lo0 = _mm256_loadu_si256((const __m256i *)q.mul_lo[0]);
+	lo1 = _mm256_loadu_si256((const __m256i *)q.mul_lo[1]);
+	lo2 = _mm256_loadu_si256((const __m256i *)q.mul_lo[2]);
+	hi0 = _mm256_loadu_si256((const __m256i *)q.mul_hi[0]);
+	hi1 = _mm256_loadu_si256((const __m256i *)q.mul_hi[1]);
+	hi2 = _mm256_loadu_si256((const __m256i *)q.mul_hi[2]);
+
+	quantise_table_setup(&t, min, bin_spacing);
+
+	for (y=0; y<nrows; y++) {
+		const uint8_t *src = (const uint8_t *)bgr_row(in, in_stride, y);
+		uint8_t *dst = (uint8_t *)(out + y*width);
+		for (i=0; i<nblocks; i++) {
+			__m256i v0 = _mm256_loadu_si256((const __m256i *)(src));
+			__m256i v1 = _mm256_loadu_si256((const __m256i *)(src+32));
+			__m256i v2 = _mm256_loadu_si256((const __m256i *)(src+64));
+			_mm256_storeu_si256((__m256i *)(dst), quantise_avx2(v0, min0, lo0, hi0));
+			_mm256_storeu_si256((__m256i *)(dst+32), quantise_avx2(v1, min1, lo1, hi1));
+			_mm256_storeu_si256((__m256i *)(dst+64), quantise_avx2(v2, min2, lo2, hi2));
+			src += 96;
+			dst += 96;
+		}
+		quantise_row(scan_params, &t, (const struct bgr *)src, width - nblocks*32,
+			     (struct bgr *)dst);
+	}
+}
+
+/*
+  build a histogram of a quantised image. Consecutive pixels often
+  fall in the same bin, so the counts are spread over 4 histograms to
+  avoid each increment waiting on the previous one. The bins are
+  found from a 32 bit load of each pixel, which is safe for all but
+  the last pixel. The counts wrap the same way as build_histogram()
+ */
+#define HISTOGRAM_WAYS 4
+
+static inline uint32_t quantised_bin(uint32_t w)
+{
+	return (w & 0xF) | ((w >> 4) & 0xF0) | ((w >> 8) & 0xF00);
+}
+
+static void sum_histograms(uint16_t count[HISTOGRAM_WAYS][HISTOGRAM_BINS],
+			   struct histogram *out)
+{
+	unsigned b;
+	for (b=0; b<HISTOGRAM_BINS; b++) {
+		out->count[b] = count[0][b] + count[1][b] + count[2][b] + count[3][b];
+	}
+}
+
+static void build_histogram_multi(const struct bgr *in,
+				  uint32_t size,
+				  struct histogram *out)
+{
+	uint16_t count[HISTOGRAM_WAYS][HISTOGRAM_BINS];
+	uint32_t i, w;
+
+	memset(count, 0, sizeof(count));
+
+	for (i=0; i+HISTOGRAM_WAYS < size; i+=HISTOGRAM_WAYS) {
+		memcpy(&w, &in[i], 4);
+		count[0][quantised_bin(w)]++;
+		memcpy(&w, &in[i+1], 4);
+		count[1][quantised_bin(w)]++;
+		memcpy(&w, &in[i+2], 4);
+		count[2][quantised_bin(w)]++;
+		memcpy(&w, &in[i+3], 4);
+		count[3][quantised_bin(w)]++;
+	}
+	for (; i<size; i++) {
+		count[0][bgr_bin(&in[i])]++;
+	}
+	sum_histograms(count, out);
+}
+
+/*
+  as build_histogram_multi(), but with the bins of 8 pixels found at
+  once with a gather
+ */
+__attribute__((target("avx2")))
+static void build_histogram_avx2(const struct bgr *in,
+				 uint32_t size,
+				 struct histogram *out)
+{
+	uint16_t count[HISTOGRAM_WAYS][HISTOGRAM_BINS];
+	uint32_t bins[8];
+	uint32_t i;
+	const __m256i ofs = _mm256_setr_epi32(0, 3, 6, 9, 12, 15, 18, 21);
+	const __m256i mask = _mm256_set1_epi32(0xF);
+
+	memset(count, 0, sizeof(count));
+
+	for (i=0; i+8 < size; i+=8) {
+		__m256i w = _mm256_i32gather_epi32((const int *)&in[i], ofs, 1);
+		__m256i b = _mm256_and_si256(w, mask);
+		b = _mm256_or_si256(b, _mm256_slli_epi32(_mm256_and_si256(_mm256_srli_epi32(w, 8), mask), 4));
+		b = _mm256_or_si256(b, _mm256_slli_epi32(_mm256_and_si256(_mm256_srli_epi32(w, 16), mask), 8));
+		_mm256_storeu_si256((__m256i *)bins, b);
+		count[0][bins[0]]++;
+		count[1][bins[1]]++;
+		count[2][bins[2]]++;
+		count[3][bins[3]]++;
+		count[0][bins[4]]++;
+		count[1][bins[5]]++;
+		count[2][bins[6]]++;
+		count[3][bins[7]]++;
+	}
+	for (; i<size; i++) {
+		count[0][bgr_bin(&in[i])]++;
+	}
+	sum_histograms(count, out);
+}
+
+static const struct scan_kernels sse2_kernels = {
+	"sse2", get_min_max_sse2, quantise_image_sse2, build_histogram_multi
+};
+
+static const struct scan_kernels avx2_kernels = {
+	"avx2", get_min_max_avx2, quantise_image_avx2, build_histogram_avx2
+};
+#endif // SCANNER_X86_SIMD
+
+static const struct scan_kernels *kernels = &scalar_kernels;
+
+/*
+  return true if a set of kernels gives the same results as the
+  scalar kernels on a range of image sizes and colour ranges
+ */
+static bool kernels_selftest(const struct scan_kernels *k)
+{
+	const uint32_t sizes[] = { 0, 1, 7, 15, 16, 17, 31, 32, 33, 47, 95, 96, 97, 1000, 4099 };
+	const uint32_t max_size = 4099;
+	struct bgr *in, *q1, *q2;
+	struct histogram *h1, *h2;
+	uint32_t seed = 1;
+	unsigned s, range, be;
+	bool ok = true;
+
+	in = malloc(max_size * sizeof(struct bgr));
+	q1 = malloc(max_size * sizeof(struct bgr));
+	q2 = malloc(max_size * sizeof(struct bgr));
+	h1 = malloc(sizeof(struct histogram));
+	h2 = malloc(sizeof(struct histogram));
+	if (in == NULL || q1 == NULL || q2 == NULL || h1 == NULL || h2 == NULL) {
+		ok = false;
+		goto done;
+	}
+
+	for (range=1; range<=256 && ok; range *= 4) {
+		for (s=0; s<sizeof(sizes)/sizeof(sizes[0]) && ok; s++) {
+			uint32_t i, size = sizes[s];
+			uint8_t *p = (uint8_t *)in;
+			struct bgr min1, max1, min2, max2, bin_spacing;
+			unsigned num_bins = (1<<HISTOGRAM_BITS_PER_COLOR);
+
+			for (i=0; i<3*size; i++) {
+				seed = seed * 1103515245 + 12345;
+				p[i] = 37*(i%3) + (seed >> 16) % range;
+			}
+
+			scalar_kernels.get_min_max(in, size, &min1, &max1);
+			k->get_min_max(in, size, &min2, &max2);
+			if (memcmp(&min1, &min2, sizeof(min1)) != 0 ||
+			    memcmp(&max1, &max2, sizeof(max1)) != 0) {
+				ok = false;
+				break;
+			}
+			if (size == 0) {
+				continue;
+			}
+
+			bin_spacing.r = 1 + (max1.r - min1.r) / num_bins;
+			bin_spacing.g = 1 + (max1.g - min1.g) / num_bins;
+			bin_spacing.b = 1 + (max1.b - min1.b) / num_bins;
+
+			for (be=0; be<2; be++) {
+				struct scan_params scan_params = scan_params_640_480;
+				scan_params.blue_emphasis = be;
+				scalar_kernels.quantise_image(&scan_params, in, 3*size, size, 1, q1, &min1, &bin_spacing);
+				k->quantise_image(&scan_params, in, 3*size, size, 1, q2, &min1, &bin_spacing);
+				if (memcmp(q1, q2, size*sizeof(struct bgr)) != 0) {
+					ok = false;
+					break;
+				}
+				scalar_kernels.build_histogram(q1, size, h1);
+				k->build_histogram(q1, size, h2);
+				if (memcmp(h1, h2, sizeof(struct histogram)) != 0) {
+					ok = false;
+					break;
+				}
+			}
+		}
+
+		/* rows with padding between them, as in an image view */
+		if (ok) {
+			const uint32_t width = 97, stride = 3*(width + 3), nrows = 3*max_size / stride;
+			struct bgr min, max, bin_spacing;
+			unsigned num_bins = (1<<HISTOGRAM_BITS_PER_COLOR);
+
+			scalar_kernels.get_min_max(in, max_size, &min, &max);
+			bin_spacing.r = 1 + (max.r - min.r) / num_bins;
+			bin_spacing.g = 1 + (max.g - min.g) / num_bins;
+			bin_spacing.b = 1 + (max.b - min.b) / num_bins;
+			scalar_kernels.quantise_image(&scan_params_640_480, in, stride, width, nrows,
+						      q1, &min, &bin_spacing);
+			k->quantise_image(&scan_params_640_480, in, stride, width, nrows,
+					  q2, &min, &bin_spacing);
+			ok = memcmp(q1, q2, width*nrows*sizeof(struct bgr)) == 0;
+		}
+	}
+
+done:
+	free(in);
+	free(q1);
+	free(q2);
+	free(h1);
+	free(h2);
+	return ok;
+}
+
+/*
+  the kernels supported by this CPU, best first
+ */
+static unsigned supported_kernels(const struct scan_kernels **ret)
+{
+	unsigned n = 0;
+#ifdef SCANNER_X86_SIMD
+	__builtin_cpu_init();
+	if (__builtin_cpu_supports("avx2")) {
+		ret[n++] = &avx2_kernels;
+	}
+	if (__builtin_cpu_supports("sse2")) {
+		ret[n++] = &sse2_kernels;
+	}
+#endif
+	ret[n++] = &scalar_kernels;
+	return n;
+}
+
+/*
+  select the best kernels that pass the self test
+ */
+static void select_kernels(void)
+{
+	const struct scan_kernels *k[3];
+	unsigned i, n = supported_kernels(k);
+
+	for (i=0; i<n; i++) {
+		if (kernels_selftest(k[i])) {
+			kernels = k[i];
+			return;
+		}
+	}
+}
+
 /*
   threshold an image by its histogram. Pixels that have a histogram
   count of more than the given threshold are set to zero value
@@ -414,721 +1197,2703 @@ static void histogram_threshold_neighbours(const struct bgr *in,
 }
 
 
-static void colour_histogram(const struct scan_params *scan_params,
-                             const struct bgr_image *in, struct bgr_image *out,
-                             struct bgr_image *quantised,
-                             struct histogram *histogram)
+/*
+  return the end of the run of masked or unmasked pixels starting at x
+ */
+static inline uint32_t mask_run(const uint8_t *mask, uint32_t x, uint32_t size)
 {
-	struct bgr min, max;
-	struct bgr bin_spacing;
-	struct bgr_image *neighbours;
-	unsigned num_bins = (1<<HISTOGRAM_BITS_PER_COLOR);
-	struct bgr_image *qsaved = NULL;
-	struct bgr_image *unquantised = NULL;
+	bool set = mask[x] != 0;
+
+	if (!set) {
+		// masks are mostly clear, so skip clear pixels 8 at a time
+		while (x+8 <= size) {
+			uint64_t v;
+			memcpy(&v, &mask[x], sizeof(v));
+			if (v != 0) {
+				break;
+			}
+			x += 8;
+		}
+	}
+	while (x < size && (mask[x] != 0) == set) {
+		x++;
+	}
+	return x;
+}
 
-        neighbours = allocate_bgr_image8(in->height, in->width, NULL);
+static void merge_min_max(struct bgr *min, struct bgr *max,
+			  const struct bgr *min2, const struct bgr *max2)
+{
+	min->b = MIN(min->b, min2->b);
+	min->g = MIN(min->g, min2->g);
+	min->r = MIN(min->r, min2->r);
+	max->b = MAX(max->b, max2->b);
+	max->g = MAX(max->g, max2->g);
+	max->r = MAX(max->r, max2->r);
+}
 
-        if (scan_params->save_intermediate) {
-            colour_save_pnm("1original.pnm", in);
+/*
+  work for one thread of the threaded colour histogram stages. Each
+  band builds its own partial histogram which is then summed.
+
+  A band is nrows rows of row_size pixels. The input rows and mask
+  rows are row_stride and mask_stride bytes apart, while the
+  quantised and output rows follow each other. A contiguous image is
+  split into bands of whole 8 pixel blocks with one long row each.
+  Pixels with a non-zero mask value are left out of the min/max and
+  the histogram, and are zero in the output
+ */
+struct histogram_band {
+	const struct scan_params *scan_params;
+	const struct bgr *in;
+	const uint8_t *mask;
+	uint32_t row_stride, mask_stride;
+	uint32_t row_size, nrows;
+	struct bgr *quantised;
+	struct bgr *out;
+	struct bgr min, max;
+	uint32_t masked;
+	const struct bgr *qmin;
+	const struct bgr *bin_spacing;
+	const struct histogram *histogram;
+	struct histogram partial;
+};
 
-                unquantised = allocate_bgr_image8(in->height, in->width, NULL);
-                qsaved = allocate_bgr_image8(in->height, in->width, NULL);
-        }
+static inline const struct bgr *band_in_row(const struct histogram_band *band, uint32_t y)
+{
+	return (const struct bgr *)(y*band->row_stride + (const uint8_t *)band->in);
+}
+
+static inline const uint8_t *band_mask_row(const struct histogram_band *band, uint32_t y)
+{
+	return band->mask + y*band->mask_stride;
+}
 
+static void band_get_min_max(const struct bgr *in, uint32_t size,
+			     struct bgr *min, struct bgr *max)
+{
+	struct bgr min2, max2;
 #ifdef __ARM_NEON__
-	get_min_max_neon(&in->data[0][0], in->width*in->height, &min, &max);
+	get_min_max_neon(in, size, &min2, &max2);
 #else
-	get_min_max(&in->data[0][0], in->width*in->height, &min, &max);
-#endif
-
-#if 0
-        printf("sc=%u blue_emphasis=%d red %u %u  green %u %u  blue %u %u\n",
-               scanner_count,
-               (int)scan_params->blue_emphasis,
-               min.r, max.r,
-               min.g, max.g,
-               min.b, max.b);
+	kernels->get_min_max(in, size, &min2, &max2);
 #endif
+	merge_min_max(min, max, &min2, &max2);
+}
 
-#if 0
-	struct bgr min2, max2;
-	if (!bgr_equal(&min, &min2) ||
-	    !bgr_equal(&max, &max2)) {
-		printf("get_min_max_neon failure\n");
+static void *band_min_max(void *arg)
+{
+	struct histogram_band *band = arg;
+	uint32_t x, y;
+
+	band->min.r = band->min.g = band->min.b = 255;
+	band->max.r = band->max.g = band->max.b = 0;
+
+	for (y=0; y<band->nrows; y++) {
+		const struct bgr *in = band_in_row(band, y);
+		const uint8_t *mask;
+		if (band->mask == NULL) {
+			band_get_min_max(in, band->row_size, &band->min, &band->max);
+			continue;
+		}
+		mask = band_mask_row(band, y);
+		for (x=0; x<band->row_size; ) {
+			uint32_t end = mask_run(mask, x, band->row_size);
+			if (!mask[x]) {
+				band_get_min_max(&in[x], end - x, &band->min, &band->max);
+			}
+			x = end;
+		}
 	}
-#endif
-
-
-	bin_spacing.r = 1 + (max.r - min.r) / num_bins;
-	bin_spacing.g = 1 + (max.g - min.g) / num_bins;
-	bin_spacing.b = 1 + (max.b - min.b) / num_bins;
-
-#if 0
-	// try using same spacing on all axes
-	if (bin_spacing.r < bin_spacing.g) bin_spacing.r = bin_spacing.g;
-	if (bin_spacing.r < bin_spacing.b) bin_spacing.r = bin_spacing.b;
-	bin_spacing.g = bin_spacing.r;
-	bin_spacing.b = bin_spacing.b;
-#endif
-
-
-	quantise_image(scan_params, &in->data[0][0], in->width*in->height,
-                       &quantised->data[0][0], &min, &bin_spacing);
-
-        if (scan_params->save_intermediate) {
-                unquantise_image(quantised, unquantised, &min, &bin_spacing);
-                colour_save_pnm("1unquantised.pnm", unquantised);
-        }
-
-	build_histogram(&quantised->data[0][0], in->width*in->height, histogram);
-
-        if (scan_params->save_intermediate) {
-                copy_bgr_image8(quantised, qsaved);
-                histogram_threshold(quantised, histogram, scan_params->histogram_count_threshold);
-                unquantise_image(quantised, unquantised, &min, &bin_spacing);
-                colour_save_pnm("2thresholded.pnm", unquantised);
-                copy_bgr_image8(qsaved, quantised);
-        }
+	return NULL;
+}
 
+static void *band_quantise(void *arg)
+{
+	struct histogram_band *band = arg;
+	uint32_t i, x, y;
 
-	histogram_threshold_neighbours(&quantised->data[0][0], in->width*in->height,
-				       &neighbours->data[0][0], histogram, scan_params->histogram_count_threshold);
+	band->masked = 0;
+	kernels->quantise_image(band->scan_params, band->in, band->row_stride,
+				band->row_size, band->nrows, band->quantised,
+				band->qmin, band->bin_spacing);
+	kernels->build_histogram(band->quantised, band->row_size*band->nrows, &band->partial);
 
-        if (scan_params->save_intermediate) {
-                unquantise_image(neighbours, unquantised, &min, &bin_spacing);
-                colour_save_pnm("3neighbours.pnm", unquantised);
-                free(unquantised);
-                free(qsaved);
-        }
+	/*
+	  take the masked pixels back out of the histogram. The counts
+	  wrap, so this gives the same result as never counting them
+	 */
+	if (band->mask != NULL) {
+		for (y=0; y<band->nrows; y++) {
+			const uint8_t *mask = band_mask_row(band, y);
+			const struct bgr *q = band->quantised + y*band->row_size;
+			for (x=0; x<band->row_size; ) {
+				uint32_t end = mask_run(mask, x, band->row_size);
+				if (mask[x]) {
+					band->masked += end - x;
+					for (i=x; i<end; i++) {
+						band->partial.count[bgr_bin(&q[i])]--;
+					}
+				}
+				x = end;
+			}
+		}
+	}
+	return NULL;
+}
 
-	copy_bgr_image8(neighbours, out);
+static void *band_threshold(void *arg)
+{
+	struct histogram_band *band = arg;
+	uint32_t x, y;
+
+	histogram_threshold_neighbours(band->quantised, band->row_size*band->nrows, band->out,
+				       band->histogram,
+				       band->scan_params->histogram_count_threshold);
+	if (band->mask != NULL) {
+		for (y=0; y<band->nrows; y++) {
+			const uint8_t *mask = band_mask_row(band, y);
+			struct bgr *out = band->out + y*band->row_size;
+			for (x=0; x<band->row_size; ) {
+				uint32_t end = mask_run(mask, x, band->row_size);
+				if (mask[x]) {
+					memset(&out[x], 0, (end - x)*sizeof(struct bgr));
+				}
+				x = end;
+			}
+		}
+	}
+	return NULL;
+}
 
-	free(neighbours);
+/*
+  the distance in bytes between the rows of an image header
+ */
+static uint32_t bgr_image_stride(const struct bgr_image *img)
+{
+	if (img->height < 2) {
+		return 3*img->width;
+	}
+	return (const uint8_t *)img->data[1] - (const uint8_t *)img->data[0];
 }
 
-#define REGION_UNKNOWN -2
-#define REGION_NONE -1
+static uint32_t grey_image_stride(const struct grey_image8 *img)
+{
+	if (img->height < 2) {
+		return img->width;
+	}
+	return img->data[1] - img->data[0];
+}
 
 /*
-  find a region number for a pixel by looking at the surrounding pixels
-  up to scan_params.region_merge
+  split an image into bands, returning the number of bands used. The
+  quantised and out images must be contiguous
  */
-static unsigned find_region(const struct scan_params *scan_params,
-                            const struct bgr_image *in, struct regions *out,
-			    int y, int x)
+static unsigned setup_bands(struct histogram_band *bands, unsigned nthreads,
+			    const struct scan_params *scan_params,
+			    const struct bgr_image *in, const struct grey_image8 *mask,
+			    struct bgr_image *quantised, struct bgr_image *out)
 {
-	int yofs, xofs;
-        uint16_t m = MAX(1, scan_params->region_merge/10);
+	uint32_t width = in->width, height = in->height;
+	uint32_t row_stride = bgr_image_stride(in);
+	uint32_t mask_stride = mask ? grey_image_stride(mask) : width;
+	unsigned i;
+
+	nthreads = MAX(1, MIN(nthreads, MAX_SCAN_THREADS));
+
+	if (row_stride == 3*width && mask_stride == width) {
+		uint32_t size = width*height;
+		/*
+		  bands are a multiple of 8 pixels so the NEON min/max
+		  ignores the same tail pixels as it does on the whole image
+		 */
+		uint32_t band_size = (size / nthreads) & ~7U;
+		if (band_size == 0) {
+			nthreads = 1;
+		}
+		for (i=0; i<nthreads; i++) {
+			uint32_t ofs = i*band_size;
+			bands[i].scan_params = scan_params;
+			bands[i].in = &in->data[0][0] + ofs;
+			bands[i].mask = mask ? &mask->data[0][0] + ofs : NULL;
+			bands[i].row_stride = 0;
+			bands[i].mask_stride = 0;
+			bands[i].row_size = (i == nthreads-1) ? size - ofs : band_size;
+			bands[i].nrows = 1;
+			bands[i].quantised = &quantised->data[0][0] + ofs;
+			bands[i].out = &out->data[0][0] + ofs;
+		}
+		return nthreads;
+	}
 
 	/*
-	  we only need to look up or directly to the left, as this function is used
-	  from assign_regions() where we scan from top to bottom, left to right
+	  a strided image is split into bands of whole rows
 	 */
-	for (yofs=-m; yofs <= 0; yofs++) {
-		for (xofs=-m; xofs <= m; xofs++) {
-                        if (yofs+y < 0) continue;
-                        if (xofs+x < 0) continue;
-                        if (xofs+x >= in->width) continue;
-
-			if (out->data[y+yofs][x+xofs] >= 0) {
-				return out->data[y+yofs][x+xofs];
-			}
-		}
+	uint32_t band_rows = height / nthreads;
+	if (band_rows == 0) {
+		nthreads = 1;
 	}
-	for (xofs=-m; xofs < 0; xofs++) {
-		if (xofs+x < 0) continue;
-		if (out->data[y][x+xofs] >= 0) {
-			return out->data[y][x+xofs];
-		}
+	for (i=0; i<nthreads; i++) {
+		uint32_t y = i*band_rows;
+		bands[i].scan_params = scan_params;
+		bands[i].in = in->data[y];
+		bands[i].mask = mask ? mask->data[y] : NULL;
+		bands[i].row_stride = row_stride;
+		bands[i].mask_stride = mask_stride;
+		bands[i].row_size = width;
+		bands[i].nrows = (i == nthreads-1) ? height - y : band_rows;
+		bands[i].quantised = quantised->data[y];
+		bands[i].out = out->data[y];
 	}
-	return REGION_NONE;
+	return nthreads;
 }
 
 /*
-  assign region numbers to contigouus regions of non-zero data in an
-  image
+  run fn over each band, using a thread per band after the first
  */
-static void assign_regions(const struct scan_params *scan_params,
-                           const struct bgr_image *in, struct regions *out)
+static void run_bands(void *(*fn)(void *), struct histogram_band *bands, unsigned nbands)
 {
-	unsigned x, y;
+	pthread_t threads[MAX_SCAN_THREADS];
+	bool started[MAX_SCAN_THREADS];
+	unsigned i;
 
-        out->num_regions = 0;
-        memset(out->region_size, 0, sizeof(out->region_size));
-        memset(out->bounds, 0, sizeof(out->bounds));
-	for (y=0; y<in->height; y++) {
-		for (x=0; x<in->width; x++) {
-			out->data[y][x] = REGION_UNKNOWN;
+	for (i=1; i<nbands; i++) {
+		started[i] = (pthread_create(&threads[i], NULL, fn, &bands[i]) == 0);
+		if (!started[i]) {
+			fn(&bands[i]);
+		}
+	}
+	fn(&bands[0]);
+	for (i=1; i<nbands; i++) {
+		if (started[i]) {
+			pthread_join(threads[i], NULL);
 		}
 	}
+}
 
-	for (y=0; y<in->height; y++) {
-		for (x=0; x<in->width; x++) {
-			if (out->data[y][x] != REGION_UNKNOWN) {
-				/* already assigned a region */
-				continue;
-			}
-			if (is_zero_bgr(&in->data[y][x])) {
-				out->data[y][x] = REGION_NONE;
-				continue;
-			}
+/*
+  rows of an image sampled when checking its colour range against
+  the bins of a temporal histogram
+ */
+#define RANGE_SAMPLE_ROWS 8
 
-			if (out->num_regions == MAX_REGIONS) {
-				return;
-			}
+/*
+  find the min and max of every RANGE_SAMPLE_ROWS'th row of an image,
+  leaving out masked pixels
+ */
+static void sample_min_max(const struct bgr_image *in, const struct grey_image8 *mask,
+			   struct bgr *min, struct bgr *max)
+{
+	uint32_t x, y;
 
-			unsigned r;
-			r = find_region(scan_params, in, out, y, x);
-			if (r == REGION_NONE) {
-			  /* a new region */
-			  r = out->num_regions;
-			  out->num_regions++;
-			  out->bounds[r].minx = x;
-			  out->bounds[r].maxx = x;
-			  out->bounds[r].miny = y;
-			  out->bounds[r].maxy = y;
-			  out->region_size[r] = 1;
-			} else {
-			  /* an existing region */
-			  out->bounds[r].minx = MIN(out->bounds[r].minx, x);
-			  out->bounds[r].miny = MIN(out->bounds[r].miny, y);
-			  out->bounds[r].maxx = MAX(out->bounds[r].maxx, x);
-			  out->bounds[r].maxy = MAX(out->bounds[r].maxy, y);
-			  out->region_size[r] =
-			    (1+out->bounds[r].maxx - out->bounds[r].minx) *
-			    (1+out->bounds[r].maxy - out->bounds[r].miny);
+	min->r = min->g = min->b = 255;
+	max->r = max->g = max->b = 0;
+	for (y=0; y<in->height; y += RANGE_SAMPLE_ROWS) {
+		const struct bgr *row = in->data[y];
+		if (mask == NULL) {
+			band_get_min_max(row, in->width, min, max);
+			continue;
+		}
+		for (x=0; x<in->width; ) {
+			uint32_t end = mask_run(mask->data[y], x, in->width);
+			if (!mask->data[y][x]) {
+				band_get_min_max(&row[x], end - x, min, max);
 			}
-
-			out->data[y][x] = r;
+			x = end;
 		}
 	}
 }
 
 /*
-  remove a region
+  see if the sampled colour range of a frame still fits the bins of a
+  temporal histogram. The range may grow by up to one bin, as those
+  pixels land in the end bins, or shrink to half before the bins are
+  too coarse to be useful
  */
-static void remove_region(struct regions *in, unsigned i)
+static bool temporal_range_stable(const struct temporal_histogram *t,
+				  const struct bgr *min, const struct bgr *max)
 {
-        if (i < in->num_regions-1) {
-                memmove(&in->region_size[i], &in->region_size[i+1],
-                        sizeof(in->region_size[i])*(in->num_regions-(i+1)));
-                memmove(&in->bounds[i], &in->bounds[i+1],
-                        sizeof(in->bounds[i])*(in->num_regions-(i+1)));
-        }
-        in->num_regions--;
+	const uint8_t *tmin = (const uint8_t *)&t->min;
+	const uint8_t *tmax = (const uint8_t *)&t->max;
+	const uint8_t *spacing = (const uint8_t *)&t->bin_spacing;
+	const uint8_t *smin = (const uint8_t *)min;
+	const uint8_t *smax = (const uint8_t *)max;
+	unsigned i;
+
+	for (i=0; i<3; i++) {
+		if (smin[i] > smax[i] ||
+		    smin[i] + spacing[i] < tmin[i] ||
+		    smax[i] > tmax[i] + spacing[i] ||
+		    2*(smax[i] - smin[i]) < tmax[i] - tmin[i]) {
+			return false;
+		}
+	}
+	return true;
 }
 
 /*
-  determine if two regions overlap, taking into account the
-  region_merge size
+  blend the histogram of a frame into a temporal histogram, and
+  replace it with the blended counts
  */
-static bool regions_overlap(const struct scan_params *scan_params,
-                            const struct region_bounds *r1, const struct region_bounds *r2)
+static void temporal_update(struct temporal_histogram *t, float decay,
+			    struct histogram *histogram)
 {
-    uint16_t m = scan_params->region_merge;
-    if (r1->maxx+m < r2->minx) return false;
-    if (r2->maxx+m < r1->minx) return false;
-    if (r1->maxy+m < r2->miny) return false;
-    if (r2->maxy+m < r1->miny) return false;
-    return true;
+	unsigned b;
+
+	for (b=0; b<HISTOGRAM_BINS; b++) {
+		float count = histogram->count[b];
+		if (t->valid) {
+			count = decay*t->count[b] + (1-decay)*count;
+		}
+		t->count[b] = count;
+		histogram->count[b] = count >= 65535 ? 65535 : (uint16_t)(count + 0.5f);
+	}
+	t->valid = true;
 }
 
 /*
-  merge regions that overlap
+  quantise an image, build its colour histogram, and zero the pixels
+  of common colours in out.
+
+  The histogram count threshold is for an image of frame_pixels
+  pixels. If fewer pixels are scanned, because the image is cropped
+  or masked, the threshold is scaled down to match. The colour bins
+  used are returned in qmin and qbin_spacing.
+
+  If temporal is not NULL the histogram is blended with those of
+  earlier frames, and the colour bins are re-used while they still fit.
+  The intermediate images are kept in capture if it is enabled
  */
-static void merge_regions(const struct scan_params *scan_params, struct regions *in)
+static void colour_histogram(struct scan_params *scan_params,
+                             const struct bgr_image *in,
+                             const struct grey_image8 *mask,
+                             struct bgr_image *out,
+                             struct bgr_image *quantised,
+                             struct histogram *histogram,
+                             struct histogram_band *bands,
+                             unsigned nthreads,
+                             uint32_t frame_pixels,
+                             struct temporal_histogram *temporal,
+                             struct stage_capture *capture,
+                             struct scan_timing *timing,
+                             struct bgr *qmin,
+                             struct bgr *qbin_spacing)
 {
-	unsigned i, j;
-        bool found_overlapping = true;
-        while (found_overlapping) {
-                found_overlapping = false;
-                for (i=0; i<in->num_regions; i++) {
-                        for (j=i+1; j<in->num_regions; j++) {
-                            if (regions_overlap(scan_params, &in->bounds[i], &in->bounds[j])) {
-                                        struct region_bounds *b1 = &in->bounds[i];
-                                        struct region_bounds *b2 = &in->bounds[j];
-                                        struct region_bounds b3 = in->bounds[i];
-                                        b3.minx = MIN(b1->minx, b2->minx);
-                                        b3.maxx = MAX(b1->maxx, b2->maxx);
-                                        b3.miny = MIN(b1->miny, b2->miny);
-                                        b3.maxy = MAX(b1->maxy, b2->maxy);
-                                        unsigned new_size = (1+b3.maxx - b3.minx) * (1+b3.maxy - b3.miny);
-                                        if ((new_size <= scan_params->max_region_area &&
-                                             (b3.maxx - b3.minx) <= scan_params->max_region_size_xy &&
-                                             (b3.maxy - b3.miny) <= scan_params->max_region_size_xy) ||
-                                            in->num_regions>20) {
-                                            *b1 = b3;
-                                            // new size is sum of the
-                                            // two regions, not
-                                            // area. This prevents two
-                                            // single pixel regions
-                                            // appearing to be large enough
-                                            in->region_size[i] += in->region_size[j];
-                                            remove_region(in, j);
-                                            j--;
-                                            found_overlapping = true;
-                                        }
-                            }
-                        }
-                }
+	struct bgr min, max;
+	struct bgr bin_spacing;
+	unsigned num_bins = (1<<HISTOGRAM_BITS_PER_COLOR);
+	unsigned nbands, i, b;
+	bool stages = stages_wanted(scan_params, capture);
+	struct bgr_image *img;
+
+        if (stages) {
+                save_stage(scan_params, capture, "1original", in);
+                timing_skip(timing);
         }
-}
 
-static bool region_too_large(const struct scan_params *scan_params, struct regions *in, unsigned i)
-{
-    if (in->region_size[i] > scan_params->max_region_area ||
-        (in->bounds[i].maxx - in->bounds[i].minx) > scan_params->max_region_size_xy ||
-        (in->bounds[i].maxy - in->bounds[i].miny) > scan_params->max_region_size_xy) {
-        return true;
-    }
-    return false;
-}
+	nbands = setup_bands(bands, nthreads, scan_params, in, mask, quantised, out);
+
+	/*
+	  with a temporal histogram the colour bins are kept from
+	  earlier frames while a sample of this frame still fits them,
+	  saving the full min/max pass. Otherwise the history is
+	  restarted with new bins
+	 */
+	bool rescale = true;
+	if (temporal != NULL && temporal->valid &&
+	    temporal->width == in->width && temporal->height == in->height) {
+		sample_min_max(in, mask, &min, &max);
+		rescale = !temporal_range_stable(temporal, &min, &max);
+	}
+
+	if (rescale) {
+		run_bands(band_min_max, bands, nbands);
+		min = bands[0].min;
+		max = bands[0].max;
+		for (i=1; i<nbands; i++) {
+			merge_min_max(&min, &max, &bands[i].min, &bands[i].max);
+		}
+		if (min.r > max.r) {
+			// every pixel is masked
+			min.r = min.g = min.b = 0;
+			max.r = max.g = max.b = 0;
+		}
 
-/*
-  remove any too large regions
- */
-static void prune_large_regions(const struct scan_params *scan_params, struct regions *in)
-{
-	unsigned i;
-	for (i=0; i<in->num_regions; i++) {
-            if (region_too_large(scan_params, in, i)) {
 #if 0
-                    printf("prune1 size=%u xsize=%u ysize=%u range=(min:%u,max:%u,minxy:%u,maxxy:%u)\n",
-                           in->region_size[i],
-                           in->bounds[i].maxx - in->bounds[i].minx,
-                           in->bounds[i].maxy - in->bounds[i].miny,
-                           scan_params->min_region_area,
-                           scan_params->max_region_area,
-                           scan_params->min_region_size_xy,
-                           scan_params->max_region_size_xy);
+		printf("sc=%u blue_emphasis=%d red %u %u  green %u %u  blue %u %u\n",
+		       scanner_count,
+		       (int)scan_params->blue_emphasis,
+		       min.r, max.r,
+		       min.g, max.g,
+		       min.b, max.b);
 #endif
-                    remove_region(in, i);
-                    i--;
-            }
-        }
-}
 
-/*
-  remove any too small regions
- */
-static void prune_small_regions(const struct scan_params *scan_params, struct regions *in)
-{
-	unsigned i;
-	for (i=0; i<in->num_regions; i++) {
-		if (in->region_size[i] < scan_params->min_region_area ||
-		    (in->bounds[i].maxx - in->bounds[i].minx) < scan_params->min_region_size_xy ||
-		    (in->bounds[i].maxy - in->bounds[i].miny) < scan_params->min_region_size_xy) {
+		bin_spacing.r = 1 + (max.r - min.r) / num_bins;
+		bin_spacing.g = 1 + (max.g - min.g) / num_bins;
+		bin_spacing.b = 1 + (max.b - min.b) / num_bins;
+
 #if 0
-                        printf("prune2 size=%u xsize=%u ysize=%u range=(min:%u,max:%u,minxy:%u,maxxy:%u)\n",
-                               in->region_size[i],
-                               in->bounds[i].maxx - in->bounds[i].minx,
-                               in->bounds[i].maxy - in->bounds[i].miny,
-                               scan_params->min_region_area,
-                               scan_params->max_region_area,
-                               scan_params->min_region_size_xy,
-                               scan_params->max_region_size_xy);
+		// try using same spacing on all axes
+		if (bin_spacing.r < bin_spacing.g) bin_spacing.r = bin_spacing.g;
+		if (bin_spacing.r < bin_spacing.b) bin_spacing.r = bin_spacing.b;
+		bin_spacing.g = bin_spacing.r;
+		bin_spacing.b = bin_spacing.b;
 #endif
-                        remove_region(in, i);
-			i--;
+
+		if (temporal != NULL) {
+			temporal->valid = false;
+			temporal->width = in->width;
+			temporal->height = in->height;
+			temporal->min = min;
+			temporal->max = max;
+			temporal->bin_spacing = bin_spacing;
+		}
+	} else {
+		min = temporal->min;
+		max = temporal->max;
+		bin_spacing = temporal->bin_spacing;
+	}
+
+	for (i=0; i<nbands; i++) {
+		bands[i].qmin = &min;
+		bands[i].bin_spacing = &bin_spacing;
+		bands[i].histogram = histogram;
+	}
+	run_bands(band_quantise, bands, nbands);
+	timing_mark(timing, STAGE_QUANTISE);
+
+	/*
+	  the counts wrap in the same way as a single pass over the
+	  whole image, so the result does not depend on the band count
+	 */
+	*histogram = bands[0].partial;
+	for (i=1; i<nbands; i++) {
+		for (b=0; b<HISTOGRAM_BINS; b++) {
+			histogram->count[b] += bands[i].partial.count[b];
 		}
+	}
+
+	/*
+	  the rarity threshold is a fraction of the pixels scanned
+	 */
+	uint32_t scanned_pixels = in->width*in->height;
+	for (i=0; i<nbands; i++) {
+		scanned_pixels -= bands[i].masked;
+	}
+	if (scanned_pixels < frame_pixels) {
+		scan_params->histogram_count_threshold =
+			MAX(1, (uint64_t)scan_params->histogram_count_threshold * scanned_pixels / frame_pixels);
+	}
 
+	if (temporal != NULL) {
+		temporal_update(temporal, scan_params->histogram_decay, histogram);
 	}
+	timing_mark(timing, STAGE_HISTOGRAM);
+
+        if (stages) {
+                img = allocate_bgr_image8(in->height, in->width, NULL);
+                if (img != NULL) {
+                        unquantise_image(quantised, img, &min, &bin_spacing);
+                }
+                keep_stage(scan_params, capture, "1unquantised", img);
+
+                img = allocate_bgr_image8(in->height, in->width, NULL);
+                if (img != NULL) {
+                        copy_bgr_image8(quantised, img);
+                        histogram_threshold(img, histogram, scan_params->histogram_count_threshold);
+                        unquantise_image(img, img, &min, &bin_spacing);
+                }
+                keep_stage(scan_params, capture, "2thresholded", img);
+                timing_skip(timing);
+        }
+
+	run_bands(band_threshold, bands, nbands);
+	timing_mark(timing, STAGE_HISTOGRAM);
+
+        if (stages) {
+                img = allocate_bgr_image8(in->height, in->width, NULL);
+                if (img != NULL) {
+                        unquantise_image(out, img, &min, &bin_spacing);
+                }
+                keep_stage(scan_params, capture, "3neighbours", img);
+                timing_skip(timing);
+        }
+
+        *qmin = min;
+        *qbin_spacing = bin_spacing;
 }
 
+#define REGION_NONE -1
 
 /*
-  score one region in an image
-
-  A score of 1000 is maximum, and means that every pixel that was
-  below the detection threshold was maximally rare
+  make sure the region arrays can hold at least n regions
  */
-static float score_one_region(const struct scan_params *scan_params,
-                              const struct region_bounds *bounds,
-                              const struct bgr_image *quantised,
-                              const struct histogram *histogram)
+static bool regions_grow(struct regions *r, unsigned n)
 {
-    float score = 0;
-    uint16_t count = 0;
-    uint16_t width, height;
-    width  = 1 + bounds->maxx - bounds->minx;
-    height = 1 + bounds->maxy - bounds->miny;
-
-    //malloc the 2D array
-    double **pixel_scores = malloc(sizeof *pixel_scores * height);
-    if (pixel_scores)
-    {
-      for (int i = 0; i < height; i++)
-      {
-        pixel_scores[i] = malloc(sizeof *pixel_scores[i] * width);
-      }
-    }
+        unsigned max_regions;
+        void *p;
 
-    for (uint16_t y=bounds->miny; y<=bounds->maxy; y++) {
-        for (uint16_t x=bounds->minx; x<=bounds->maxx; x++) {
-            const struct bgr *v = &quantised->data[y][x];
-            uint16_t b = bgr_bin(v);
-            double *scorep = &pixel_scores[y-bounds->miny][x-bounds->minx]; //PyArray_GETPTR2(pixel_scores, y-bounds->miny, x-bounds->minx);
-            if (histogram->count[b] >= scan_params->histogram_count_threshold) {
-                    *scorep = 0;
-                    continue;
-            }
-            int diff = (scan_params->histogram_count_threshold - histogram->count[b]);
-            count++;
-            score += diff;
-            *scorep = diff;
+        if (n <= r->max_regions) {
+                return true;
         }
-    }
-    if (count == 0) {
-        return 0;
-    }
-
-    //free the pixel_scores array
-    if (pixel_scores)
-    {
-      for (int i = 0; i < height; i++)
-      {
-        free(pixel_scores[i]);
-      }
-    }
-    free(pixel_scores);
-
-    return 1000.0 * score / (count * scan_params->histogram_count_threshold);
+        max_regions = MAX(n, MAX(2*r->max_regions, 1024));
+
+        p = realloc(r->region_size, max_regions * sizeof(r->region_size[0]));
+        if (p == NULL) return false;
+        r->region_size = p;
+        p = realloc(r->pixel_count, max_regions * sizeof(r->pixel_count[0]));
+        if (p == NULL) return false;
+        r->pixel_count = p;
+        p = realloc(r->bounds, max_regions * sizeof(r->bounds[0]));
+        if (p == NULL) return false;
+        r->bounds = p;
+        p = realloc(r->region_score, max_regions * sizeof(r->region_score[0]));
+        if (p == NULL) return false;
+        r->region_score = p;
+        p = realloc(r->parent, max_regions * sizeof(r->parent[0]));
+        if (p == NULL) return false;
+        r->parent = p;
+        p = realloc(r->merge_queue, max_regions * sizeof(r->merge_queue[0]));
+        if (p == NULL) return false;
+        r->merge_queue = p;
+        p = realloc(r->merge_stamp, max_regions * sizeof(r->merge_stamp[0]));
+        if (p == NULL) return false;
+        r->merge_stamp = p;
+
+        count_alloc(r->allocs, 7, max_regions * (sizeof(r->region_size[0]) + sizeof(r->pixel_count[0]) +
+                                                 sizeof(r->bounds[0]) + sizeof(r->region_score[0]) +
+                                                 sizeof(r->parent[0]) + sizeof(r->merge_queue[0]) +
+                                                 sizeof(r->merge_stamp[0])));
+        r->max_regions = max_regions;
+        return true;
 }
 
+static void regions_free(struct regions *r)
+{
+        if (r == NULL) {
+                return;
+        }
+        free(r->region_size);
+        free(r->pixel_count);
+        free(r->bounds);
+        free(r->region_score);
+        free(r->parent);
+        free(r->row_labels);
+        free(r->grid);
+        free(r->grid_entries);
+        free(r->merge_queue);
+        free(r->merge_stamp);
+        free(r);
+}
 
 /*
-  score the regions based on their histogram.
-  Score is the sum of the distance below the histogram theshold for
-  all pixels in the region, divided by the number of pixels that were
-  below the threshold
+  find the root label of a provisional label. Roots are always the
+  smallest label in their set, so parent[i] <= i
  */
-static void score_regions(const struct scan_params *scan_params,
-                          struct regions *in,
-                          const struct bgr_image *quantised, const struct histogram *histogram)
+static inline uint32_t label_find(uint32_t *parent, uint32_t i)
 {
-	unsigned i;
-	for (i=0; i<in->num_regions; i++) {
-                in->region_score[i] = score_one_region(scan_params,
-                                                       &in->bounds[i], quantised, histogram);
+        while (parent[i] != i) {
+                parent[i] = parent[parent[i]];
+                i = parent[i];
         }
+        return i;
 }
 
 /*
-  draw a square on an image
+  join the sets of two labels, returning the new root
  */
-static void draw_square(struct bgr_image *img,
-			const struct bgr *c,
-			uint16_t left,
-			uint16_t top,
-			uint16_t right,
-			uint16_t bottom)
+static inline uint32_t label_union(uint32_t *parent, uint32_t a, uint32_t b)
 {
-	uint16_t x, y;
-	for (x=left; x<= right; x++) {
-		img->data[top][x] = *c;
+        a = label_find(parent, a);
+        b = label_find(parent, b);
+        if (a < b) {
+                parent[b] = a;
+                return a;
+        }
+        parent[a] = b;
+        return b;
+}
+
+static inline void bounds_extend(struct region_bounds *b, const struct region_bounds *b2)
+{
+        b->minx = MIN(b->minx, b2->minx);
+        b->miny = MIN(b->miny, b2->miny);
+        b->maxx = MAX(b->maxx, b2->maxx);
+        b->maxy = MAX(b->maxy, b2->maxy);
+}
+
+/*
+  return true if 8 pixels starting at p are all zero
+ */
+static inline bool is_zero_bgr8(const struct bgr *p)
+{
+        uint64_t v[3];
+        memcpy(v, p, sizeof(v));
+        return (v[0] | v[1] | v[2]) == 0;
+}
+
+/*
+  make sure there is room for m+1 rows of provisional labels
+ */
+static bool row_labels_alloc(struct regions *out, int m, int width)
+{
+        if (out->row_labels_size < (uint32_t)((m+1)*width)) {
+                free(out->row_labels);
+                out->row_labels_size = 0;
+                out->row_labels = malloc((m+1)*width*sizeof(int32_t));
+                if (out->row_labels == NULL) {
+                        return false;
+                }
+                out->row_labels_size = (m+1)*width;
+                count_alloc(out->allocs, 1, (m+1)*width*sizeof(int32_t));
+        }
+        return true;
+}
+
+/*
+  give a non-zero pixel the label of an already labelled neighbour
+  above or to the left within m pixels, recording label equivalences
+  with union-find, or a new label if it has none. Inlined into each
+  version of assign_regions
+ */
+static inline __attribute__((always_inline))
+void label_pixel(struct regions *out, int m, int width, int x, int y,
+                 int32_t *labels, unsigned *num_labels)
+{
+        int xofs, yofs;
+        int32_t r = REGION_NONE;
+
+        /*
+          look at the pixels above and to the left,
+          which have already been labelled
+         */
+        for (yofs=-m; yofs <= 0; yofs++) {
+                if (y+yofs < 0) continue;
+                const int32_t *nlabels = &out->row_labels[((y+yofs) % (m+1))*width];
+                int xmax = (yofs == 0) ? -1 : m;
+                for (xofs=-m; xofs <= xmax; xofs++) {
+                        if (x+xofs < 0) continue;
+                        if (x+xofs >= width) break;
+                        int32_t r2 = nlabels[x+xofs];
+                        if (r2 < 0 || r2 == r) continue;
+                        if (r == REGION_NONE) {
+                                r = r2;
+                        } else {
+                                r = label_union(out->parent, r, r2);
+                        }
+                }
+        }
+
+        struct region_bounds *b;
+        if (r == REGION_NONE) {
+                /* a new label */
+                if (!regions_grow(out, *num_labels+1)) {
+                        return;
+                }
+                r = (*num_labels)++;
+                out->parent[r] = r;
+                b = &out->bounds[r];
+                b->minx = b->maxx = x;
+                b->miny = b->maxy = y;
+                out->pixel_count[r] = 1;
+        } else {
+                /* an existing label */
+                b = &out->bounds[r];
+                b->minx = MIN(b->minx, x);
+                b->maxx = MAX(b->maxx, x);
+                b->maxy = y;
+                out->pixel_count[r]++;
+        }
+        labels[x] = r;
+}
+
+/*
+  fold the labels into regions. Every label points at a smaller label
+  in its set, so after folding labels in order each parent entry can
+  be replaced by the region number of its set. Roots are the smallest
+  label in their set, so the regions stay in the order they were
+  first seen, and a region slot is only written once all the labels
+  that used it have been folded. The size of each region is then the
+  area of its bounding box
+ */
+static void fold_labels(struct regions *out, unsigned num_labels)
+{
+        uint32_t *parent = out->parent;
+        unsigned i;
+
+        for (i=0; i<num_labels; i++) {
+                unsigned r;
+                if (parent[i] == i) {
+                        r = out->num_regions++;
+                        out->bounds[r] = out->bounds[i];
+                        out->pixel_count[r] = out->pixel_count[i];
+                } else {
+                        r = parent[parent[i]];
+                        bounds_extend(&out->bounds[r], &out->bounds[i]);
+                        out->pixel_count[r] += out->pixel_count[i];
+                }
+                parent[i] = r;
+        }
+        for (i=0; i<out->num_regions; i++) {
+                const struct region_bounds *b = &out->bounds[i];
+                out->region_size[i] = (1+b->maxx - b->minx) * (1+b->maxy - b->miny);
+        }
+}
+
+/*
+  assign region numbers to contiguous regions of non-zero data in an
+  image.
+
+  Pixels are connected if they are within scan_params.region_merge/10
+  pixels of each other. The first pass gives each pixel the label of
+  an already labelled neighbour above or to the left, recording label
+  equivalences with union-find, along with the bounds and pixel count
+  of each label. Only the last m+1 rows of labels are kept. The second
+  pass folds each set of equivalent labels into one region, so the
+  image is only scanned once
+ */
+static void assign_regions(const struct scan_params *scan_params,
+                           const struct bgr_image *in, struct regions *out)
+{
+	int x, y;
+        int m = MAX(1, scan_params->region_merge/10);
+        int width = in->width, height = in->height;
+        unsigned num_labels = 0;
+
+        out->num_regions = 0;
+        if (!row_labels_alloc(out, m, width)) {
+                return;
+        }
+
+	for (y=0; y<height; y++) {
+                const struct bgr *row = in->data[y];
+                int32_t *labels = &out->row_labels[(y % (m+1))*width];
+                memset(labels, 0xFF, width*sizeof(int32_t));
+		for (x=0; x<width; x++) {
+                        if ((x & 7) == 0 && x+8 <= width && is_zero_bgr8(&row[x])) {
+                                x += 7;
+                                continue;
+                        }
+			if (is_zero_bgr(&row[x])) {
+				continue;
+			}
+                        label_pixel(out, m, width, x, y, labels, &num_labels);
+		}
+	}
+
+        fold_labels(out, num_labels);
+}
+
+/*
+  assign region numbers to contiguous regions of non-zero pixels in
+  an 8 bit image, in the same way as assign_regions()
+ */
+static void assign_regions_grey(const struct scan_params *scan_params,
+                                const struct grey_image8 *in, struct regions *out)
+{
+	int x, y;
+        int m = MAX(1, scan_params->region_merge/10);
+        int width = in->width, height = in->height;
+        unsigned num_labels = 0;
+
+        out->num_regions = 0;
+        if (!row_labels_alloc(out, m, width)) {
+                return;
+        }
+
+	for (y=0; y<height; y++) {
+                const uint8_t *row = in->data[y];
+                int32_t *labels = &out->row_labels[(y % (m+1))*width];
+                memset(labels, 0xFF, width*sizeof(int32_t));
+		for (x=0; x<width; x++) {
+                        if ((x & 7) == 0 && x+8 <= width) {
+                                uint64_t v;
+                                memcpy(&v, &row[x], sizeof(v));
+                                if (v == 0) {
+                                        x += 7;
+                                        continue;
+                                }
+                        }
+			if (row[x] == 0) {
+				continue;
+			}
+                        label_pixel(out, m, width, x, y, labels, &num_labels);
+		}
+	}
+
+        fold_labels(out, num_labels);
+}
+
+/*
+  copy region i to slot n, used when compacting the region list
+ */
+static inline void copy_region(struct regions *in, unsigned n, unsigned i)
+{
+        if (n != i) {
+                in->region_size[n] = in->region_size[i];
+                in->pixel_count[n] = in->pixel_count[i];
+                in->bounds[n] = in->bounds[i];
+        }
+}
+
+/*
+  determine if two regions overlap, taking into account the
+  region_merge size
+ */
+static bool regions_overlap(const struct scan_params *scan_params,
+                            const struct region_bounds *r1, const struct region_bounds *r2)
+{
+    uint16_t m = scan_params->region_merge;
+    if (r1->maxx+m < r2->minx) return false;
+    if (r2->maxx+m < r1->minx) return false;
+    if (r1->maxy+m < r2->miny) return false;
+    if (r2->maxy+m < r1->miny) return false;
+    return true;
+}
+
+/*
+  the range of grid cells covered by a region, optionally grown by
+  the merge distance
+ */
+struct grid_range {
+        unsigned x1, y1, x2, y2;
+};
+
+struct merge_grid {
+        unsigned cell_size;
+        unsigned width, height;
+};
+
+static void grid_cells(const struct merge_grid *g, const struct region_bounds *b,
+                       unsigned m, struct grid_range *c)
+{
+        c->x1 = (b->minx > m ? b->minx - m : 0) / g->cell_size;
+        c->y1 = (b->miny > m ? b->miny - m : 0) / g->cell_size;
+        c->x2 = MIN((b->maxx + m) / g->cell_size, g->width-1);
+        c->y2 = MIN((b->maxy + m) / g->cell_size, g->height-1);
+}
+
+/*
+  add region i to the grid cells in range c that are not in range old
+ */
+static bool grid_insert(struct regions *in, const struct merge_grid *g, unsigned i,
+                        const struct grid_range *c, const struct grid_range *old)
+{
+        unsigned x, y;
+        for (y=c->y1; y<=c->y2; y++) {
+                for (x=c->x1; x<=c->x2; x++) {
+                        if (old != NULL &&
+                            x >= old->x1 && x <= old->x2 &&
+                            y >= old->y1 && y <= old->y2) {
+                                continue;
+                        }
+                        if (in->num_grid_entries == in->max_grid_entries) {
+                                unsigned n = MAX(2*in->max_grid_entries, 1024);
+                                void *p = realloc(in->grid_entries, n * sizeof(in->grid_entries[0]));
+                                if (p == NULL) {
+                                        return false;
+                                }
+                                in->grid_entries = p;
+                                in->max_grid_entries = n;
+                                count_alloc(in->allocs, 1, n * sizeof(in->grid_entries[0]));
+                        }
+                        int32_t *cell = &in->grid[y*g->width + x];
+                        struct grid_entry *e = &in->grid_entries[in->num_grid_entries];
+                        e->region = i;
+                        e->next = *cell;
+                        *cell = in->num_grid_entries++;
+                }
+        }
+        return true;
+}
+
+static void queue_push(uint32_t *q, unsigned *n, uint32_t v)
+{
+        unsigned i = (*n)++;
+        while (i > 0 && q[(i-1)/2] > v) {
+                q[i] = q[(i-1)/2];
+                i = (i-1)/2;
+        }
+        q[i] = v;
+}
+
+static uint32_t queue_pop(uint32_t *q, unsigned *n)
+{
+        uint32_t ret = q[0];
+        uint32_t v = q[--(*n)];
+        unsigned i = 0;
+        while (2*i+1 < *n) {
+                unsigned c = 2*i+1;
+                if (c+1 < *n && q[c+1] < q[c]) c++;
+                if (v <= q[c]) break;
+                q[i] = q[c];
+                i = c;
+        }
+        q[i] = v;
+        return ret;
+}
+
+/*
+  queue the live regions numbered above min_j that share a grid cell
+  with range c, and that have not already been queued under stamp
+ */
+static void queue_neighbours(struct regions *in, const struct merge_grid *g,
+                             const struct grid_range *c, unsigned min_j,
+                             uint32_t stamp, unsigned *nqueue)
+{
+        unsigned x, y;
+        for (y=c->y1; y<=c->y2; y++) {
+                for (x=c->x1; x<=c->x2; x++) {
+                        int32_t e;
+                        for (e=in->grid[y*g->width + x]; e != -1; e=in->grid_entries[e].next) {
+                                uint32_t j = in->grid_entries[e].region;
+                                if (j <= min_j || in->parent[j] != j || in->merge_stamp[j] == stamp) {
+                                        continue;
+                                }
+                                in->merge_stamp[j] = stamp;
+                                queue_push(in->merge_queue, nqueue, j);
+                        }
+                }
+        }
+}
+
+/*
+  merge regions that overlap
+
+  Each pass visits the regions in order, merging into each region the
+  later regions that overlap it, in order. Regions are bucketed in a
+  grid of cells at least region_merge pixels across, so only regions
+  in nearby cells are tested. A merged region is marked by pointing
+  its parent at the region it was merged into, and the survivors are
+  compacted once no more merges are found
+ */
+static void merge_regions(const struct scan_params *scan_params, struct regions *in)
+{
+	unsigned i, n;
+        unsigned m = scan_params->region_merge;
+        unsigned num_live = in->num_regions;
+        uint32_t stamp = 0;
+        bool found_overlapping = true;
+        struct merge_grid g;
+
+        if (in->num_regions < 2) {
+                return;
+        }
+
+        g.cell_size = MAX(m, 16);
+        g.width = (in->width + g.cell_size - 1) / g.cell_size;
+        g.height = (in->height + g.cell_size - 1) / g.cell_size;
+        if (in->grid_size < g.width*g.height) {
+                free(in->grid);
+                in->grid_size = 0;
+                in->grid = malloc(g.width*g.height*sizeof(in->grid[0]));
+                if (in->grid == NULL) {
+                        return;
+                }
+                in->grid_size = g.width*g.height;
+                count_alloc(in->allocs, 1, g.width*g.height*sizeof(in->grid[0]));
+        }
+        memset(in->grid, 0xFF, g.width*g.height*sizeof(in->grid[0]));
+        in->num_grid_entries = 0;
+
+        for (i=0; i<in->num_regions; i++) {
+                struct grid_range c;
+                in->parent[i] = i;
+                in->merge_stamp[i] = 0;
+                grid_cells(&g, &in->bounds[i], 0, &c);
+                if (!grid_insert(in, &g, i, &c, NULL)) {
+                        return;
+                }
+        }
+
+        while (found_overlapping) {
+                found_overlapping = false;
+                for (i=0; i<in->num_regions; i++) {
+                        struct grid_range c;
+                        unsigned nqueue = 0;
+                        if (in->parent[i] != i) {
+                                continue;
+                        }
+                        stamp++;
+                        grid_cells(&g, &in->bounds[i], m, &c);
+                        queue_neighbours(in, &g, &c, i, stamp, &nqueue);
+                        while (nqueue > 0) {
+                                uint32_t j = queue_pop(in->merge_queue, &nqueue);
+                                if (!regions_overlap(scan_params, &in->bounds[i], &in->bounds[j])) {
+                                        continue;
+                                }
+                                struct region_bounds b3 = in->bounds[i];
+                                bounds_extend(&b3, &in->bounds[j]);
+                                unsigned new_size = (1+b3.maxx - b3.minx) * (1+b3.maxy - b3.miny);
+                                if ((new_size <= scan_params->max_region_area &&
+                                     (b3.maxx - b3.minx) <= scan_params->max_region_size_xy &&
+                                     (b3.maxy - b3.miny) <= scan_params->max_region_size_xy) ||
+                                    num_live>20) {
+                                        struct grid_range old, c2;
+                                        grid_cells(&g, &in->bounds[i], 0, &old);
+                                        in->bounds[i] = b3;
+                                        // new size is sum of the
+                                        // two regions, not
+                                        // area. This prevents two
+                                        // single pixel regions
+                                        // appearing to be large enough
+                                        in->region_size[i] += in->region_size[j];
+                                        in->pixel_count[i] += in->pixel_count[j];
+                                        in->parent[j] = i;
+                                        num_live--;
+                                        found_overlapping = true;
+
+                                        /*
+                                          the region has grown, so
+                                          queue any later regions
+                                          that it may now overlap
+                                         */
+                                        grid_cells(&g, &b3, 0, &c2);
+                                        if (!grid_insert(in, &g, i, &c2, &old)) {
+                                                found_overlapping = false;
+                                                break;
+                                        }
+                                        grid_cells(&g, &b3, m, &c2);
+                                        queue_neighbours(in, &g, &c2, j, stamp, &nqueue);
+                                }
+                        }
+                }
+        }
+
+        for (i=n=0; i<in->num_regions; i++) {
+                if (in->parent[i] == i) {
+                        copy_region(in, n++, i);
+                }
+        }
+        in->num_regions = n;
+}
+
+static bool region_too_large(const struct scan_params *scan_params, struct regions *in, unsigned i)
+{
+    if (in->region_size[i] > scan_params->max_region_area ||
+        (in->bounds[i].maxx - in->bounds[i].minx) > scan_params->max_region_size_xy ||
+        (in->bounds[i].maxy - in->bounds[i].miny) > scan_params->max_region_size_xy) {
+        return true;
+    }
+    return false;
+}
+
+/*
+  remove any too large regions
+ */
+static void prune_large_regions(const struct scan_params *scan_params, struct regions *in)
+{
+	unsigned i, n=0;
+	for (i=0; i<in->num_regions; i++) {
+            if (region_too_large(scan_params, in, i)) {
+#if 0
+                    printf("prune1 size=%u xsize=%u ysize=%u range=(min:%u,max:%u,minxy:%u,maxxy:%u)\n",
+                           in->region_size[i],
+                           in->bounds[i].maxx - in->bounds[i].minx,
+                           in->bounds[i].maxy - in->bounds[i].miny,
+                           scan_params->min_region_area,
+                           scan_params->max_region_area,
+                           scan_params->min_region_size_xy,
+                           scan_params->max_region_size_xy);
+#endif
+                    continue;
+            }
+            copy_region(in, n++, i);
+        }
+        in->num_regions = n;
+}
+
+static bool region_too_small(const struct scan_params *scan_params, struct regions *in, unsigned i)
+{
+    if (in->region_size[i] < scan_params->min_region_area ||
+        (in->bounds[i].maxx - in->bounds[i].minx) < scan_params->min_region_size_xy ||
+        (in->bounds[i].maxy - in->bounds[i].miny) < scan_params->min_region_size_xy) {
+        return true;
+    }
+    return false;
+}
+
+/*
+  remove any too small regions
+ */
+static void prune_small_regions(const struct scan_params *scan_params, struct regions *in)
+{
+	unsigned i, n=0;
+	for (i=0; i<in->num_regions; i++) {
+		if (region_too_small(scan_params, in, i)) {
+#if 0
+                        printf("prune2 size=%u xsize=%u ysize=%u range=(min:%u,max:%u,minxy:%u,maxxy:%u)\n",
+                               in->region_size[i],
+                               in->bounds[i].maxx - in->bounds[i].minx,
+                               in->bounds[i].maxy - in->bounds[i].miny,
+                               scan_params->min_region_area,
+                               scan_params->max_region_area,
+                               scan_params->min_region_size_xy,
+                               scan_params->max_region_size_xy);
+#endif
+                        continue;
+		}
+                copy_region(in, n++, i);
+	}
+        in->num_regions = n;
+}
+
+
+/*
+  score one region in an image
+
+  A score of 1000 is maximum, and means that every pixel that was
+  below the detection threshold was maximally rare
+ */
+static float score_one_region(const struct scan_params *scan_params,
+                              const struct region_bounds *bounds,
+                              const struct bgr_image *quantised,
+                              const struct grey_image8 *mask,
+                              const struct histogram *histogram)
+{
+    float score = 0;
+    uint16_t count = 0;
+
+    for (uint16_t y=bounds->miny; y<=bounds->maxy; y++) {
+        for (uint16_t x=bounds->minx; x<=bounds->maxx; x++) {
+            if (mask != NULL && mask->data[y][x]) {
+                    continue;
+            }
+            const struct bgr *v = &quantised->data[y][x];
+            uint16_t b = bgr_bin(v);
+            if (histogram->count[b] >= scan_params->histogram_count_threshold) {
+                    continue;
+            }
+            int diff = (scan_params->histogram_count_threshold - histogram->count[b]);
+            count++;
+            score += diff;
+        }
+    }
+    if (count == 0) {
+        return 0;
+    }
+
+    return 1000.0 * score / (count * scan_params->histogram_count_threshold);
+}
+
+
+/*
+  score the regions based on their histogram.
+  Score is the sum of the distance below the histogram theshold for
+  all pixels in the region, divided by the number of pixels that were
+  below the threshold
+ */
+static void score_regions(const struct scan_params *scan_params,
+                          struct regions *in,
+                          const struct bgr_image *quantised,
+                          const struct grey_image8 *mask,
+                          const struct histogram *histogram)
+{
+	unsigned i;
+	for (i=0; i<in->num_regions; i++) {
+                in->region_score[i] = score_one_region(scan_params,
+                                                       &in->bounds[i], quantised, mask, histogram);
+        }
+}
+
+/*
+  draw a square on an image
+ */
+static void draw_square(struct bgr_image *img,
+			const struct bgr *c,
+			uint16_t left,
+			uint16_t top,
+			uint16_t right,
+			uint16_t bottom)
+{
+	uint16_t x, y;
+	for (x=left; x<= right; x++) {
+		img->data[top][x] = *c;
 		img->data[top+1][x] = *c;
 		img->data[bottom][x] = *c;
 		img->data[bottom-1][x] = *c;
 	}
-	for (y=top; y<= bottom; y++) {
-		img->data[y][left] = *c;
-		img->data[y][left+1] = *c;
-		img->data[y][right] = *c;
-		img->data[y][right-1] = *c;
+	for (y=top; y<= bottom; y++) {
+		img->data[y][left] = *c;
+		img->data[y][left+1] = *c;
+		img->data[y][right] = *c;
+		img->data[y][right-1] = *c;
+	}
+}
+
+
+/*
+  mark regions in an image with a blue square
+ */
+static void mark_regions(struct bgr_image *img, const struct regions *r)
+{
+	unsigned i;
+	struct bgr c = { 255, 0, 0 };
+	for (i=0; i<r->num_regions; i++) {
+		draw_square(img,
+			    &c,
+			    MAX(r->bounds[i].minx-2, 0),
+			    MAX(r->bounds[i].miny-2, 0),
+			    MIN(r->bounds[i].maxx+2, (img->width)-1),
+			    MIN(r->bounds[i].maxy+2, (img->height)-1));
+	}
+}
+
+
+/*
+  thermal images are 16 bit big endian, with 14 significant bits
+ */
+#define THERMAL_BITS 14
+
+static inline uint16_t thermal_value(uint16_t raw)
+{
+        if (__BYTE_ORDER == __LITTLE_ENDIAN) {
+                raw = (uint16_t)((raw >> 8) | (raw << 8));
+        }
+        return raw >> 2;
+}
+
+/*
+  the lowest value in a thermal image
+ */
+static uint16_t thermal_min(const uint16_t *data, uint32_t size)
+{
+        uint16_t minv = 0xFFFF;
+        uint32_t i;
+	for (i=0; i<size; i++) {
+                uint16_t value = thermal_value(data[i]);
+                minv = value < minv ? value : minv;
+        }
+        return minv;
+}
+
+/*
+  lookup table from thermal value to colour for thermal_convert, kept
+  for the parameters it was last built for
+ */
+struct thermal_table {
+        bool valid;
+        uint16_t clip_high, clip_low;
+        float blue_threshold, green_threshold;
+        struct bgr colour[1<<THERMAL_BITS];
+};
+
+static struct thermal_table thermal_table;
+static pthread_mutex_t thermal_table_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static uint8_t thermal_map_value(float v, const float threshold)
+{
+        if (v > threshold) {
+                float p = 1.0 - (v - threshold) / (1.0 - threshold);
+                return 255*p;
+        }
+        float p = 1.0 - (threshold - v) / threshold;
+        return 255*p;
+}
+
+static void thermal_table_setup(struct thermal_table *t,
+                                uint16_t clip_high, uint16_t clip_low,
+                                float blue_threshold, float green_threshold)
+{
+        uint32_t value;
+
+        if (t->valid &&
+            t->clip_high == clip_high && t->clip_low == clip_low &&
+            t->blue_threshold == blue_threshold &&
+            t->green_threshold == green_threshold) {
+                return;
+        }
+        for (value=0; value < (1U<<THERMAL_BITS); value++) {
+                float v = 0;
+                if (value >= clip_high) {
+                        v = 1.0;
+                } else if (value > clip_low) {
+                        v = (value - clip_low) / (float)(clip_high - clip_low);
+                }
+                t->colour[value].r = v*255;
+                t->colour[value].b = thermal_map_value(v, blue_threshold);
+                t->colour[value].g = thermal_map_value(v, green_threshold);
+        }
+        t->clip_high = clip_high;
+        t->clip_low = clip_low;
+        t->blue_threshold = blue_threshold;
+        t->green_threshold = green_threshold;
+        t->valid = true;
+}
+
+/*
+  convert a 16 bit thermal image to a colour image. The colour of
+  each thermal value comes from a lookup table, which is only rebuilt
+  when the parameters or the clip_low found from the image change
+ */
+static PyObject *
+scanner_thermal_convert(PyObject *self, PyObject *args)
+{
+	PyArrayObject *img_in, *img_out;
+        unsigned short clip_high, clip_low;
+        float blue_threshold, green_threshold;
+
+	if (!PyArg_ParseTuple(args, "OOHff",
+                              &img_in, &img_out,
+                              &clip_high,
+                              &blue_threshold, &green_threshold))
+		return NULL;
+
+	CHECK_CONTIGUOUS(img_in);
+	CHECK_CONTIGUOUS(img_out);
+
+        uint16_t height = PyArray_DIM(img_in, 0);
+        uint16_t width  = PyArray_DIM(img_in, 1);
+	if (PyArray_STRIDE(img_in, 0) != 2*width) {
+		PyErr_SetString(ScannerError, "input must be 16 bit");
+		return NULL;
+	}
+	if (PyArray_DIM(img_out, 1) != width ||
+	    PyArray_DIM(img_out, 0) != height ||
+	    PyArray_STRIDE(img_out, 0) != 3*width) {
+		PyErr_SetString(ScannerError, "output must be same shape as input and 24 bit");
+		return NULL;
+	}
+
+        const uint16_t *data = PyArray_DATA(img_in);
+        struct bgr *rgb = PyArray_DATA(img_out);
+        uint32_t size = width*height;
+	Py_BEGIN_ALLOW_THREADS;
+
+        uint16_t minv = thermal_min(data, size);
+        clip_low = minv + (clip_high-minv)/10;
+
+        pthread_mutex_lock(&thermal_table_lock);
+        thermal_table_setup(&thermal_table, clip_high, clip_low, blue_threshold, green_threshold);
+	for (uint32_t i=0; i<size; i++) {
+                rgb[i] = thermal_table.colour[thermal_value(data[i])];
+	}
+        pthread_mutex_unlock(&thermal_table_lock);
+
+	Py_END_ALLOW_THREADS;
+	Py_RETURN_NONE;
+}
+
+/*
+  scale the scan parameters for the image being scanned
+ */
+static void scale_scan_params(struct scan_params *scan_params, uint32_t height, uint32_t width)
+{
+    float wscale = width/640.0;
+    float ascale = (width*height)/(640.0*480.0);
+    if (ascale < 1.0) ascale = 1.0;
+    if (wscale < 1.0) wscale = 1.0;
+    *scan_params = scan_params_640_480;
+    scan_params->min_region_area *= ascale;
+    scan_params->max_region_area *= ascale;
+    scan_params->min_region_size_xy *= wscale;
+    scan_params->max_region_size_xy *= wscale;
+    scan_params->histogram_count_threshold *= ascale;
+    scan_params->region_merge *= wscale;
+}
+
+/*
+  lookup a key in a dictionary and return value as a float, or
+  default_value if not found
+ */
+static float dict_lookup(PyObject *parm_dict, const char *key, float default_value)
+{
+    PyObject *obj = PyDict_GetItemString(parm_dict, key);
+    if (obj == NULL || !PyFloat_Check(obj)) {
+        return default_value;
+    }
+    return PyFloat_AsDouble(obj);
+}
+
+/*
+  scale the scan parameters for the image being scanned
+ */
+static void scale_scan_params_user(struct scan_params *scan_params, uint32_t height, uint32_t width, PyObject *parm_dict)
+{
+    float meters_per_pixel = dict_lookup(parm_dict, "MetersPerPixel", 0.1);
+    float meters_per_pixel2 = meters_per_pixel * meters_per_pixel;
+    *scan_params = scan_params_640_480;
+    scan_params->min_region_area = MAX(dict_lookup(parm_dict, "MinRegionArea", 1.0) / meters_per_pixel2, 1);
+    scan_params->max_region_area = MAX(dict_lookup(parm_dict, "MaxRegionArea", 4.0) / meters_per_pixel2, 1);
+    scan_params->min_region_size_xy = MAX(dict_lookup(parm_dict, "MinRegionSize", 0.25) / meters_per_pixel, 1);
+    scan_params->max_region_size_xy = MAX(dict_lookup(parm_dict, "MaxRegionSize", 4.0) / meters_per_pixel, 1);
+    scan_params->histogram_count_threshold = MAX(dict_lookup(parm_dict, "MaxRarityPct", 0.016) * (width*height)/100.0, 1);
+    scan_params->region_merge = MAX(dict_lookup(parm_dict, "RegionMergeSize", 0.5) / meters_per_pixel, 1);
+    scan_params->save_intermediate = dict_lookup(parm_dict, "SaveIntermediate", 0);
+    scan_params->blue_emphasis = dict_lookup(parm_dict, "BlueEmphasis", 0);
+    float pyramid = dict_lookup(parm_dict, "Pyramid", 1);
+    scan_params->pyramid = pyramid >= 4 ? 4 : pyramid >= 2 ? 2 : 1;
+    scan_params->histogram_decay = MIN(MAX(dict_lookup(parm_dict, "HistogramDecay", 0), 0), 0.999);
+    if (scan_params->save_intermediate) {
+        printf("mpp=%f mpp2=%f min_region_area=%u max_region_area=%u min_region_size_xy=%u max_region_size_xy=%u histogram_count_threshold=%u region_merge=%u\n",
+               meters_per_pixel,
+               meters_per_pixel2,
+               scan_params->min_region_area,
+               scan_params->max_region_area,
+               scan_params->min_region_size_xy,
+               scan_params->max_region_size_xy,
+               scan_params->histogram_count_threshold,
+               scan_params->region_merge);
+    }
+}
+
+/*
+  the working buffers for scanning images of one size. These are
+  allocated once and re-used for every frame, so a long running
+  scanner does not need to go back to the allocator for each image
+ */
+struct scanner_state {
+        uint16_t height;
+        uint16_t width;
+        struct scan_params scan_params;
+        // header pointing at the part of the caller's image being
+        // scanned, which starts at roi_x, roi_y
+        struct bgr_image *in;
+        uint16_t roi_x, roi_y;
+        // header pointing at the caller's exclusion mask, and the
+        // mask for the current scan, or NULL if there is none
+        struct grey_image8 *mask_header;
+        const struct grey_image8 *mask;
+        struct bgr_image *quantised;
+        struct bgr_image *himage;
+        struct histogram *histogram;
+        struct regions *regions;
+        // downsampled image and mask for a coarse to fine scan,
+        // allocated on first use, and a header pointing at the part
+        // of the mask around a coarse region
+        struct bgr_image *coarse;
+        struct grey_image8 *coarse_mask;
+        struct grey_image8 *box_mask;
+        // column sums of one row of blocks while downsampling
+        uint16_t *row_sum;
+        // colour histogram of earlier frames, used when the
+        // histogram_decay parameter is set
+        struct temporal_histogram temporal;
+        // intermediate images of the current scan
+        struct stage_capture capture;
+        struct scan_timing timing;
+        // number of threads for the colour histogram stages
+        unsigned threads;
+        struct histogram_band bands[MAX_SCAN_THREADS];
+        // buffers allocated by scans, rather than with the scanner
+        struct alloc_count allocs;
+};
+
+static void scanner_state_free(struct scanner_state *state)
+{
+        if (state == NULL) {
+                return;
+        }
+        free(state->in);
+        free(state->mask_header);
+        free(state->quantised);
+        free(state->himage);
+        free(state->histogram);
+        regions_free(state->regions);
+        free(state->coarse);
+        free(state->coarse_mask);
+        free(state->box_mask);
+        free(state->row_sum);
+        stage_capture_clear(&state->capture);
+        free(state);
+}
+
+/*
+  allocate the scan buffers for a given image size
+ */
+static struct scanner_state *scanner_state_alloc(uint16_t height, uint16_t width)
+{
+        struct scanner_state *state = calloc(1, sizeof(*state));
+        if (state == NULL) {
+                return NULL;
+        }
+        state->height = height;
+        state->width = width;
+        state->in = allocate_bgr_image8_header(height, width);
+        state->mask_header = allocate_grey_image8_header(height, width);
+        state->quantised = allocate_bgr_image8(height, width, NULL);
+        state->himage = allocate_bgr_image8(height, width, NULL);
+        ALLOCATE(state->histogram);
+        state->regions = calloc(1, sizeof(struct regions));
+        if (state->in == NULL || state->mask_header == NULL ||
+            state->quantised == NULL ||
+            state->himage == NULL || state->histogram == NULL ||
+            state->regions == NULL) {
+                scanner_state_free(state);
+                return NULL;
+        }
+        state->regions->height = height;
+        state->regions->width = width;
+        state->regions->allocs = &state->allocs;
+        state->threads = 1;
+        scale_scan_params(&state->scan_params, height, width);
+        return state;
+}
+
+/*
+  return true if a change of scan parameters means the colour
+  histogram of earlier frames can't be carried over. The size limits
+  and rarity threshold don't change the histogram, and as they follow
+  MetersPerPixel they change with altitude on most frames
+ */
+static bool histogram_params_changed(const struct scan_params *p1, const struct scan_params *p2)
+{
+        return p1->blue_emphasis != p2->blue_emphasis ||
+                p1->pyramid != p2->pyramid ||
+                p1->histogram_decay != p2->histogram_decay;
+}
+
+/*
+  set the scan parameters from a user parameter dictionary, or the
+  defaults for the image size if parm_dict is NULL or None. The
+  colour histogram history is kept unless the new parameters change
+  how it is built
+ */
+static void scanner_state_set_params(struct scanner_state *state, PyObject *parm_dict)
+{
+        struct scan_params old = state->scan_params;
+
+        if (parm_dict != NULL && parm_dict != Py_None) {
+                scale_scan_params_user(&state->scan_params, state->height, state->width, parm_dict);
+        } else {
+                scale_scan_params(&state->scan_params, state->height, state->width);
+        }
+        if (histogram_params_changed(&old, &state->scan_params)) {
+                state->temporal.valid = false;
+        }
+}
+
+/*
+  check that an object is an 8 bit BGR image. The rows may be strided,
+  but the pixels within a row must be packed
+ */
+static bool check_bgr_image(PyObject *obj)
+{
+        PyArrayObject *img = (PyArrayObject *)obj;
+	if (!PyArray_Check(obj) ||
+            PyArray_NDIM(img) != 3 ||
+            PyArray_DIM(img, 2) != 3 ||
+            PyArray_ITEMSIZE(img) != 1 ||
+            PyArray_STRIDE(img, 2) != 1 ||
+            PyArray_STRIDE(img, 1) != 3 ||
+            PyArray_STRIDE(img, 0) < 3*PyArray_DIM(img, 1)) {
+		PyErr_SetString(ScannerError, "input must be BGR");
+		return false;
+	}
+	return true;
+}
+
+/*
+  set the size of an image header and point its rows at data
+ */
+static void bgr_image_set_view(struct bgr_image *img, uint16_t height, uint16_t width,
+                               const void *data, uint32_t stride)
+{
+        img->height = height;
+        img->width = width;
+        bgr_image8_set_data(img, data, stride);
+}
+
+/*
+  point a scanner state at the part of an image to be scanned, given
+  by an optional (x, y, width, height) roi tuple, and an optional
+  exclusion mask of the same size as the image. The image is not
+  copied. Raises an exception and returns false if the arguments are
+  not valid
+ */
+static bool scanner_state_set_image(struct scanner_state *state, PyObject *img_obj,
+                                    PyObject *roi, PyObject *mask_obj)
+{
+        PyArrayObject *img = (PyArrayObject *)img_obj;
+        uint16_t x = 0, y = 0, width = state->width, height = state->height;
+
+        if (!check_bgr_image(img_obj)) {
+                return false;
+        }
+	if (PyArray_DIM(img, 0) != state->height ||
+	    PyArray_DIM(img, 1) != state->width) {
+		PyErr_SetString(ScannerError, "image does not match scanner size");
+		return false;
+	}
+        if (roi != NULL && roi != Py_None) {
+                if (!PyArg_ParseTuple(roi, "HHHH", &x, &y, &width, &height)) {
+                        return false;
+                }
+                if (width == 0 || height == 0 ||
+                    x + width > state->width ||
+                    y + height > state->height) {
+                        PyErr_SetString(ScannerError, "roi outside image");
+                        return false;
+                }
+        }
+        state->mask = NULL;
+        if (mask_obj != NULL && mask_obj != Py_None) {
+                PyArrayObject *mask = (PyArrayObject *)mask_obj;
+                if (!PyArray_Check(mask_obj) ||
+                    PyArray_NDIM(mask) != 2 ||
+                    PyArray_DIM(mask, 0) != state->height ||
+                    PyArray_DIM(mask, 1) != state->width ||
+                    PyArray_ITEMSIZE(mask) != 1 ||
+                    PyArray_STRIDE(mask, 1) != 1 ||
+                    PyArray_STRIDE(mask, 0) < state->width) {
+                        PyErr_SetString(ScannerError, "mask must be an 8 bit array of the image size");
+                        return false;
+                }
+                uint32_t stride = PyArray_STRIDE(mask, 0);
+                state->mask_header->height = height;
+                state->mask_header->width = width;
+                grey_image8_set_data(state->mask_header,
+                                     (const uint8_t *)PyArray_DATA(mask) + y*stride + x,
+                                     stride);
+                state->mask = state->mask_header;
+        }
+
+        uint32_t stride = PyArray_STRIDE(img, 0);
+        state->roi_x = x;
+        state->roi_y = y;
+        bgr_image_set_view(state->in, height, width,
+                           (const uint8_t *)PyArray_DATA(img) + y*stride + 3*x, stride);
+        bgr_image_set_view(state->quantised, height, width,
+                           state->quantised->data[0], 3*width);
+        bgr_image_set_view(state->himage, height, width,
+                           state->himage->data[0], 3*width);
+        state->regions->height = height;
+        state->regions->width = width;
+        return true;
+}
+
+/*
+  keep a copy of an image with the current regions marked on it as an
+  intermediate image
+ */
+static void mark_and_save(const struct scan_params *scan_params,
+                          struct stage_capture *capture,
+                          const struct bgr_image *in, const struct regions *regions,
+                          const char *name)
+{
+        struct bgr_image *marked;
+        uint32_t y;
+        marked = allocate_bgr_image8(in->height, in->width, NULL);
+        if (marked == NULL) {
+                return;
+        }
+        for (y=0; y<marked->height; y++) {
+                memcpy(marked->data[y], in->data[y], marked->width*sizeof(struct bgr));
+        }
+        mark_regions(marked, regions);
+        keep_stage(scan_params, capture, name, marked);
+}
+
+/*
+  find the candidate regions in an image, leaving them unscored. The
+  quantised image, histogram and colour bins are left for scoring
+ */
+static void find_regions(struct scan_params *scan_params,
+                         struct scanner_state *state,
+                         const struct bgr_image *in,
+                         const struct grey_image8 *mask,
+                         uint32_t frame_pixels,
+                         struct bgr *qmin,
+                         struct bgr *qbin_spacing)
+{
+        struct regions *regions = state->regions;
+        struct stage_capture *capture = &state->capture;
+        struct scan_timing *timing = &state->timing;
+        bool stages = stages_wanted(scan_params, capture);
+
+        colour_histogram(scan_params, in, mask, state->himage,
+                         state->quantised, state->histogram,
+                         state->bands, state->threads, frame_pixels,
+                         scan_params->histogram_decay > 0 ? &state->temporal : NULL,
+                         capture, timing, qmin, qbin_spacing);
+        assign_regions(scan_params, state->himage, regions);
+        timing_mark(timing, STAGE_LABEL);
+
+        if (stages) {
+                mark_and_save(scan_params, capture, in, regions, "4regions");
+                timing_skip(timing);
+        }
+
+        prune_large_regions(scan_params, regions);
+        timing_mark(timing, STAGE_PRUNE);
+        if (stages) {
+                mark_and_save(scan_params, capture, in, regions, "5prunelarge");
+                timing_skip(timing);
+        }
+
+        merge_regions(scan_params, regions);
+        timing_mark(timing, STAGE_MERGE);
+        if (stages) {
+                mark_and_save(scan_params, capture, in, regions, "6merged");
+                timing_skip(timing);
+        }
+
+        prune_small_regions(scan_params, regions);
+        timing_mark(timing, STAGE_PRUNE);
+        if (stages) {
+                mark_and_save(scan_params, capture, in, regions, "7pruned");
+                timing_skip(timing);
+        }
+}
+
+/*
+  average the column sums of factor rows of an image in blocks of
+  factor pixels. Inlined for each factor so the loops are unrolled
+ */
+static inline __attribute__((always_inline))
+void downsample_row(const uint16_t *sum, unsigned factor, unsigned shift,
+                    uint32_t width, struct bgr *out)
+{
+	uint32_t x;
+	unsigned i;
+
+	for (x=0; x<width; x++) {
+		const uint16_t *s = &sum[3*factor*x];
+		unsigned b=0, g=0, r=0;
+		for (i=0; i<factor; i++) {
+			b += s[3*i];
+			g += s[3*i+1];
+			r += s[3*i+2];
+		}
+		out[x].b = (b + (1U<<(shift-1))) >> shift;
+		out[x].g = (g + (1U<<(shift-1))) >> shift;
+		out[x].r = (r + (1U<<(shift-1))) >> shift;
+	}
+}
+
+/*
+  downsample an image by 2 or 4, averaging each factor by factor
+  block of pixels. Any part blocks on the right and bottom edges are
+  dropped. sum must have room for the values of one input row
+ */
+static void downsample_image(const struct bgr_image *in, unsigned factor,
+                             struct bgr_image *out, uint16_t *sum)
+{
+	const uint32_t n = 3*factor*out->width;
+	uint32_t i, y;
+	unsigned j;
+
+	for (y=0; y<out->height; y++) {
+		const uint8_t *row = (const uint8_t *)in->data[y*factor];
+		for (i=0; i<n; i++) {
+			sum[i] = row[i];
+		}
+		for (j=1; j<factor; j++) {
+			row = (const uint8_t *)in->data[y*factor+j];
+			for (i=0; i<n; i++) {
+				sum[i] += row[i];
+			}
+		}
+		if (factor == 2) {
+			downsample_row(sum, 2, 2, out->width, out->data[y]);
+		} else {
+			downsample_row(sum, 4, 4, out->width, out->data[y]);
+		}
+	}
+}
+
+/*
+  downsample a mask, excluding each block with any pixel excluded
+ */
+static void downsample_mask(const struct grey_image8 *in, unsigned factor,
+                            struct grey_image8 *out)
+{
+	unsigned x, y, i, j;
+
+	for (y=0; y<out->height; y++) {
+		for (x=0; x<out->width; x++) {
+			uint8_t m = 0;
+			for (j=0; j<factor; j++) {
+				const uint8_t *v = &in->data[y*factor+j][x*factor];
+				for (i=0; i<factor; i++) {
+					m |= v[i];
+				}
+			}
+			out->data[y][x] = m != 0;
+		}
 	}
 }
 
+/*
+  scan parameters for an image downsampled by factor. Averaging
+  shrinks small targets and joins up nearby pieces of larger ones, so
+  the size limits are loosened. All the size limits are checked again
+  at full resolution
+ */
+static void coarse_scan_params(const struct scan_params *scan_params, unsigned factor,
+                               struct scan_params *coarse)
+{
+	unsigned f2 = factor*factor;
+
+	*coarse = *scan_params;
+	coarse->min_region_area = MAX(scan_params->min_region_area / (2*f2), 1);
+	coarse->max_region_area = MAX(2*scan_params->max_region_area / f2, 1);
+	coarse->min_region_size_xy = scan_params->min_region_size_xy / (2*factor);
+	coarse->max_region_size_xy = MAX(2*scan_params->max_region_size_xy / factor, 1);
+	coarse->histogram_count_threshold = MAX(scan_params->histogram_count_threshold / f2, 1);
+	coarse->region_merge = MAX(scan_params->region_merge / factor, 1);
+}
 
 /*
-  mark regions in an image with a blue square
+  make sure the coarse scan buffers are allocated, returning false if
+  they could not be
  */
-static void mark_regions(struct bgr_image *img, const struct regions *r)
+static bool scanner_state_alloc_coarse(struct scanner_state *state)
 {
-	unsigned i;
-	struct bgr c = { 255, 0, 0 };
-	for (i=0; i<r->num_regions; i++) {
-		draw_square(img,
-			    &c,
-			    MAX(r->bounds[i].minx-2, 0),
-			    MAX(r->bounds[i].miny-2, 0),
-			    MIN(r->bounds[i].maxx+2, (img->width)-1),
-			    MIN(r->bounds[i].maxy+2, (img->height)-1));
+        uint16_t height = MAX(state->height/2, 1);
+        uint16_t width = MAX(state->width/2, 1);
+
+        if (state->coarse == NULL) {
+                state->coarse = allocate_bgr_image8(height, width, NULL);
+                count_alloc(&state->allocs, 1, height*width*sizeof(struct bgr));
+        }
+        if (state->coarse_mask == NULL) {
+                state->coarse_mask = allocate_grey_image8(height, width, NULL);
+                count_alloc(&state->allocs, 1, height*width);
+        }
+        if (state->box_mask == NULL) {
+                state->box_mask = allocate_grey_image8_header(state->height, state->width);
+                count_alloc(&state->allocs, 1, sizeof(*state->box_mask));
+        }
+        if (state->row_sum == NULL) {
+                state->row_sum = malloc(3*state->width*sizeof(uint16_t));
+                count_alloc(&state->allocs, 1, 3*state->width*sizeof(uint16_t));
+        }
+        return state->coarse != NULL && state->coarse_mask != NULL &&
+                state->box_mask != NULL && state->row_sum != NULL;
+}
+
+/*
+  take the regions found in an image downsampled by factor back to the
+  full resolution image in state->in. Each region is looked at again
+  in a box one coarse pixel larger all round, using the colour bins
+  and histogram of the coarse scan, and the bounds shrink to the rare
+  pixels in the box. The refined regions are then pruned and merged
+  with the full resolution size limits, as a full resolution scan
+  would, and the rest are scored at full resolution
+ */
+static void refine_regions(const struct scan_params *scan_params,
+                           const struct scan_params *coarse_params,
+                           struct scanner_state *state, unsigned factor,
+                           const struct bgr *qmin, const struct bgr *qbin_spacing)
+{
+        struct regions *regions = state->regions;
+        const struct bgr_image *in = state->in;
+        const struct grey_image8 *mask = state->mask;
+        struct bgr *quantised = state->quantised->data[0];
+        struct bgr *out = state->himage->data[0];
+        uint32_t in_stride = bgr_image_stride(in);
+        unsigned i, n = 0;
+
+        for (i=0; i<regions->num_regions; i++) {
+                const struct region_bounds *b = &regions->bounds[i];
+                struct region_bounds box, rb;
+                uint32_t x, y, w, h, count = 0;
+
+                box.minx = b->minx > 0 ? (b->minx-1)*factor : 0;
+                box.miny = b->miny > 0 ? (b->miny-1)*factor : 0;
+                box.maxx = MIN((b->maxx+2)*factor, in->width) - 1;
+                box.maxy = MIN((b->maxy+2)*factor, in->height) - 1;
+                w = box.maxx - box.minx + 1;
+                h = box.maxy - box.miny + 1;
+
+                kernels->quantise_image(coarse_params, &in->data[box.miny][box.minx], in_stride,
+                                        w, h, quantised, qmin, qbin_spacing);
+                histogram_threshold_neighbours(quantised, w*h, out, state->histogram,
+                                               coarse_params->histogram_count_threshold);
+
+                rb.minx = w;
+                rb.miny = h;
+                rb.maxx = rb.maxy = 0;
+                for (y=0; y<h; y++) {
+                        const struct bgr *v = &out[y*w];
+                        const uint8_t *m = mask ? &mask->data[box.miny+y][box.minx] : NULL;
+                        for (x=0; x<w; x++) {
+                                if (is_zero_bgr(&v[x]) || (m != NULL && m[x])) {
+                                        continue;
+                                }
+                                count++;
+                                rb.minx = MIN(rb.minx, x);
+                                rb.miny = MIN(rb.miny, y);
+                                rb.maxx = MAX(rb.maxx, x);
+                                rb.maxy = MAX(rb.maxy, y);
+                        }
+                }
+                if (count == 0) {
+                        continue;
+                }
+
+                regions->region_size[n] = (1+rb.maxx - rb.minx) * (1+rb.maxy - rb.miny);
+                regions->pixel_count[n] = count;
+                regions->bounds[n].minx = box.minx + rb.minx;
+                regions->bounds[n].miny = box.miny + rb.miny;
+                regions->bounds[n].maxx = box.minx + rb.maxx;
+                regions->bounds[n].maxy = box.miny + rb.maxy;
+                n++;
+        }
+        regions->num_regions = n;
+
+        /*
+          the coarse size limits are loose, so the refined regions
+          get the same checks as those of a full resolution scan
+         */
+        prune_large_regions(scan_params, regions);
+        merge_regions(scan_params, regions);
+        prune_small_regions(scan_params, regions);
+
+        for (i=0; i<regions->num_regions; i++) {
+                const struct region_bounds *b = &regions->bounds[i];
+                struct region_bounds rb;
+                uint32_t w = b->maxx - b->minx + 1;
+                uint32_t h = b->maxy - b->miny + 1;
+
+                kernels->quantise_image(coarse_params, &in->data[b->miny][b->minx], in_stride,
+                                        w, h, quantised, qmin, qbin_spacing);
+                bgr_image_set_view(state->quantised, h, w, quantised, 3*w);
+                if (mask != NULL) {
+                        state->box_mask->height = h;
+                        state->box_mask->width = w;
+                        grey_image8_set_data(state->box_mask, &mask->data[b->miny][b->minx],
+                                             grey_image_stride(mask));
+                }
+                rb.minx = rb.miny = 0;
+                rb.maxx = w - 1;
+                rb.maxy = h - 1;
+                regions->region_score[i] = score_one_region(coarse_params, &rb, state->quantised,
+                                                            mask ? state->box_mask : NULL,
+                                                            state->histogram);
+        }
+        bgr_image_set_view(state->quantised, in->height, in->width, quantised, 3*in->width);
+}
+
+/*
+  find candidate regions in a downsampled copy of the image, then
+  refine and score them at full resolution. This is much faster than
+  a full resolution scan, while still finding targets that are too
+  small to survive scanning the downsampled image alone
+ */
+static void scan_image_pyramid(struct scanner_state *state, unsigned factor)
+{
+        struct scan_params params = state->scan_params;
+        struct scan_params coarse_params;
+        struct bgr qmin, qbin_spacing;
+        struct regions *regions = state->regions;
+        uint16_t width = state->in->width / factor;
+        uint16_t height = state->in->height / factor;
+        const struct grey_image8 *mask = NULL;
+
+        coarse_scan_params(&params, factor, &coarse_params);
+
+        bgr_image_set_view(state->coarse, height, width, state->coarse->data[0], 3*width);
+        downsample_image(state->in, factor, state->coarse, state->row_sum);
+        if (state->mask != NULL) {
+                state->coarse_mask->height = height;
+                state->coarse_mask->width = width;
+                grey_image8_set_data(state->coarse_mask, state->coarse_mask->data[0], width);
+                downsample_mask(state->mask, factor, state->coarse_mask);
+                mask = state->coarse_mask;
+        }
+        timing_mark(&state->timing, STAGE_DOWNSAMPLE);
+
+        bgr_image_set_view(state->quantised, height, width, state->quantised->data[0], 3*width);
+        bgr_image_set_view(state->himage, height, width, state->himage->data[0], 3*width);
+        regions->height = height;
+        regions->width = width;
+
+        find_regions(&coarse_params, state, state->coarse, mask,
+                     (state->width/factor)*(state->height/factor),
+                     &qmin, &qbin_spacing);
+
+        regions->height = state->in->height;
+        regions->width = state->in->width;
+        bgr_image_set_view(state->himage, state->in->height, state->in->width,
+                           state->himage->data[0], 3*state->in->width);
+
+        refine_regions(&params, &coarse_params, state, factor, &qmin, &qbin_spacing);
+        timing_mark(&state->timing, STAGE_REFINE);
+
+        if (stages_wanted(&params, &state->capture)) {
+                mark_and_save(&params, &state->capture, state->in, regions, "8refined");
+        }
+}
+
+/*
+  run the scan pipeline over the image in state->in. This does not
+  touch any python objects, so can be called without the GIL
+ */
+static void scan_image(struct scanner_state *state)
+{
+        struct scan_params params = state->scan_params;
+        unsigned factor = params.pyramid;
+        struct bgr qmin, qbin_spacing;
+
+        timing_start(&state->timing);
+        if (factor > 1 &&
+            state->in->width >= factor && state->in->height >= factor &&
+            scanner_state_alloc_coarse(state)) {
+                scan_image_pyramid(state, factor);
+                return;
+        }
+
+        find_regions(&params, state, state->in, state->mask,
+                     state->width*state->height, &qmin, &qbin_spacing);
+        score_regions(&params, state->regions, state->quantised, state->mask, state->histogram);
+        timing_mark(&state->timing, STAGE_SCORE);
+}
+
+/*
+  layout of one element of the array returned by scan(..., as_array=True)
+ */
+struct PACKED region_record {
+        uint16_t x1, y1, x2, y2;
+        float score;
+        uint32_t pixel_count;
+};
+
+static PyArray_Descr *region_descr;
+
+/*
+  return the scanned regions as a list of (minx,miny,maxx,maxy,score)
+  tuples, offset by the position (x, y) of the scanned area in the image
+ */
+static PyObject *regions_to_list(const struct regions *regions, uint16_t x, uint16_t y)
+{
+	PyObject *list = PyList_New(regions->num_regions);
+	for (unsigned i=0; i<regions->num_regions; i++) {
+		PyObject *t = Py_BuildValue("(iiiif)",
+					    regions->bounds[i].minx + x,
+					    regions->bounds[i].miny + y,
+					    regions->bounds[i].maxx + x,
+					    regions->bounds[i].maxy + y,
+                                            regions->region_score[i]);
+		PyList_SET_ITEM(list, i, t);
 	}
+	return list;
+}
+
+static PyObject *regions_to_array(const struct regions *regions, uint16_t x, uint16_t y)
+{
+        npy_intp dims[1] = { regions->num_regions };
+        Py_INCREF(region_descr);
+        PyArrayObject *ret = (PyArrayObject *)PyArray_NewFromDescr(&PyArray_Type, region_descr,
+                                                                   1, dims, NULL, NULL, 0, NULL);
+        if (ret == NULL) {
+                return NULL;
+        }
+        struct region_record *r = PyArray_DATA(ret);
+	for (unsigned i=0; i<regions->num_regions; i++) {
+                r[i].x1 = regions->bounds[i].minx + x;
+                r[i].y1 = regions->bounds[i].miny + y;
+                r[i].x2 = regions->bounds[i].maxx + x;
+                r[i].y2 = regions->bounds[i].maxy + y;
+                r[i].score = regions->region_score[i];
+                r[i].pixel_count = regions->pixel_count[i];
+        }
+        return (PyObject *)ret;
+}
+
+/*
+  return the regions found by a scan, either as a list of
+  (x1,y1,x2,y2,score) tuples or as a structured numpy array, in the
+  coordinates of the whole image
+ */
+static PyObject *regions_result(const struct scanner_state *state, PyObject *as_array)
+{
+        if (as_array != NULL && PyObject_IsTrue(as_array)) {
+                return regions_to_array(state->regions, state->roi_x, state->roi_y);
+        }
+        return regions_to_list(state->regions, state->roi_x, state->roi_y);
 }
 
+/*
+  score a region of a thermal scan by how far its hot pixels are
+  above the threshold, with 1000 for every pixel at the top of the
+  thermal range
+ */
+static float thermal_score_region(const uint16_t *data, uint16_t width,
+                                  const struct region_bounds *bounds,
+                                  uint16_t threshold)
+{
+        const uint16_t top = (1U<<THERMAL_BITS) - 1;
+        uint64_t excess = 0;
+        uint32_t count = 0;
+
+        for (uint16_t y=bounds->miny; y<=bounds->maxy; y++) {
+                for (uint16_t x=bounds->minx; x<=bounds->maxx; x++) {
+                        uint16_t value = thermal_value(data[y*(uint32_t)width + x]);
+                        if (value < threshold) {
+                                continue;
+                        }
+                        excess += value - threshold;
+                        count++;
+                }
+        }
+        if (count == 0) {
+                return 0;
+        }
+        return 1000.0 * excess / (count * (float)MAX(top - threshold, 1));
+}
 
 /*
-  convert a 16 bit thermal image to a colour image
+  scan a 16 bit thermal image for regions of pixels at or above a
+  threshold, working on the thermal values directly rather than on a
+  colour image from thermal_convert. The regions are sized, merged
+  and pruned using the same parameters as scan()
  */
 static PyObject *
-scanner_thermal_convert(PyObject *self, PyObject *args)
+scanner_thermal_scan(PyObject *self, PyObject *args, PyObject *kwds)
 {
-	PyArrayObject *img_in, *img_out;
-        unsigned short clip_high, clip_low;
-        float blue_threshold, green_threshold;
+        static char *kwlist[] = { "img", "threshold", "params", "as_array", NULL };
+	PyArrayObject *img_in;
+        unsigned short threshold;
+        PyObject *parm_dict = NULL;
+        PyObject *as_array = NULL;
+        struct scan_params scan_params;
 
-	if (!PyArg_ParseTuple(args, "OOHff",
-                              &img_in, &img_out,
-                              &clip_high,
-                              &blue_threshold, &green_threshold))
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "OH|OO", kwlist,
+                                         &img_in, &threshold, &parm_dict, &as_array))
 		return NULL;
 
-	CHECK_CONTIGUOUS(img_in);
-	CHECK_CONTIGUOUS(img_out);
+	if (!PyArray_Check(img_in) ||
+            PyArray_NDIM(img_in) != 2 ||
+            PyArray_ITEMSIZE(img_in) != 2 ||
+            PyArray_STRIDE(img_in, 1) != 2 ||
+            PyArray_STRIDE(img_in, 0) != 2*PyArray_DIM(img_in, 1)) {
+		PyErr_SetString(ScannerError, "input must be a contiguous 16 bit image");
+		return NULL;
+	}
+        if (parm_dict != NULL && parm_dict != Py_None && !PyDict_Check(parm_dict)) {
+		PyErr_SetString(PyExc_TypeError, "params must be a dictionary");
+		return NULL;
+        }
 
         uint16_t height = PyArray_DIM(img_in, 0);
         uint16_t width  = PyArray_DIM(img_in, 1);
-	if (PyArray_STRIDE(img_in, 0) != 2*width) {
-		PyErr_SetString(ScannerError, "input must be 16 bit");
+        const uint16_t *data = PyArray_DATA(img_in);
+
+        if (parm_dict != NULL && parm_dict != Py_None) {
+                scale_scan_params_user(&scan_params, height, width, parm_dict);
+        } else {
+                scale_scan_params(&scan_params, height, width);
+        }
+
+        struct grey_image8 *hot = allocate_grey_image8(height, width, NULL);
+        struct regions *regions = calloc(1, sizeof(struct regions));
+        if (hot == NULL || regions == NULL) {
+                free(hot);
+                free(regions);
+                return PyErr_NoMemory();
+        }
+        regions->height = height;
+        regions->width = width;
+
+	Py_BEGIN_ALLOW_THREADS;
+        uint8_t *h = &hot->data[0][0];
+	for (uint32_t i=0; i<width*(uint32_t)height; i++) {
+                h[i] = thermal_value(data[i]) >= threshold;
+        }
+        assign_regions_grey(&scan_params, hot, regions);
+        prune_large_regions(&scan_params, regions);
+        merge_regions(&scan_params, regions);
+        prune_small_regions(&scan_params, regions);
+        for (unsigned i=0; i<regions->num_regions; i++) {
+                regions->region_score[i] = thermal_score_region(data, width, &regions->bounds[i],
+                                                                threshold);
+        }
+	Py_END_ALLOW_THREADS;
+
+        PyObject *ret;
+        if (as_array != NULL && PyObject_IsTrue(as_array)) {
+                ret = regions_to_array(regions, 0, 0);
+        } else {
+                ret = regions_to_list(regions, 0, 0);
+        }
+        free(hot);
+        regions_free(regions);
+        return ret;
+}
+
+/*
+  scan a BGR image for regions of interest and return the markup as
+  a set of tuples, or as a structured array if as_array is true
+ */
+static PyObject *
+scanner_scan(PyObject *self, PyObject *args, PyObject *kwds)
+{
+        static char *kwlist[] = { "img", "params", "threads", "as_array", "roi", "mask", NULL };
+	PyObject *img_in;
+        PyObject *parm_dict = NULL;
+        unsigned int threads = 1;
+        PyObject *as_array = NULL;
+        PyObject *roi = NULL;
+        PyObject *mask = NULL;
+
+#if SHOW_TIMING
+        start_timer();
+#endif
+
+        scanner_count++;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OIOOO", kwlist,
+                                         &img_in, &parm_dict, &threads, &as_array,
+                                         &roi, &mask))
 		return NULL;
-	}
-	if (PyArray_DIM(img_out, 1) != width ||
-	    PyArray_DIM(img_out, 0) != height ||
-	    PyArray_STRIDE(img_out, 0) != 3*width) {
-		PyErr_SetString(ScannerError, "output must be same shape as input and 24 bit");
+
+        if (!check_bgr_image(img_in)) {
 		return NULL;
 	}
+        uint16_t height = PyArray_DIM((PyArrayObject *)img_in, 0);
+        uint16_t width  = PyArray_DIM((PyArrayObject *)img_in, 1);
 
-        const uint16_t *data = PyArray_DATA(img_in);
-        struct bgr *rgb = PyArray_DATA(img_out);
-        uint16_t mask = 0, minv = 0xFFFF, maxv = 0;
-	Py_BEGIN_ALLOW_THREADS;
+        struct scanner_state *state = scanner_state_alloc(height, width);
+        if (state == NULL) {
+                return PyErr_NoMemory();
+        }
+        scanner_state_set_params(state, parm_dict);
+        state->threads = MAX(1, MIN(threads, MAX_SCAN_THREADS));
+        if (!scanner_state_set_image(state, img_in, roi, mask)) {
+                scanner_state_free(state);
+                return NULL;
+        }
 
-	for (uint32_t i=0; i<width*height; i++) {
-            uint16_t value = data[i];
-            if (__BYTE_ORDER == __LITTLE_ENDIAN) {
-                swab(&value, &value, 2);
-            }
-            value >>= 2;
-            mask |= value;
-            if (value > maxv) maxv = value;
-            if (value < minv) minv = value;
+    Py_BEGIN_ALLOW_THREADS;
+        scan_image(state);
+    Py_END_ALLOW_THREADS;
+
+	PyObject *ret = regions_result(state, as_array);
+
+        scanner_state_free(state);
+
+#if SHOW_TIMING
+        printf("dt=%f\n", end_timer());
+#endif
+
+	return ret;
+}
+
+
+/*
+  a Scanner object holds a scanner_state for repeated scans of
+  images of the same size with the same parameters
+ */
+typedef struct {
+        PyObject_HEAD
+        struct scanner_state *state;
+        bool busy;
+        // number of recent scans to keep the intermediate images of,
+        // and a list of dicts of those images, oldest first
+        unsigned capture;
+        PyObject *captures;
+} ScannerObject;
+
+static void
+Scanner_dealloc(ScannerObject *self)
+{
+        scanner_state_free(self->state);
+        Py_XDECREF(self->captures);
+        Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static int
+Scanner_init(ScannerObject *self, PyObject *args, PyObject *kwds)
+{
+        static char *kwlist[] = { "width", "height", "params", "threads", NULL };
+        unsigned short width, height;
+        PyObject *parm_dict = NULL;
+        unsigned int threads = 1;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "HH|OI", kwlist,
+                                         &width, &height, &parm_dict, &threads))
+		return -1;
+        if (width == 0 || height == 0) {
+		PyErr_SetString(ScannerError, "invalid image size");
+		return -1;
+        }
+        if (parm_dict != NULL && parm_dict != Py_None && !PyDict_Check(parm_dict)) {
+		PyErr_SetString(PyExc_TypeError, "params must be a dictionary");
+		return -1;
         }
 
-        clip_low = minv + (clip_high-minv)/10;
+        scanner_state_free(self->state);
+        self->state = scanner_state_alloc(height, width);
+        if (self->state == NULL) {
+                PyErr_NoMemory();
+                return -1;
+        }
+        scanner_state_set_params(self->state, parm_dict);
+        self->state->threads = MAX(1, MIN(threads, MAX_SCAN_THREADS));
+        return 0;
+}
 
-	for (uint32_t i=0; i<width*height; i++) {
-            uint16_t value = data[i];
-            if (__BYTE_ORDER == __LITTLE_ENDIAN) {
-                swab(&value, &value, 2);
-            }
-            value >>= 2;
-            uint8_t map_value(float v, const float threshold) {
-                if (v > threshold) {
-                    float p = 1.0 - (v - threshold) / (1.0 - threshold);
-                    return 255*p;
+static void capture_image_free(PyObject *capsule)
+{
+        free(PyCapsule_GetPointer(capsule, NULL));
+}
+
+/*
+  return a numpy array which owns the pixels of a captured image
+ */
+static PyObject *capture_image_array(struct bgr_image *img)
+{
+        npy_intp dims[3] = { img->height, img->width, 3 };
+        PyObject *capsule = PyCapsule_New(img, NULL, capture_image_free);
+        if (capsule == NULL) {
+                free(img);
+                return NULL;
+        }
+        PyObject *arr = PyArray_SimpleNewFromData(3, dims, NPY_UINT8, &img->data[0][0]);
+        if (arr == NULL) {
+                Py_DECREF(capsule);
+                return NULL;
+        }
+        if (PyArray_SetBaseObject((PyArrayObject *)arr, capsule) != 0) {
+                Py_DECREF(arr);
+                return NULL;
+        }
+        return arr;
+}
+
+/*
+  add the intermediate images of the last scan to the ring of
+  captured scans as a dict of arrays, dropping the oldest scans
+ */
+static bool Scanner_keep_capture(ScannerObject *self)
+{
+        struct stage_capture *capture = &self->state->capture;
+        PyObject *stages = PyDict_New();
+        unsigned i;
+
+        for (i=0; i<capture->num_stages; i++) {
+                struct bgr_image *img = capture->image[i];
+                if (stages == NULL) {
+                        free(img);
+                        continue;
                 }
-                float p = 1.0 - (threshold - v) / threshold;
-                return 255*p;
-            }
-            float v = 0;
-            if (value >= clip_high) {
-                v = 1.0;
-            } else if (value > clip_low) {
-                v = (value - clip_low) / (float)(clip_high - clip_low);
-            }
-            rgb[i].r = v*255;
-            rgb[i].b = map_value(v, blue_threshold);
-            rgb[i].g = map_value(v, green_threshold);
-	}
-	Py_END_ALLOW_THREADS;
-	Py_RETURN_NONE;
+                PyObject *arr = capture_image_array(img);
+                if (arr == NULL) {
+                        Py_CLEAR(stages);
+                        continue;
+                }
+                if (PyDict_SetItemString(stages, capture->name[i], arr) != 0) {
+                        Py_CLEAR(stages);
+                }
+                Py_DECREF(arr);
+        }
+        capture->num_stages = 0;
+        if (stages == NULL) {
+                return false;
+        }
+
+        if (self->captures == NULL) {
+                self->captures = PyList_New(0);
+        }
+        if (self->captures == NULL || PyList_Append(self->captures, stages) != 0) {
+                Py_DECREF(stages);
+                return false;
+        }
+        Py_DECREF(stages);
+        Py_ssize_t n = PyList_Size(self->captures);
+        if (n > (Py_ssize_t)self->capture &&
+            PySequence_DelSlice(self->captures, 0, n - self->capture) != 0) {
+                return false;
+        }
+        return true;
+}
+
+/*
+  scan one BGR image using the Scanner buffers
+ */
+static PyObject *
+Scanner_scan(ScannerObject *self, PyObject *args, PyObject *kwds)
+{
+        static char *kwlist[] = { "img", "as_array", "roi", "mask", NULL };
+	PyObject *img_in;
+        PyObject *as_array = NULL;
+        PyObject *roi = NULL;
+        PyObject *mask = NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOO", kwlist,
+                                         &img_in, &as_array, &roi, &mask))
+		return NULL;
+
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return NULL;
+        }
+        if (self->busy) {
+		PyErr_SetString(ScannerError, "scanner already in use");
+		return NULL;
+        }
+        struct scanner_state *state = self->state;
+        if (!scanner_state_set_image(state, img_in, roi, mask)) {
+                return NULL;
+        }
+
+        scanner_count++;
+
+        state->capture.enabled = self->capture > 0;
+
+        self->busy = true;
+    Py_BEGIN_ALLOW_THREADS;
+        scan_image(state);
+    Py_END_ALLOW_THREADS;
+        self->busy = false;
+
+        if (state->capture.enabled && !Scanner_keep_capture(self)) {
+                return NULL;
+        }
+	return regions_result(state, as_array);
+}
+
+/*
+  return the intermediate images of a recent scan as a dict of arrays.
+  age is the number of scans back, with 0 for the most recent
+ */
+static PyObject *
+Scanner_intermediates(ScannerObject *self, PyObject *args)
+{
+        int age = 0;
+
+	if (!PyArg_ParseTuple(args, "|i", &age))
+		return NULL;
+
+        Py_ssize_t n = self->captures ? PyList_Size(self->captures) : 0;
+        if (age < 0 || age >= n) {
+		PyErr_SetString(ScannerError, "scan not captured");
+		return NULL;
+        }
+        PyObject *stages = PyList_GetItem(self->captures, n - 1 - age);
+        Py_INCREF(stages);
+        return stages;
 }
 
 /*
-  scale the scan parameters for the image being scanned
+  return the seconds spent in each stage of the last scan as a dict
  */
-static void scale_scan_params(struct scan_params *scan_params, uint32_t height, uint32_t width)
+static PyObject *
+Scanner_timings(ScannerObject *self, PyObject *args)
 {
-    float wscale = width/640.0;
-    float ascale = (width*height)/(640.0*480.0);
-    if (ascale < 1.0) ascale = 1.0;
-    if (wscale < 1.0) wscale = 1.0;
-    *scan_params = scan_params_640_480;
-    scan_params->min_region_area *= ascale;
-    scan_params->max_region_area *= ascale;
-    scan_params->min_region_size_xy *= wscale;
-    scan_params->max_region_size_xy *= wscale;
-    scan_params->histogram_count_threshold *= ascale;
-    scan_params->region_merge *= wscale;
+        PyObject *ret;
+        unsigned i;
+
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return NULL;
+        }
+        ret = PyDict_New();
+        if (ret == NULL) {
+                return NULL;
+        }
+        for (i=0; i<NUM_SCAN_STAGES; i++) {
+                PyObject *v = PyFloat_FromDouble(self->state->timing.seconds[i]);
+                if (v == NULL || PyDict_SetItemString(ret, scan_stage_names[i], v) != 0) {
+                        Py_XDECREF(v);
+                        Py_DECREF(ret);
+                        return NULL;
+                }
+                Py_DECREF(v);
+        }
+        return ret;
 }
 
 /*
-  lookup a key in a dictionary and return value as a float, or
-  default_value if not found
+  return the number and total bytes of the buffers allocated by scans
+  since the scanner was created. A scanner which has seen its largest
+  scan allocates nothing more
  */
-static float dict_lookup(PyObject *parm_dict, const char *key, float default_value)
+static PyObject *
+Scanner_allocations(ScannerObject *self, PyObject *args)
 {
-    PyObject *obj = PyDict_GetItemString(parm_dict, key);
-    if (obj == NULL || !PyFloat_Check(obj)) {
-        return default_value;
-    }
-    return PyFloat_AsDouble(obj);
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return NULL;
+        }
+        return Py_BuildValue("{s:K,s:K}",
+                             "count", (unsigned long long)self->state->allocs.count,
+                             "bytes", (unsigned long long)self->state->allocs.bytes);
 }
 
 /*
-  scale the scan parameters for the image being scanned
+  forget the colour histogram of earlier frames
  */
-static void scale_scan_params_user(struct scan_params *scan_params, uint32_t height, uint32_t width, PyObject *parm_dict)
+static PyObject *
+Scanner_reset_history(ScannerObject *self, PyObject *args)
 {
-    float meters_per_pixel = dict_lookup(parm_dict, "MetersPerPixel", 0.1);
-    float meters_per_pixel2 = meters_per_pixel * meters_per_pixel;
-    *scan_params = scan_params_640_480;
-    scan_params->min_region_area = MAX(dict_lookup(parm_dict, "MinRegionArea", 1.0) / meters_per_pixel2, 1);
-    scan_params->max_region_area = MAX(dict_lookup(parm_dict, "MaxRegionArea", 4.0) / meters_per_pixel2, 1);
-    scan_params->min_region_size_xy = MAX(dict_lookup(parm_dict, "MinRegionSize", 0.25) / meters_per_pixel, 1);
-    scan_params->max_region_size_xy = MAX(dict_lookup(parm_dict, "MaxRegionSize", 4.0) / meters_per_pixel, 1);
-    scan_params->histogram_count_threshold = MAX(dict_lookup(parm_dict, "MaxRarityPct", 0.016) * (width*height)/100.0, 1);
-    scan_params->region_merge = MAX(dict_lookup(parm_dict, "RegionMergeSize", 0.5) / meters_per_pixel, 1);
-    scan_params->save_intermediate = dict_lookup(parm_dict, "SaveIntermediate", 0);
-    scan_params->blue_emphasis = dict_lookup(parm_dict, "BlueEmphasis", 0);
-    if (scan_params->save_intermediate) {
-        printf("mpp=%f mpp2=%f min_region_area=%u max_region_area=%u min_region_size_xy=%u max_region_size_xy=%u histogram_count_threshold=%u region_merge=%u\n",
-               meters_per_pixel,
-               meters_per_pixel2,
-               scan_params->min_region_area,
-               scan_params->max_region_area,
-               scan_params->min_region_size_xy,
-               scan_params->max_region_size_xy,
-               scan_params->histogram_count_threshold,
-               scan_params->region_merge);
-    }
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return NULL;
+        }
+        if (self->busy) {
+		PyErr_SetString(ScannerError, "scanner already in use");
+		return NULL;
+        }
+        self->state->temporal.valid = false;
+	Py_RETURN_NONE;
 }
 
 /*
-  scan a BGR image for regions of interest and return the markup as
-  a set of tuples
+  change the scan parameters
  */
 static PyObject *
-scanner_scan(PyObject *self, PyObject *args)
+Scanner_update_params(ScannerObject *self, PyObject *args)
 {
-	PyArrayObject *img_in;
         PyObject *parm_dict = NULL;
 
-#if SHOW_TIMING
-        start_timer();
-#endif
-
-        scanner_count++;
-
-	if (!PyArg_ParseTuple(args, "O|O", &img_in, &parm_dict))
+	if (!PyArg_ParseTuple(args, "O", &parm_dict))
 		return NULL;
 
-	CHECK_CONTIGUOUS(img_in);
-
-        uint16_t height = PyArray_DIM(img_in, 0);
-        uint16_t width  = PyArray_DIM(img_in, 1);
-	if (PyArray_STRIDE(img_in, 0) != 3*width) {
-		PyErr_SetString(ScannerError, "input must be BGR");
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return NULL;
+        }
+        if (self->busy) {
+		PyErr_SetString(ScannerError, "scanner already in use");
+		return NULL;
+        }
+        if (parm_dict != Py_None && !PyDict_Check(parm_dict)) {
+		PyErr_SetString(PyExc_TypeError, "params must be a dictionary");
 		return NULL;
-	}
-
-       const struct bgr_image *in = allocate_bgr_image8(height, width, PyArray_DATA(img_in));
-
-
- 	struct regions *regions = any_matrix(2,
-                                             sizeof(int16_t),
-                                             offsetof(struct regions, data),
-                                             height,
-                                             width);
-
-        /*
-          we need to allocate the histogram and quantised structures
-          here and pass them into colour_histogram() so that they can
-          be kept around for the score_regions() code.
-         */
-        struct histogram *histogram;
-        struct bgr_image *quantised;
-        struct scan_params scan_params;
-
-        quantised = allocate_bgr_image8(height, width, NULL);
-        ALLOCATE(histogram);
-
-        if (parm_dict != NULL) {
-            scale_scan_params_user(&scan_params, height, width, parm_dict);
-        } else {
-            scale_scan_params(&scan_params, height, width);
         }
+        scanner_state_set_params(self->state, parm_dict);
+	Py_RETURN_NONE;
+}
 
-    Py_BEGIN_ALLOW_THREADS;
+static PyObject *
+Scanner_get_width(ScannerObject *self, void *closure)
+{
+        return Py_BuildValue("i", self->state ? self->state->width : 0);
+}
 
-        struct bgr_image *himage = allocate_bgr_image8(height, width, NULL);
-        struct bgr_image *jimage = allocate_bgr_image8(height, width, NULL);
-        regions->height = height;
-        regions->width = width;
+static PyObject *
+Scanner_get_height(ScannerObject *self, void *closure)
+{
+        return Py_BuildValue("i", self->state ? self->state->height : 0);
+}
 
-        colour_histogram(&scan_params, in, himage, quantised, histogram);
-        assign_regions(&scan_params, himage, regions);
+static PyObject *
+Scanner_get_threads(ScannerObject *self, void *closure)
+{
+        return Py_BuildValue("i", self->state ? self->state->threads : 1);
+}
 
-        if (scan_params.save_intermediate) {
-                struct bgr_image *marked;
-                marked = allocate_bgr_image8(height, width, NULL);
-                copy_bgr_image8(in, marked);
-                mark_regions(marked, regions);
-                colour_save_pnm("4regions.pnm", marked);
-                free(marked);
+static int
+Scanner_set_threads(ScannerObject *self, PyObject *value, void *closure)
+{
+        long threads;
+        if (value == NULL) {
+		PyErr_SetString(PyExc_TypeError, "cannot delete threads");
+		return -1;
         }
-
-        prune_large_regions(&scan_params, regions);
-        if (scan_params.save_intermediate) {
-                struct bgr_image *marked;
-                marked = allocate_bgr_image8(height, width, NULL);
-                copy_bgr_image8(in, marked);
-                mark_regions(marked, regions);
-                colour_save_pnm("5prunelarge.pnm", marked);
-                free(marked);
+        threads = PyLong_AsLong(value);
+        if (threads == -1 && PyErr_Occurred()) {
+		return -1;
         }
-
-        merge_regions(&scan_params, regions);
-        if (scan_params.save_intermediate) {
-                struct bgr_image *marked;
-                marked = allocate_bgr_image8(height, width, NULL);
-                copy_bgr_image8(in, marked);
-                mark_regions(marked, regions);
-                colour_save_pnm("6merged.pnm", marked);
-                free(marked);
+        if (self->state == NULL) {
+		PyErr_SetString(ScannerError, "scanner not initialised");
+		return -1;
         }
-
-        prune_small_regions(&scan_params, regions);
-        if (scan_params.save_intermediate) {
-                struct bgr_image *marked;
-                marked = allocate_bgr_image8(height, width, NULL);
-                copy_bgr_image8(in, marked);
-                mark_regions(marked, regions);
-                colour_save_pnm("7pruned.pnm", marked);
-                free(marked);
+        if (self->busy) {
+		PyErr_SetString(ScannerError, "scanner already in use");
+		return -1;
         }
+        self->state->threads = MAX(1, MIN(threads, MAX_SCAN_THREADS));
+        return 0;
+}
 
-        free(himage);
-        free(jimage);
-
-    Py_END_ALLOW_THREADS;
-
-    score_regions(&scan_params, regions, quantised, histogram);
-
-    free(histogram);
-    free(quantised);
-    free((void*)in);
+static PyObject *
+Scanner_get_capture(ScannerObject *self, void *closure)
+{
+        return Py_BuildValue("I", self->capture);
+}
 
-	PyObject *list = PyList_New(regions->num_regions);
-	for (unsigned i=0; i<regions->num_regions; i++) {
-		PyObject *t = Py_BuildValue("(iiiif)",
-					    regions->bounds[i].minx,
-					    regions->bounds[i].miny,
-					    regions->bounds[i].maxx,
-					    regions->bounds[i].maxy,
-                                            regions->region_score[i]);
-		PyList_SET_ITEM(list, i, t);
-	}
+static int
+Scanner_set_capture(ScannerObject *self, PyObject *value, void *closure)
+{
+        long capture;
+        if (value == NULL) {
+		PyErr_SetString(PyExc_TypeError, "cannot delete capture");
+		return -1;
+        }
+        capture = PyLong_AsLong(value);
+        if (capture == -1 && PyErr_Occurred()) {
+		return -1;
+        }
+        if (capture < 0) {
+		PyErr_SetString(PyExc_ValueError, "capture must not be negative");
+		return -1;
+        }
+        if (self->busy) {
+		PyErr_SetString(ScannerError, "scanner already in use");
+		return -1;
+        }
+        self->capture = capture;
+        if (self->captures != NULL && PyList_Size(self->captures) > capture &&
+            PySequence_DelSlice(self->captures, 0, PyList_Size(self->captures) - capture) != 0) {
+		return -1;
+        }
+        return 0;
+}
 
-	free(regions);
+static PyMethodDef Scanner_methods[] = {
+	{"scan", (PyCFunction)Scanner_scan, METH_VARARGS | METH_KEYWORDS, "histogram scan a colour image"},
+	{"update_params", (PyCFunction)Scanner_update_params, METH_VARARGS, "set new scan parameters"},
+	{"reset_history", (PyCFunction)Scanner_reset_history, METH_NOARGS, "forget the colour histogram of earlier frames"},
+	{"intermediates", (PyCFunction)Scanner_intermediates, METH_VARARGS, "intermediate images of a recent scan"},
+	{"timings", (PyCFunction)Scanner_timings, METH_NOARGS, "seconds spent in each stage of the last scan"},
+	{"allocations", (PyCFunction)Scanner_allocations, METH_NOARGS, "buffers allocated by scans"},
+	{NULL, NULL, 0, NULL}
+};
 
-#if SHOW_TIMING
-        printf("dt=%f\n", end_timer());
-#endif
+static PyGetSetDef Scanner_getset[] = {
+        {"width", (getter)Scanner_get_width, NULL, "image width", NULL},
+        {"height", (getter)Scanner_get_height, NULL, "image height", NULL},
+        {"threads", (getter)Scanner_get_threads, (setter)Scanner_set_threads,
+         "number of threads for the histogram stages", NULL},
+        {"capture", (getter)Scanner_get_capture, (setter)Scanner_set_capture,
+         "number of recent scans to keep the intermediate images of", NULL},
+        {NULL}
+};
 
-	return list;
-}
+static PyTypeObject ScannerType = {
+        PyVarObject_HEAD_INIT(NULL, 0)
+        "scanner.Scanner",              /* tp_name */
+        sizeof(ScannerObject),          /* tp_basicsize */
+        0,                              /* tp_itemsize */
+        (destructor)Scanner_dealloc,    /* tp_dealloc */
+        0,                              /* tp_print */
+        0,                              /* tp_getattr */
+        0,                              /* tp_setattr */
+        0,                              /* tp_compare */
+        0,                              /* tp_repr */
+        0,                              /* tp_as_number */
+        0,                              /* tp_as_sequence */
+        0,                              /* tp_as_mapping */
+        0,                              /* tp_hash */
+        0,                              /* tp_call */
+        0,                              /* tp_str */
+        0,                              /* tp_getattro */
+        0,                              /* tp_setattro */
+        0,                              /* tp_as_buffer */
+        Py_TPFLAGS_DEFAULT,             /* tp_flags */
+        "Scanner(width, height, params=None, threads=1): re-usable image scanner", /* tp_doc */
+        0,                              /* tp_traverse */
+        0,                              /* tp_clear */
+        0,                              /* tp_richcompare */
+        0,                              /* tp_weaklistoffset */
+        0,                              /* tp_iter */
+        0,                              /* tp_iternext */
+        Scanner_methods,                /* tp_methods */
+        0,                              /* tp_members */
+        Scanner_getset,                 /* tp_getset */
+        0,                              /* tp_base */
+        0,                              /* tp_dict */
+        0,                              /* tp_descr_get */
+        0,                              /* tp_descr_set */
+        0,                              /* tp_dictoffset */
+        (initproc)Scanner_init,         /* tp_init */
+        0,                              /* tp_alloc */
+        PyType_GenericNew,              /* tp_new */
+};
 
 
 /*
@@ -1192,10 +3957,285 @@ scanner_rect_extract(PyObject *self, PyObject *args)
 }
 
 
+/*
+  one column or row of a thumbnail: the two source pixels it is
+  interpolated from, or -1 for a pixel past the image edge, and the
+  weight of the second
+ */
+struct thumb_tap {
+        int32_t p0, p1;
+        uint32_t w1;
+};
+
+// interpolation weights are fixed point with this many fraction bits
+#define THUMB_WEIGHT_BITS 11
+#define THUMB_WEIGHT_ONE (1U<<THUMB_WEIGHT_BITS)
+
+/*
+  work out the source taps for a thumbnail of size pixels taken from
+  a rectangle starting at ofs and len pixels long, on an image axis
+  limit pixels long. This uses the same pixel centre mapping as
+  cv2.resize() with INTER_LINEAR
+ */
+static void thumb_taps(struct thumb_tap *taps, uint32_t size,
+                       int32_t ofs, int32_t len, int32_t limit)
+{
+        float scale = len / (float)size;
+        uint32_t i;
+
+        for (i=0; i<size; i++) {
+                int32_t s0, s1;
+                float f = 0;
+                if (len == (int32_t)size) {
+                        s0 = s1 = i;
+                } else {
+                        float fs = (i + 0.5f) * scale - 0.5f;
+                        s0 = (int32_t)floorf(fs);
+                        f = fs - s0;
+                        if (s0 < 0) {
+                                s0 = 0;
+                                f = 0;
+                        }
+                        if (s0 >= len-1) {
+                                s0 = len-1;
+                                f = 0;
+                        }
+                        s1 = f > 0 ? s0+1 : s0;
+                }
+                s0 += ofs;
+                s1 += ofs;
+                taps[i].p0 = (s0 >= 0 && s0 < limit) ? s0 : -1;
+                taps[i].p1 = (s1 >= 0 && s1 < limit) ? s1 : -1;
+                taps[i].w1 = (uint32_t)(f * THUMB_WEIGHT_ONE + 0.5f);
+        }
+}
+
+static const struct bgr thumb_black;
+
+static inline const struct bgr *thumb_pixel(const struct bgr *row, int32_t x)
+{
+        if (row == NULL || x < 0) {
+                return &thumb_black;
+        }
+        return &row[x];
+}
+
+static inline uint8_t thumb_blend(uint32_t p00, uint32_t p01, uint32_t p10, uint32_t p11,
+                                  uint32_t wx, uint32_t wy)
+{
+        uint32_t top = p00 * (THUMB_WEIGHT_ONE - wx) + p01 * wx;
+        uint32_t bottom = p10 * (THUMB_WEIGHT_ONE - wx) + p11 * wx;
+        return (top * (THUMB_WEIGHT_ONE - wy) + bottom * wy +
+                (1U<<(2*THUMB_WEIGHT_BITS-1))) >> (2*THUMB_WEIGHT_BITS);
+}
+
+/*
+  fill one thumbnail from a rectangle of a 24 bit BGR image,
+  resizing the rectangle to the thumbnail size if needed. Pixels of
+  the rectangle past the edge of the image are black
+ */
+static void thumb_fill(const struct bgr *in, uint16_t width, uint16_t height,
+                       const int32_t rect[4], struct bgr *out, uint32_t size,
+                       struct thumb_tap *xtaps, struct thumb_tap *ytaps)
+{
+        const int32_t rx = rect[0], ry = rect[1], rw = rect[2], rh = rect[3];
+        uint32_t x, y;
+
+        if (rw <= 0 || rh <= 0) {
+                memset(out, 0, size*size*sizeof(struct bgr));
+                return;
+        }
+
+        if (rw == (int32_t)size && rh == (int32_t)size) {
+                // straight copy, clamped to the image
+                int32_t x1 = MAX(rx, 0);
+                int32_t x2 = MIN(rx + rw, (int32_t)width);
+                for (y=0; y<size; y++) {
+                        struct bgr *out_y = out + y*size;
+                        int32_t sy = ry + (int32_t)y;
+                        if (sy < 0 || sy >= height || x1 >= x2) {
+                                memset(out_y, 0, size*sizeof(struct bgr));
+                                continue;
+                        }
+                        memset(out_y, 0, (x1-rx)*sizeof(struct bgr));
+                        memcpy(out_y + (x1-rx), in + sy*(uint32_t)width + x1,
+                               (x2-x1)*sizeof(struct bgr));
+                        memset(out_y + (x2-rx), 0, (rx+rw-x2)*sizeof(struct bgr));
+                }
+                return;
+        }
+
+        thumb_taps(xtaps, size, rx, rw, width);
+        thumb_taps(ytaps, size, ry, rh, height);
+        for (y=0; y<size; y++) {
+                const struct thumb_tap *ty = &ytaps[y];
+                const struct bgr *row0 = ty->p0 < 0 ? NULL : in + ty->p0*(uint32_t)width;
+                const struct bgr *row1 = ty->p1 < 0 ? NULL : in + ty->p1*(uint32_t)width;
+                struct bgr *out_y = out + y*size;
+                for (x=0; x<size; x++) {
+                        const struct thumb_tap *tx = &xtaps[x];
+                        const struct bgr *p00 = thumb_pixel(row0, tx->p0);
+                        const struct bgr *p01 = thumb_pixel(row0, tx->p1);
+                        const struct bgr *p10 = thumb_pixel(row1, tx->p0);
+                        const struct bgr *p11 = thumb_pixel(row1, tx->p1);
+                        out_y[x].b = thumb_blend(p00->b, p01->b, p10->b, p11->b, tx->w1, ty->w1);
+                        out_y[x].g = thumb_blend(p00->g, p01->g, p10->g, p11->g, tx->w1, ty->w1);
+                        out_y[x].r = thumb_blend(p00->r, p01->r, p10->r, p11->r, tx->w1, ty->w1);
+                }
+        }
+}
+
+/*
+  extract many square thumbnails from a 24 bit BGR image in one call
+  img is a 24 bit image
+  rects is a Nx4 array of (x, y, width, height) source rectangles,
+  which may run past the edges of the image
+  thumb_size is the width and height of each thumbnail
+
+  returns a N x thumb_size x thumb_size x 3 array. Rectangles which
+  are not thumb_size square are resized to fit
+ */
+static PyObject *
+scanner_rect_extract_many(PyObject *self, PyObject *args)
+{
+	PyArrayObject *img_in;
+        PyObject *rects_in;
+        unsigned short thumb_size;
+
+	if (!PyArg_ParseTuple(args, "OOH", &img_in, &rects_in, &thumb_size))
+		return NULL;
+
+	if (!PyArray_Check(img_in) ||
+            PyArray_NDIM(img_in) != 3 ||
+            PyArray_DIM(img_in, 2) != 3 ||
+            PyArray_ITEMSIZE(img_in) != 1) {
+		PyErr_SetString(ScannerError, "input must be 24 bit");
+		return NULL;
+	}
+	CHECK_CONTIGUOUS(img_in);
+        if (thumb_size == 0) {
+		PyErr_SetString(ScannerError, "thumb_size must be positive");
+		return NULL;
+        }
+
+        PyArrayObject *rects = (PyArrayObject *)PyArray_FROM_OTF(rects_in, NPY_INT32,
+                                                                 NPY_ARRAY_IN_ARRAY);
+        if (rects == NULL) {
+                return NULL;
+        }
+        npy_intp n = PyArray_SIZE(rects) / 4;
+        if (PyArray_SIZE(rects) != 0 &&
+            (PyArray_NDIM(rects) != 2 || PyArray_DIM(rects, 1) != 4)) {
+                Py_DECREF(rects);
+		PyErr_SetString(ScannerError, "rects must be a Nx4 array");
+		return NULL;
+        }
+
+        npy_intp dims[4] = { n, thumb_size, thumb_size, 3 };
+        PyObject *ret = PyArray_SimpleNew(4, dims, NPY_UINT8);
+        struct thumb_tap *taps = malloc(2*thumb_size*sizeof(struct thumb_tap));
+        if (ret == NULL || taps == NULL) {
+                Py_DECREF(rects);
+                Py_XDECREF(ret);
+                free(taps);
+                return PyErr_NoMemory();
+        }
+
+        uint16_t width = PyArray_DIM(img_in, 1);
+        uint16_t height = PyArray_DIM(img_in, 0);
+	const struct bgr *in = PyArray_DATA(img_in);
+        const int32_t *r = PyArray_DATA(rects);
+        struct bgr *out = PyArray_DATA((PyArrayObject *)ret);
+        npy_intp i;
+
+	Py_BEGIN_ALLOW_THREADS;
+        for (i=0; i<n; i++) {
+                thumb_fill(in, width, height, &r[4*i],
+                           out + i*thumb_size*thumb_size, thumb_size,
+                           taps, taps + thumb_size);
+        }
+	Py_END_ALLOW_THREADS;
+
+        free(taps);
+        Py_DECREF(rects);
+        return ret;
+}
+
+
+/*
+  return the name of the kernels in use for the colour histogram stages
+ */
+static PyObject *
+scanner_get_simd(PyObject *self, PyObject *args)
+{
+	return Py_BuildValue("s", kernels->name);
+}
+
+/*
+  choose the kernels for the colour histogram stages by name
+ */
+static PyObject *
+scanner_set_simd(PyObject *self, PyObject *args)
+{
+	const struct scan_kernels *k[3];
+	const char *name;
+	unsigned i, n;
+
+	if (!PyArg_ParseTuple(args, "s", &name))
+		return NULL;
+
+	n = supported_kernels(k);
+	for (i=0; i<n; i++) {
+		if (strcmp(k[i]->name, name) == 0) {
+			kernels = k[i];
+			Py_RETURN_NONE;
+		}
+	}
+	PyErr_SetString(ScannerError, "kernels not supported on this CPU");
+	return NULL;
+}
+
+/*
+  check all the kernels supported by this CPU against the scalar
+  kernels, returning a list of their names
+ */
+static PyObject *
+scanner_simd_selftest(PyObject *self, PyObject *args)
+{
+	const struct scan_kernels *k[3];
+	unsigned i, n;
+	bool ok = true;
+
+	n = supported_kernels(k);
+	Py_BEGIN_ALLOW_THREADS;
+	for (i=0; i<n; i++) {
+		if (!kernels_selftest(k[i])) {
+			ok = false;
+			break;
+		}
+	}
+	Py_END_ALLOW_THREADS;
+	if (!ok) {
+		PyErr_Format(ScannerError, "%s kernels failed self test", k[i]->name);
+		return NULL;
+	}
+
+	PyObject *list = PyList_New(n);
+	for (i=0; i<n; i++) {
+		PyList_SET_ITEM(list, i, Py_BuildValue("s", k[i]->name));
+	}
+	return list;
+}
+
 static PyMethodDef ScannerMethods[] = {
-	{"scan", scanner_scan, METH_VARARGS, "histogram scan a colour image"},
+	{"scan", (PyCFunction)scanner_scan, METH_VARARGS | METH_KEYWORDS, "histogram scan a colour image"},
 	{"rect_extract", scanner_rect_extract, METH_VARARGS, "extract a rectange from a 24 bit BGR image"},
+	{"rect_extract_many", scanner_rect_extract_many, METH_VARARGS, "extract many square thumbnails from a 24 bit BGR image"},
 	{"thermal_convert", scanner_thermal_convert, METH_VARARGS, "convert 16 bit thermal image to colour"},
+	{"thermal_scan", (PyCFunction)scanner_thermal_scan, METH_VARARGS | METH_KEYWORDS, "scan a 16 bit thermal image for hot regions"},
+	{"get_simd", scanner_get_simd, METH_NOARGS, "name of the kernels used for the colour histogram"},
+	{"set_simd", scanner_set_simd, METH_VARARGS, "choose the kernels used for the colour histogram"},
+	{"simd_selftest", scanner_simd_selftest, METH_NOARGS, "check the SIMD kernels against the scalar kernels"},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -1252,6 +4292,33 @@ initscanner(void)
 
     import_array();
 
+    select_kernels();
+
+    if (PyType_Ready(&ScannerType) < 0) {
+#if PY_MAJOR_VERSION >= 3
+        return NULL;
+#else
+        return;
+#endif
+    }
+    Py_INCREF(&ScannerType);
+    PyModule_AddObject(m, "Scanner", (PyObject *)&ScannerType);
+
+    PyObject *spec = Py_BuildValue("[(ss)(ss)(ss)(ss)(ss)(ss)]",
+                                   "x1", "u2", "y1", "u2", "x2", "u2", "y2", "u2",
+                                   "score", "f4", "pixel_count", "u4");
+    if (spec == NULL || !PyArray_DescrConverter(spec, &region_descr)) {
+        Py_XDECREF(spec);
+#if PY_MAJOR_VERSION >= 3
+        return NULL;
+#else
+        return;
+#endif
+    }
+    Py_DECREF(spec);
+    Py_INCREF(region_descr);
+    PyModule_AddObject(m, "region_dtype", (PyObject *)region_descr);
+
     ScannerError = PyErr_NewException("scanner.error", NULL, NULL);
     Py_INCREF(ScannerError);
     PyModule_AddObject(m, "error", ScannerError);
@@ -9,13 +9,15 @@ class StampedCommand:
         self.blockid = None
 
 class ImagePacket(StampedCommand):
-    '''a jpeg image sent to the ground station'''
-    def __init__(self, frame_time, jpeg, pos, priority):
+    '''a jpeg image sent to the ground station. stage is the name of
+    the intermediate scan image it is, or None for the captured image'''
+    def __init__(self, frame_time, jpeg, pos, priority, stage=None):
         StampedCommand.__init__(self)
         self.frame_time = frame_time
         self.jpeg = jpeg
         self.pos = pos
         self.priority = priority
+        self.stage = stage
 
 class ImageDelta(StampedCommand):
     '''an image delta sent to the ground station'''
@@ -60,11 +62,14 @@ class CommandResponse(StampedCommand):
         self.response = response
         
 class ImageRequest(StampedCommand):
-    '''request a jpeg image from the aircraft'''
-    def __init__(self, frame_time, fullres):
+    '''request a jpeg image from the aircraft. If stage is given the
+    named intermediate image of the scan is sent instead, if the
+    aircraft captured it'''
+    def __init__(self, frame_time, fullres, stage=None):
         StampedCommand.__init__(self)
         self.frame_time = frame_time
         self.fullres = fullres
+        self.stage = stage
 
 class HeartBeat(StampedCommand):
     '''generic heartbeat to keep bsend alive'''
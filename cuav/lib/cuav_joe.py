@@ -1,13 +1,15 @@
 #!/usr/bin/python
 '''
 object to hold Joe positions
-We store a pickled list of these objects in joe.log
+We store these as fixed size binary records in joe.log. Older logs
+are a pickled list of these objects
 Andrew Tridgell
 May 2012
 '''
 
-import os, sys, pickle, time
-from cuav.lib import cuav_util, mav_position
+import os, sys, pickle, time, struct, itertools
+import numpy
+from cuav.lib import cuav_util, mav_position, cuav_region
 
 
 class JoePosition():
@@ -33,56 +35,464 @@ class JoePosition():
                                                              time.asctime(time.localtime(self.frame_time)),
                                                              self.rawname())
       
+# the binary joe log is a header followed by fixed size records of
+# joe_dtype. The image and thumbnail filenames are kept one per line in
+# a side file, and the records hold the line number of each name.
+# Floats of nan are None
+joe_magic = b'CUAVJOE\0'
+joe_version = 1
+joe_header = struct.Struct('<8sII')
+
+joe_dtype = numpy.dtype([('frame_time', '<f8'),
+                         ('lat', '<f8'), ('lon', '<f8'),
+                         ('score', '<f8'), ('scan_score', '<f8'),
+                         ('x1', '<i4'), ('y1', '<i4'), ('x2', '<i4'), ('y2', '<i4'),
+                         ('scan_w', '<i4'), ('scan_h', '<i4'),
+                         ('pos_lat', '<f8'), ('pos_lon', '<f8'), ('altitude', '<f8'),
+                         ('roll', '<f8'), ('pitch', '<f8'), ('yaw', '<f8'),
+                         ('pos_time', '<f8'),
+                         ('image_id', '<i4'), ('thumb_id', '<i4')])
+
+def names_filename(filename):
+  '''return the name of the side file holding the filenames of a joe log'''
+  return filename + '.names'
+
+def is_binary_log(filename):
+  '''return True if a joe log is in the binary format'''
+  try:
+    with open(filename, 'rb') as f:
+      return f.read(len(joe_magic)) == joe_magic
+  except (IOError, OSError):
+    return False
+
+def _truncate(filename, size):
+  with open(filename, 'r+b') as f:
+    f.truncate(size)
+
+def trim_log(filename):
+  '''cut a binary joe log back to its last whole record, and its names
+  file back to its last whole line, so a log that was being written
+  when the program stopped can be appended to'''
+  if not os.path.exists(filename):
+    return
+  size = os.path.getsize(filename)
+  with open(filename, 'rb') as f:
+    head = f.read(joe_header.size)
+  if size < joe_header.size:
+    # only part of the header was written
+    if len(head) > 0 and joe_magic.startswith(head[:len(joe_magic)]):
+      _truncate(filename, 0)
+  elif head.startswith(joe_magic):
+    whole = size - (size - joe_header.size) % joe_dtype.itemsize
+    if whole != size:
+      _truncate(filename, whole)
+  names = names_filename(filename)
+  if os.path.exists(names):
+    with open(names, 'rb') as f:
+      data = f.read()
+    if not data.endswith(b'\n'):
+      _truncate(names, data.rfind(b'\n') + 1)
+
+def _nan(v):
+  if v is None:
+    return numpy.nan
+  return v
+
+def _none(v):
+  if v != v:
+    return None
+  return v
+
+
 class JoeLog():
-  '''a Joe position logger'''
-  def __init__(self, filename, append=True):
+  '''a Joe position logger. Records are appended to a binary log which
+  stays open, with the regions of one frame written in one go. An old
+  pickle format log is appended to in the pickle format. With index
+  set the joes are also added to a JoeIndex, whose entry numbers are
+  the record numbers of the log'''
+  def __init__(self, filename, append=True, index=False):
     self.filename = filename
-    if filename is not None:
-      self.log = filename #open(filename, "ab" if append else "wb")
-      if not append:
+    self.log = None
+    self.legacy = False
+    self.names = {}
+    self.names_log = None
+    self.index = None
+    if filename is None:
+      if index:
+        self.index = JoeIndex()
+      return
+    if not append:
+      for f in [filename, names_filename(filename)]:
         try:
-          os.remove(self.filename)
-        except:
+          os.remove(f)
+        except OSError:
           pass
-    else:
-      self.log = None
-        
+    trim_log(filename)
+    if index:
+      self.index = index_joes(filename)
+    if os.path.exists(filename) and os.path.getsize(filename) > 0 and not is_binary_log(filename):
+      self.legacy = True
+      self.log = filename
+      return
+    if os.path.exists(names_filename(filename)):
+      with open(names_filename(filename)) as f:
+        for line in f:
+          self.names[line.rstrip('\n')] = len(self.names)
+    self.log = open(filename, 'ab')
+    if self.log.tell() == 0:
+      self.log.write(joe_header.pack(joe_magic, joe_version, joe_dtype.itemsize))
+      self.log.flush()
+    self.names_log = open(names_filename(filename), 'a')
+
+  def _name_id(self, name):
+    '''return the id of a filename, adding it to the side file if needed'''
+    if name is None:
+      return -1
+    if not name in self.names:
+      self.names[name] = len(self.names)
+      self.names_log.write(name + '\n')
+      self.names_log.flush()
+    return self.names[name]
+
+  def _record(self, latlon, frame_time, r, pos, image_filename, thumb_filename):
+    '''return a joe_dtype record as a tuple'''
+    if latlon is None:
+      latlon = (None, None)
+    scan_shape = getattr(r, 'scan_shape', None)
+    if scan_shape is None:
+      scan_shape = (-1, -1)
+    if pos is None:
+      pos = mav_position.MavPosition(None, None, None, None, None, None, None)
+    return ((_nan(frame_time), _nan(latlon[0]), _nan(latlon[1]),
+             _nan(getattr(r, 'score', None)), _nan(getattr(r, 'scan_score', None))) +
+            tuple(r.tuple()) + tuple(scan_shape) +
+            (_nan(pos.lat), _nan(pos.lon), _nan(pos.altitude),
+             _nan(pos.roll), _nan(pos.pitch), _nan(pos.yaw), _nan(pos.time),
+             self._name_id(image_filename), self._name_id(thumb_filename)))
+
+  def _write(self, joes):
+    '''write a list of (latlon, frame_time, r, pos, image_filename, thumb_filename)'''
+    if self.index is not None:
+      for joe in joes:
+        latlon = joe[0]
+        if latlon is None:
+          latlon = (None, None)
+        self.index.add(latlon[0], latlon[1], joe[1])
+    if self.log is None or len(joes) == 0:
+      return
+    if self.legacy:
+      with open(self.filename, "ab") as f:
+        for joe in joes:
+          f.write(pickle.dumps(JoePosition(*joe), protocol=pickle.HIGHEST_PROTOCOL))
+      return
+    recs = numpy.array([self._record(*joe) for joe in joes], dtype=joe_dtype)
+    self.log.write(recs.tobytes())
+    self.log.flush()
+
   def add(self, latlon, frame_time, r, pos, image_filename, thumb_filename):
     '''add an entry to the log'''
-    joe = JoePosition(latlon, frame_time, r, pos, image_filename, thumb_filename)
-    if self.log is not None:
-      with open(self.filename, "ab") as f:
-        f.write(pickle.dumps(joe, protocol=pickle.HIGHEST_PROTOCOL))
-        f.flush()
-        
+    self._write([(latlon, frame_time, r, pos, image_filename, thumb_filename)])
+
   def add_regions(self, frame_time, regions, pos, image_filename, thumb_filename=None):
     '''add a set of regions to the log, applying geo-referencing.
     Add latlon attribute to regions
     '''
     ret = []
-    for r in regions:
-        self.add(r.latlon, frame_time, r, pos, image_filename, thumb_filename)
+    self._write([(r.latlon, frame_time, r, pos, image_filename, thumb_filename) for r in regions])
     return ret
-        
-            
+
+  def close(self):
+    '''close the log'''
+    if self.log is not None and not self.legacy:
+      self.log.close()
+      self.names_log.close()
+    self.log = None
+
+
+def read_names(filename):
+  '''return the list of filenames of a binary joe log'''
+  if not os.path.exists(names_filename(filename)):
+    return []
+  with open(names_filename(filename)) as f:
+    return [line.rstrip('\n') for line in f]
+
+def read_records(filename):
+  '''return the joe_dtype records of a binary joe log, memory mapped.
+  A partly written record at the end of the log is ignored'''
+  size = os.path.getsize(filename)
+  with open(filename, 'rb') as f:
+    (magic, version, itemsize) = joe_header.unpack(f.read(joe_header.size))
+  if magic != joe_magic or version != joe_version or itemsize != joe_dtype.itemsize:
+    raise ValueError("%s is not a version %u joe log" % (filename, joe_version))
+  count = (size - joe_header.size) // joe_dtype.itemsize
+  if count == 0:
+    return numpy.zeros(0, dtype=joe_dtype)
+  return numpy.memmap(filename, dtype=joe_dtype, mode='r', offset=joe_header.size, shape=(count,))
+
+def joe_from_record(rec, names):
+  '''return a JoePosition from a joe_dtype record, as a tuple of
+  python values as given by tolist()'''
+  (frame_time, lat, lon, score, scan_score, x1, y1, x2, y2, scan_w, scan_h,
+   pos_lat, pos_lon, altitude, roll, pitch, yaw, pos_time, image_id, thumb_id) = rec
+  scan_shape = (scan_w, scan_h)
+  if scan_shape == (-1, -1):
+    scan_shape = None
+  r = cuav_region.Region(x1, y1, x2, y2, scan_shape, _none(scan_score))
+  r.score = _none(score)
+  latlon = None
+  if lat == lat:
+    latlon = (lat, lon)
+  r.latlon = latlon
+  pos = None
+  if pos_lat == pos_lat:
+    pos = mav_position.MavPosition(pos_lat, pos_lon, _none(altitude),
+                                   _none(roll), _none(pitch), _none(yaw), _none(pos_time))
+  image_filename = None
+  if image_id >= 0:
+    image_filename = names[image_id]
+  thumb_filename = None
+  if thumb_id >= 0:
+    thumb_filename = names[thumb_id]
+  return JoePosition(latlon, _none(frame_time), r, pos, image_filename, thumb_filename)
+
+def convert_log(infile, outfile):
+  '''convert a pickle format joe log to the binary format, returning
+  the number of joes converted'''
+  joelog = JoeLog(outfile, append=False)
+  count = 0
+  for joe in JoeIterator(infile):
+    joelog.add(joe.latlon, joe.frame_time, joe.r, joe.pos, joe.image_filename, joe.thumb_filename)
+    count += 1
+  joelog.close()
+  return count
+
+
 class JoeIterator():
-  '''an iterator for a joe.log'''
+  '''an iterator for a joe.log, in either the binary or pickle format.
+  The joes are read as they are iterated over'''
   def __init__(self, filename):
-    self.joes = []
-    
-    in_s = open(filename, 'rb')
-    try:
-      # Read the data
+    self.filename = filename
+    self.binary = is_binary_log(filename)
+
+  def __iter__(self):
+    if self.binary:
+      names = read_names(self.filename)
+      recs = read_records(self.filename)
+      for i in range(0, len(recs), 1024):
+        for rec in recs[i:i+1024].tolist():
+          yield joe_from_record(rec, names)
+      return
+    with open(self.filename, 'rb') as in_s:
       while True:
         try:
-          o = pickle.load(in_s)
-          self.joes.append(o)
+          yield pickle.load(in_s)
         except EOFError:
           break
-    finally:
-      in_s.close()
 
   def getjoes(self):
-    return self.joes
-  
+    return list(self)
+
+
+def read_joes(filename, idxs):
+  '''return a list of the JoePositions of a joe log at some record numbers'''
+  if is_binary_log(filename):
+    names = read_names(filename)
+    recs = read_records(filename)[numpy.asarray(idxs, dtype=numpy.int64)]
+    return [joe_from_record(rec, names) for rec in recs.tolist()]
+  joes = JoeIterator(filename).getjoes()
+  return [joes[i] for i in idxs]
+
+
+class JoeIndex(object):
+  '''a spatial and temporal index of joes, or anything else with a
+  position and time. Entries are numbered in the order they are added,
+  which for a joe log is the record number. Positions are bucketed in a
+  grid of cell_size meters on a tangent plane, so a query only looks at
+  the entries in nearby cells. Entries with no position are only found
+  by time'''
+  def __init__(self, cell_size=50.0, capacity=1024):
+    self.cell_size = float(cell_size)
+    self.projector = None
+    self.cells = {}
+    self.bounds = None
+    self.count = 0
+    self._lat = numpy.empty(capacity)
+    self._lon = numpy.empty(capacity)
+    self._time = numpy.empty(capacity)
+    self._time_sorted = True
+    self._time_order = None
+
+  def __len__(self):
+    return self.count
+
+  def _grow(self, n):
+    '''make room for n more entries'''
+    if self.count + n <= len(self._lat):
+      return
+    capacity = max(2*len(self._lat), self.count + n)
+    for name in ['_lat', '_lon', '_time']:
+      a = numpy.empty(capacity)
+      a[:self.count] = getattr(self, name)[:self.count]
+      setattr(self, name, a)
+
+  def _cells(self, lat, lon):
+    '''return the grid cell x and y arrays of some positions'''
+    (east, north) = self.projector.to_enu(lat, lon)
+    return (numpy.floor(east / self.cell_size).astype(numpy.int64),
+            numpy.floor(north / self.cell_size).astype(numpy.int64))
+
+  def _add_cells(self, idxs):
+    '''add entries to the grid'''
+    idxs = idxs[~numpy.isnan(self._lat[idxs])]
+    if len(idxs) == 0:
+      return
+    if self.projector is None:
+      self.projector = cuav_util.ENUProjector(self._lat[idxs[0]], self._lon[idxs[0]])
+    (x, y) = self._cells(self._lat[idxs], self._lon[idxs])
+    if self.bounds is None:
+      self.bounds = [x[0], y[0], x[0], y[0]]
+    self.bounds = [min(self.bounds[0], x.min()), min(self.bounds[1], y.min()),
+                   max(self.bounds[2], x.max()), max(self.bounds[3], y.max())]
+    # group the entries by cell, keeping them in order within a cell
+    order = numpy.lexsort((idxs, y, x))
+    (x, y, idxs) = (x[order], y[order], idxs[order])
+    starts = numpy.flatnonzero(numpy.concatenate(([True], (x[1:] != x[:-1]) | (y[1:] != y[:-1]))))
+    ends = numpy.append(starts[1:], len(idxs))
+    for (s, e) in zip(starts.tolist(), ends.tolist()):
+      key = (int(x[s]), int(y[s]))
+      if not key in self.cells:
+        self.cells[key] = []
+      self.cells[key].extend(idxs[s:e].tolist())
+
+  def add_many(self, lats, lons, frame_times):
+    '''add arrays of entries, with nan for no position. Returns the
+    numbers of the new entries'''
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    n = len(lats)
+    self._grow(n)
+    idxs = numpy.arange(self.count, self.count+n)
+    self._lat[idxs] = lats
+    self._lon[idxs] = numpy.asarray(lons, dtype=numpy.float64)
+    self._time[idxs] = numpy.asarray(frame_times, dtype=numpy.float64)
+    if self._time_sorted and n > 0:
+      t = self._time[max(self.count-1, 0):self.count+n]
+      self._time_sorted = bool((t[1:] >= t[:-1]).all())
+    self._time_order = None
+    self.count += n
+    self._add_cells(idxs)
+    return idxs
+
+  def add(self, lat, lon, frame_time):
+    '''add an entry, returning its number. lat and lon may be None'''
+    return int(self.add_many([_nan(lat)], [_nan(lon)], [_nan(frame_time)])[0])
+
+  def update(self, idx, lat, lon, frame_time):
+    '''change the position and time of an entry'''
+    if not numpy.isnan(self._lat[idx]):
+      (x, y) = self._cells(self._lat[idx], self._lon[idx])
+      self.cells[(int(x), int(y))].remove(idx)
+    self._lat[idx] = _nan(lat)
+    self._lon[idx] = _nan(lon)
+    if self._time[idx] != _nan(frame_time):
+      self._time[idx] = _nan(frame_time)
+      self._time_sorted = False
+      self._time_order = None
+    self._add_cells(numpy.array([idx]))
+
+  def position(self, idx):
+    '''return the (lat, lon, frame_time) of an entry'''
+    return (_none(float(self._lat[idx])), _none(float(self._lon[idx])), _none(float(self._time[idx])))
+
+  def _candidates(self, lat, lon, margin):
+    '''return the sorted numbers of the entries in the cells within
+    margin meters of a point, and whether that is every cell'''
+    if self.projector is None:
+      return (numpy.zeros(0, dtype=numpy.int64), True)
+    (east, north) = self.projector.to_enu(lat, lon)
+    (x0, y0, x1, y1) = [int(numpy.floor(v / self.cell_size)) for v in
+                        [east.min()-margin, north.min()-margin, east.max()+margin, north.max()+margin]]
+    everything = (x0 <= self.bounds[0] and y0 <= self.bounds[1] and
+                  x1 >= self.bounds[2] and y1 >= self.bounds[3])
+    (x0, y0) = (max(x0, self.bounds[0]), max(y0, self.bounds[1]))
+    (x1, y1) = (min(x1, self.bounds[2]), min(y1, self.bounds[3]))
+    if x0 > x1 or y0 > y1:
+      return (numpy.zeros(0, dtype=numpy.int64), everything)
+    if (x1-x0+1) * (y1-y0+1) > len(self.cells):
+      lists = [v for (k, v) in self.cells.items() if x0 <= k[0] <= x1 and y0 <= k[1] <= y1]
+    else:
+      lists = [self.cells[(x, y)] for x in range(x0, x1+1) for y in range(y0, y1+1) if (x, y) in self.cells]
+    idxs = numpy.fromiter(itertools.chain.from_iterable(lists), dtype=numpy.int64)
+    idxs.sort()
+    return (idxs, everything)
+
+  def radius(self, lat, lon, radius):
+    '''return the numbers of the entries within radius meters of a point'''
+    # the tangent plane is only used to pick cells, so allow for its error
+    (idxs, everything) = self._candidates(lat, lon, radius*1.01 + 1.0)
+    distances = cuav_util.gps_distance_many(lat, lon, self._lat[idxs], self._lon[idxs])
+    return idxs[distances <= radius]
+
+  def bbox(self, lat1, lon1, lat2, lon2):
+    '''return the numbers of the entries within a latitude/longitude box'''
+    (idxs, everything) = self._candidates([lat1, lat1, lat2, lat2], [lon1, lon2, lon1, lon2], 1.0)
+    (lat, lon) = (self._lat[idxs], self._lon[idxs])
+    inside = ((lat >= min(lat1, lat2)) & (lat <= max(lat1, lat2)) &
+              (lon >= min(lon1, lon2)) & (lon <= max(lon1, lon2)))
+    return idxs[inside]
+
+  def nearest(self, lat, lon, k=1):
+    '''return the numbers of the k entries closest to a point, closest first'''
+    margin = self.cell_size
+    while True:
+      (idxs, everything) = self._candidates(lat, lon, margin)
+      if len(idxs) >= k or everything:
+        distances = cuav_util.gps_distance_many(lat, lon, self._lat[idxs], self._lon[idxs])
+        order = numpy.argsort(distances, kind='mergesort')[:k]
+        if everything or len(order) == 0:
+          return idxs[order]
+        # the k closest so far are the k closest if nothing outside
+        # the cells searched can be closer
+        furthest = distances[order[-1]]*1.01 + 1.0
+        if furthest <= margin:
+          return idxs[order]
+        margin = furthest
+      else:
+        margin *= 2
+
+  def time_range(self, t1, t2):
+    '''return the numbers of the entries with times from t1 to t2
+    inclusive, in time order. Either may be None for no limit'''
+    times = self._time[:self.count]
+    if self._time_sorted:
+      order = None
+    else:
+      if self._time_order is None:
+        order = numpy.argsort(times, kind='mergesort')
+        self._time_order = (order, times[order])
+      (order, times) = self._time_order
+    start = 0
+    end = self.count
+    if t1 is not None:
+      start = int(numpy.searchsorted(times, t1, side='left'))
+    if t2 is not None:
+      end = int(numpy.searchsorted(times, t2, side='right'))
+    if order is None:
+      return numpy.arange(start, max(start, end))
+    return order[start:max(start, end)]
+
 
+def index_joes(filename, cell_size=50.0):
+  '''return a JoeIndex of a joe log'''
+  index = JoeIndex(cell_size)
+  if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+    return index
+  if is_binary_log(filename):
+    recs = read_records(filename)
+    index.add_many(recs['lat'], recs['lon'], recs['frame_time'])
+    return index
+  for joe in JoeIterator(filename):
+    latlon = joe.latlon
+    if latlon is None:
+      latlon = (None, None)
+    index.add(latlon[0], latlon[1], joe.frame_time)
+  return index
@@ -2,7 +2,10 @@
 '''Class for determining and plotting a landing location for a UAV, based on a set
 of detected regions.'''
 
+import numpy
+
 from cuav.lib import cuav_util
+from cuav.lib import cuav_region
 
 class LandingZoneDisplay:
     '''this is a landing zone object for transmitting to the GCS for display purposes'''
@@ -14,16 +17,14 @@ class LandingZoneDisplay:
 
 class LandingZone:
     def __init__(self):
-        self.regions = []
+        self.regions = cuav_region.RegionSet()
         self.last_len = 0
         self.last_result = None
 
     def checkaddregion(self, r, pos):
         '''Add a region to the list of landing zone regions'''
         # remember the bank angle and yaw for weighting
-        r.angle = abs(pos.roll) + abs(pos.pitch)
-        r.yaw = pos.yaw
-        self.regions.append(r)
+        self.regions.append(r, angle=abs(pos.roll) + abs(pos.pitch), yaw=pos.yaw)
 
     def distance_from(self, region, center):
         '''return distance of a region from a center point'''
@@ -31,15 +32,14 @@ class LandingZone:
         (clat, clon) = center
         return cuav_util.gps_distance(lat, lon, clat, clon)
 
+    def distances_from(self, regions, center):
+        '''return the distances of an array of regions from a center point'''
+        (clat, clon) = center
+        return cuav_util.gps_distance_many(regions['lat'], regions['lon'], clat, clon)
+
     def average_pos(self, regions):
-        '''return (lat,lon) average of a list of regions'''
-        lat_sum = 0.0
-        lon_sum = 0.0
-        for r in regions:
-            (lat,lon) = r.latlon
-            lat_sum += lat
-            lon_sum += lon
-        return (lat_sum / len(regions), lon_sum / len(regions))
+        '''return (lat,lon) average of an array of regions'''
+        return (float(regions['lat'].mean()), float(regions['lon'].mean()))
 
     def calclandingzone(self):
         '''work out best estimate of the landing zone
@@ -61,46 +61,43 @@ class LandingZone:
             return None
 
         # start by dropping the bottom 25% percentile by score. This removes
-        # the likely bad matches
-
-        # take a shallow copy
-        regions = self.regions[:]
+        # the likely bad matches. The stable sorts keep the order of
+        # regions with equal keys, as list.sort() does
+        regions = self.regions.array
+        idx = numpy.arange(len(regions))
 
         # throw away bottom 25% by score
-        regions.sort(key = lambda r : r.score, reverse=True)
-        regions = regions[:-len(regions)//4]
+        idx = idx[numpy.argsort(-regions['score'][idx], kind='stable')]
+        idx = idx[:-len(idx)//4]
 
         # throw away bottom 25% by angle
-        regions.sort(key = lambda r : r.angle, reverse=False)
-        regions = regions[:-len(regions)//4]
+        idx = idx[numpy.argsort(regions['angle'][idx], kind='stable')]
+        idx = idx[:-len(idx)//4]
 
         # remove outliers
         outlier_distance = 15
 
         while True:
-            if len(regions) < 1:
+            if len(idx) < 1:
                 return None
-        
-            # find average position
-            center = self.average_pos(regions)
 
-            regions.sort(key = lambda r : self.distance_from(r, center), reverse=False)
-            if self.distance_from(regions[-1], center) < outlier_distance:
+            # find average position
+            center = self.average_pos(regions[idx])
+            distances = self.distances_from(regions[idx], center)
+            order = numpy.argsort(distances, kind='stable')
+            idx = idx[order]
+            if distances[order[-1]] < outlier_distance:
                 break
-            regions.pop(len(regions)-1)
+            idx = idx[:-1]
 
-        if len(regions) < 1:
+        if len(idx) < 1:
             return None
-        
+
         # re-calculate center
-        center = self.average_pos(regions)
+        center = self.average_pos(regions[idx])
 
-        maxerror = 0.0
-        sumscore = 0.0
-        for r in regions:
-            d = self.distance_from(r, center)
-            maxerror = max(d, maxerror)
-            sumscore += r.score
+        maxerror = float(self.distances_from(regions[idx], center).max())
+        sumscore = float(regions['score'][idx].sum())
 
-        self.last_result = LandingZoneDisplay(center, maxerror, sumscore / len(regions), len(regions))
+        self.last_result = LandingZoneDisplay(center, maxerror, sumscore / len(idx), len(idx))
         return self.last_result
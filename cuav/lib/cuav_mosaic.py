@@ -9,6 +9,8 @@ import numpy, os, cv2, sys, time, math, functools
 
 from cuav.lib import cuav_util
 from cuav.lib import cuav_region
+from cuav.lib import cuav_joe
+from cuav.image import scanner
 from MAVProxy.modules.lib import mp_image
 from MAVProxy.modules.mavproxy_map import mp_slipmap
 from MAVProxy.modules.lib.mp_menu import *
@@ -54,11 +56,8 @@ class MosaicImage:
 def ExtractThumbs(img, count):
     '''extract thumbnails from a composite thumbnail image'''
     thumb_size = cuav_util.image_width(img) // count
-    thumbs = []
-    for i in range(count):
-        thumb = cuav_util.SubImage(img, (i*thumb_size, 0, thumb_size, thumb_size))
-        thumbs.append(thumb)
-    return thumbs
+    rects = [(i*thumb_size, 0, thumb_size, thumb_size) for i in range(count)]
+    return list(scanner.rect_extract_many(numpy.ascontiguousarray(img), rects, thumb_size))
 
 class Mosaic():
     '''keep a mosaic of found regions'''
@@ -93,6 +92,7 @@ class Mosaic():
         self.page = 0
         self.sort_type = 'Score'
         self.images = []
+        self.image_index = cuav_joe.JoeIndex()
         self.current_view = 0
         self.last_view_latlon = None
         self.view_filename = None
@@ -338,17 +338,10 @@ class Mosaic():
         if len(selected) != 0 and self.show_selected(selected[0]):
             return
         (lat, lon) = latlon
-        closest = -1
-        closest_distance = -1
-        for idx in range(len(self.images)):
-            pos = self.images[idx].pos
-            if pos is not None:
-                distance = cuav_util.gps_distance(lat, lon, pos.lat, pos.lon)
-                if closest == -1 or distance < closest_distance:
-                    closest_distance = distance
-                    closest = idx
-        if closest == -1:
+        idxs = self.image_index.nearest(lat, lon)
+        if len(idxs) == 0:
             return
+        closest = int(idxs[0])
         self.current_view = closest
         self.last_view_latlon = None
         image = self.images[closest]
@@ -846,11 +839,17 @@ class Mosaic():
     def add_image(self, frame_time, filename, pos):
         '''add a camera image'''
         idx = self.find_image_idx(filename)
+        if pos is None:
+            (lat, lon) = (None, None)
+        else:
+            (lat, lon) = (pos.lat, pos.lon)
         if idx is not None:
             self.images[idx].pos = pos
             self.images[idx].frame_time = frame_time
+            self.image_index.update(idx, lat, lon, frame_time)
         else:
             self.images.append(MosaicImage(frame_time, filename, pos))
+            self.image_index.add(lat, lon, frame_time)
 
     def tag_image(self, frame_time, tag_color=(0,255,255)):
         '''tag a mosaic image'''
@@ -4,9 +4,14 @@
 import numpy, sys, os, time, cv2, math
 from numpy import shape
 from cuav.lib import cuav_util
+from cuav.image import scanner
 
 class Region:
     '''a object representing a recognised region in an image'''
+    __slots__ = ('x1', 'y1', 'x2', 'y2', 'latlon', 'score', 'scan_score',
+                 'whiteness', 'blue_score', 'scan_shape',
+                 'hsv_score', 'col_score', 'angle', 'yaw')
+
     def __init__(self, x1, y1, x2, y2, scan_shape, scan_score=0):
         self.x1 = x1
         self.y1 = y1
@@ -41,14 +46,51 @@ class Region:
     def __str__(self):
         return '%s latlon=%s score=%s' % (str(self.tuple()), str(self.latlon), self.score)
 
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k))
+
+    def __setstate__(self, state):
+        # older logs hold the __dict__ of a Region
+        for (k, v) in state.items():
+            setattr(self, k, v)
+
+# the array form of a list of regions, as returned by RegionsConvert
+# for the output of scanner.scan(..., as_array=True). A score, lat or lon
+# of nan is the same as None in a Region
+region_dtype = numpy.dtype([('x1', numpy.int32), ('y1', numpy.int32),
+                            ('x2', numpy.int32), ('y2', numpy.int32),
+                            ('scan_score', numpy.float64),
+                            ('pixel_count', numpy.uint32),
+                            ('score', numpy.float64),
+                            ('lat', numpy.float64), ('lon', numpy.float64)])
+
+def is_region_array(regions):
+    '''return True if regions is in the array form rather than a list'''
+    return isinstance(regions, numpy.ndarray)
+
 def RegionsConvert(rlist, scan_shape, full_shape):
     '''convert a region list from tuple to Region format,
-    also mapping to the shape of the full image'''
-    ret = []
+    also mapping to the shape of the full image
+
+    If rlist is the array from scanner.scan(..., as_array=True) then
+    an array of region_dtype is returned instead'''
     scan_w = scan_shape[0]
     scan_h = scan_shape[1]
     full_w = full_shape[0]
     full_h = full_shape[1]
+    if is_region_array(rlist):
+        ret = numpy.empty(len(rlist), dtype=region_dtype)
+        ret['x1'] = (rlist['x1'].astype(numpy.int32) * full_w) // scan_w
+        ret['x2'] = (rlist['x2'].astype(numpy.int32) * full_w) // scan_w
+        ret['y1'] = (rlist['y1'].astype(numpy.int32) * full_h) // scan_h
+        ret['y2'] = (rlist['y2'].astype(numpy.int32) * full_h) // scan_h
+        ret['scan_score'] = rlist['score']
+        ret['pixel_count'] = rlist['pixel_count']
+        ret['score'] = numpy.nan
+        ret['lat'] = numpy.nan
+        ret['lon'] = numpy.nan
+        return ret
+    ret = []
     for r in rlist:
         (x1,y1,x2,y2,score) = r
         x1 = (x1 * full_w) // scan_w
@@ -59,81 +101,267 @@ def RegionsConvert(rlist, scan_shape, full_shape):
         ret.append(Region(x1,y1,x2,y2, scan_shape, score))
     return ret
 
+def RegionsFromArray(regions, scan_shape):
+    '''convert an array of region_dtype to a list of Region objects'''
+    ret = []
+    for r in regions:
+        region = Region(int(r['x1']), int(r['y1']), int(r['x2']), int(r['y2']),
+                        scan_shape, float(r['scan_score']))
+        if not numpy.isnan(r['score']):
+            region.score = float(r['score'])
+        if not numpy.isnan(r['lat']):
+            region.latlon = (float(r['lat']), float(r['lon']))
+        ret.append(region)
+    return ret
+
+# the columns of a RegionSet. Floats of nan are the same as None or an
+# unset attribute in a Region, and a scan shape of (-1,-1) is None
+regionset_dtype = numpy.dtype(region_dtype.descr +
+                              [('scan_w', numpy.int32), ('scan_h', numpy.int32),
+                               ('whiteness', numpy.float64), ('blue_score', numpy.float64),
+                               ('hsv_score', numpy.float64), ('col_score', numpy.float64),
+                               ('angle', numpy.float64), ('yaw', numpy.float64)])
+
+# Region attributes which are a single float column of a RegionSet
+regionset_floats = ['scan_score', 'score', 'whiteness', 'blue_score',
+                    'hsv_score', 'col_score', 'angle', 'yaw']
+
+def _nan_to_none(v):
+    v = float(v)
+    if numpy.isnan(v):
+        return None
+    return v
+
+def _none_to_nan(v):
+    if v is None:
+        return numpy.nan
+    return v
+
+def _region_from_state(state):
+    '''unpickle a Region saved from a RegionView'''
+    region = Region.__new__(Region)
+    region.__setstate__(state)
+    return region
+
+class RegionView(object):
+    '''a Region stored in a row of a RegionSet. This has the same
+    attributes and methods as a Region'''
+    __slots__ = ('regionset', 'idx')
+
+    def __init__(self, regionset, idx):
+        self.regionset = regionset
+        self.idx = idx
+
+    def _row(self):
+        return self.regionset._data[self.idx]
+
+    def _get(self, name):
+        return self.regionset._data[name][self.idx]
+
+    def _set(self, name, value):
+        self.regionset._data[name][self.idx] = value
+
+    def region(self):
+        '''return a copy of the region as a Region'''
+        region = Region(self.x1, self.y1, self.x2, self.y2, self.scan_shape, self.scan_score)
+        region.latlon = self.latlon
+        region.score = self.score
+        region.whiteness = self.whiteness
+        region.blue_score = self.blue_score
+        # these are only set on a Region once they are known
+        for k in ['hsv_score', 'col_score', 'angle', 'yaw']:
+            v = getattr(self, k)
+            if v is not None:
+                setattr(region, k, v)
+        return region
+
+    def __reduce__(self):
+        # pickle a copy, rather than the whole set
+        return (_region_from_state, (self.region().__getstate__(),))
+
+    x1 = property(lambda self: int(self._get('x1')), lambda self, v: self._set('x1', v))
+    y1 = property(lambda self: int(self._get('y1')), lambda self, v: self._set('y1', v))
+    x2 = property(lambda self: int(self._get('x2')), lambda self, v: self._set('x2', v))
+    y2 = property(lambda self: int(self._get('y2')), lambda self, v: self._set('y2', v))
+
+    @property
+    def latlon(self):
+        lat = self._get('lat')
+        if numpy.isnan(lat):
+            return None
+        return (float(lat), float(self._get('lon')))
+
+    @latlon.setter
+    def latlon(self, latlon):
+        if latlon is None or latlon[0] is None:
+            latlon = (numpy.nan, numpy.nan)
+        self._set('lat', latlon[0])
+        self._set('lon', latlon[1])
+
+    @property
+    def scan_shape(self):
+        shape = (int(self._get('scan_w')), int(self._get('scan_h')))
+        if shape == (-1, -1):
+            return None
+        return shape
+
+    @scan_shape.setter
+    def scan_shape(self, shape):
+        if shape is None:
+            shape = (-1, -1)
+        self._set('scan_w', shape[0])
+        self._set('scan_h', shape[1])
+
+    tuple = Region.tuple
+    center = Region.center
+    draw_rectangle = Region.draw_rectangle
+    __str__ = Region.__str__
+
+def _float_property(name):
+    return property(lambda self: _nan_to_none(self._get(name)),
+                    lambda self, v: self._set(name, _none_to_nan(v)))
+
+for _name in regionset_floats:
+    setattr(RegionView, _name, _float_property(_name))
+
+class RegionSet(object):
+    '''a growable set of regions stored as one array of regionset_dtype,
+    rather than as one python object per region. Indexing or iterating
+    gives a RegionView for each region'''
+    def __init__(self, regions=None):
+        self._data = numpy.empty(16, dtype=regionset_dtype)
+        self._count = 0
+        if regions is not None:
+            self.extend(regions)
+
+    def __len__(self):
+        return self._count
+
+    def _grow(self, n):
+        '''make room for n more regions'''
+        if self._count + n <= len(self._data):
+            return
+        data = numpy.empty(max(2*len(self._data), self._count + n), dtype=regionset_dtype)
+        data[:self._count] = self._data[:self._count]
+        self._data = data
+
+    def append(self, region, angle=None, yaw=None):
+        '''add a Region or RegionView, optionally with the bank angle and
+        yaw of the aircraft when it was seen'''
+        self._grow(1)
+        idx = self._count
+        self._count += 1
+        if isinstance(region, RegionView):
+            self._data[idx] = region._row()
+        else:
+            row = self._data[idx:idx+1]
+            (row['x1'], row['y1'], row['x2'], row['y2']) = region.tuple()
+            scan_shape = region.scan_shape
+            if scan_shape is None:
+                scan_shape = (-1, -1)
+            (row['scan_w'], row['scan_h']) = scan_shape
+            row['pixel_count'] = 0
+            latlon = region.latlon
+            if latlon is None or latlon[0] is None:
+                latlon = (numpy.nan, numpy.nan)
+            (row['lat'], row['lon']) = latlon
+            for k in regionset_floats:
+                row[k] = _none_to_nan(getattr(region, k, None))
+        view = RegionView(self, idx)
+        if angle is not None:
+            view.angle = angle
+        if yaw is not None:
+            view.yaw = yaw
+        return view
+
+    def extend(self, regions, scan_shape=None):
+        '''add a list of regions, a RegionSet, or an array of region_dtype
+        from an image of scan_shape'''
+        if isinstance(regions, RegionSet):
+            regions = regions.array
+        if not is_region_array(regions):
+            for r in regions:
+                self.append(r)
+            return
+        self._grow(len(regions))
+        rows = self._data[self._count:self._count+len(regions)]
+        for k in regionset_floats:
+            rows[k] = numpy.nan
+        for k in regions.dtype.names:
+            rows[k] = regions[k]
+        if regions.dtype != regionset_dtype:
+            if scan_shape is None:
+                scan_shape = (-1, -1)
+            (rows['scan_w'], rows['scan_h']) = scan_shape
+        self._count += len(regions)
+
+    @property
+    def array(self):
+        '''the regions as an array of regionset_dtype. This is a view, so
+        changes to it change the set'''
+        return self._data[:self._count]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, str):
+            return self.array[idx]
+        if idx < 0:
+            idx += self._count
+        if idx < 0 or idx >= self._count:
+            raise IndexError('region index out of range')
+        return RegionView(self, idx)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield RegionView(self, i)
+
+    def regions(self):
+        '''return the regions as a list of Region objects'''
+        return [v.region() for v in self]
+
+    def __getstate__(self):
+        return { 'regions' : self.array }
+
+    def __setstate__(self, state):
+        self._data = numpy.array(state['regions'], dtype=regionset_dtype)
+        self._count = len(self._data)
+
 def image_whiteness(hsv):
         ''' a measure of the whiteness of an HSV image 0 to 1'''
-        #(width,height) = cv.GetSize(hsv)
         (height,width,d) = shape(hsv)
-        score = 0
-        count = 0
         if height == 0 or width == 0:
             return 0
-        for x in range(width):
-            for y in range(height):
-                (h,s,v) = hsv[y,x]
-                if (s < 25 and v > 50):
-                    count += 1
+        s = hsv[:,:,1]
+        v = hsv[:,:,2]
+        count = numpy.count_nonzero((s < 25) & (v > 50))
         return float(count)/float(width*height)
 
 def raw_hsv_score(hsv):
     '''try to score a HSV image based on hsv'''
     (height,width,d) = shape(hsv)
-    score = 0
-    blue_count = 0
-    red_count = 0
-    sum_v = 0
-
-    # keep range of hsv
-    h_min = 255
-    h_max = 0
-    s_min = 255
-    s_max = 0
-    v_min = 255
-    v_max = 0
-
-    from numpy import zeros
-    scorix = zeros((height,width))
-    for x in range(width):
-        for y in range(height):
-            pix_score = 0
-            (h,s,v) = hsv[y,x]
-            if h > h_max:
-                    h_max = h
-            if s > s_max:
-                    s_max = s
-            if v > v_max:
-                    v_max = v
-            if h < h_min:
-                    h_min = h
-            if s < s_min:
-                    s_min = s
-            if v < v_min:
-                    v_min = v
-            sum_v += v
-            if (h < 22 or (h > 171 and h < 191)) and s > 50 and v < 150:
-                pix_score += 3
-                blue_count += 1
-                #print (x,y),h,s,v,'B'
-            elif h > 108 and h < 140 and s > 140 and v > 128:
-                pix_score += 1
-                red_count += 1
-                #print (x,y),h,s,v,'R'
-            elif h > 82 and h < 94 and s > 125 and v > 100 and v < 230:
-                pix_score += 1
-                red_count += 1
-                #print (x,y),h,s,v,'Y'
-            elif v > 160 and s > 100:
-                pix_score += 1
-                #print h,s,v,'V'
-            elif h>70 and s > 110 and v > 90:
-                pix_score += 1
-                #print h,s,v,'S'
-            score += pix_score
-            scorix[y,x] = pix_score
-    avg_v = sum_v / (width*height)
-    score = 500 * float(score) / (width*height)
+    h = hsv[:,:,0]
+    s = hsv[:,:,1]
+    v = hsv[:,:,2]
+
+    # each pixel scores for the first of these classes it falls in
+    blue = ((h < 22) | ((h > 171) & (h < 191))) & (s > 50) & (v < 150)
+    rest = ~blue
+    red = rest & (h > 108) & (h < 140) & (s > 140) & (v > 128)
+    rest &= ~red
+    yellow = rest & (h > 82) & (h < 94) & (s > 125) & (v > 100) & (v < 230)
+    rest &= ~yellow
+    bright = rest & (v > 160) & (s > 100)
+    rest &= ~bright
+    saturated = rest & (h > 70) & (s > 110) & (v > 90)
+
+    scorix = 3.0 * blue + (red | yellow | bright | saturated)
+    blue_count = numpy.count_nonzero(blue)
+    red_count = numpy.count_nonzero(red) + numpy.count_nonzero(yellow)
+    avg_v = float(v.sum(dtype=numpy.uint64)) / (width*height)
+    score = 500 * float(scorix.sum()) / (width*height)
     score = max(score, 1)
 
-    return (score, scorix, blue_count, red_count, avg_v, s_max - s_min, v_max - v_min)
+    return (score, scorix, blue_count, red_count, avg_v,
+            int(s.max()) - int(s.min()), int(v.max()) - int(v.min()))
 
 def log_scaling(value, scale):
     # apply a log scaling to a value
@@ -199,12 +427,17 @@ def rgb_score(img):
     pct_blue = 100.0 * blue_count / num_pixels
     return min(pct_red, pct_blue) * 5000
     
-def score_region(img, r, filter_type='simple'):
-    '''filter a list of regions using HSV values'''
+def score_region(img, r, filter_type='simple', shape=None):
+    '''filter a list of regions using HSV values. If shape is given it is
+    the (w,h) of the image the region coordinates refer to, and the
+    region is mapped into img, which may be a reduced resolution copy'''
     (x1, y1, x2, y2) = r.tuple()
     (w,h) = cuav_util.image_shape(img)
     x = (x1+x2)//2
     y = (y1+y2)//2
+    if shape is not None:
+        x = x * w // shape[0]
+        y = y * h // shape[1]
     x1 = max(x-10,0)
     x2 = min(x+10,w)
     y1 = max(y-10,0)
@@ -215,63 +448,142 @@ def score_region(img, r, filter_type='simple'):
     #hsv_score(r, hsv)
     #r.score += template_score(rimg)
 
-def filter_regions(img, regions, min_score=4, filter_type='simple'):
-    '''filter a list of regions using HSV values'''
+def rgb_score_many(img, regions, shape=None):
+    '''rgb_score of the 20x20 area around the center of each region
+    in an array of region_dtype, as used by score_region'''
+    (w,h) = cuav_util.image_shape(img)
+    x = (regions['x1'] + regions['x2'])//2
+    y = (regions['y1'] + regions['y2'])//2
+    if shape is not None:
+        x = x * w // shape[0]
+        y = y * h // shape[1]
+    x1 = numpy.maximum(x-10, 0)
+    x2 = numpy.minimum(x+10, w)
+    y1 = numpy.maximum(y-10, 0)
+    y2 = numpy.minimum(y+10, h)
+    ofs = numpy.arange(20)
+    xs = x1[:,None] + ofs
+    ys = y1[:,None] + ofs
+    valid = ((xs < x2[:,None])[:,None,:] & (ys < y2[:,None])[:,:,None])
+    pix = img[numpy.minimum(ys, h-1)[:,:,None], numpy.minimum(xs, w-1)[:,None,:]].astype(numpy.float64)
+    (r,g,b) = (pix[...,0], pix[...,1], pix[...,2])
+    col_thresh = 1.4
+    red = (r > g*col_thresh) & (r > b*col_thresh)
+    blue = ~red & (b > r*col_thresh) & (b > g*col_thresh)
+    num_pixels = valid.sum(axis=(1,2))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pct_red = 100.0 * (red & valid).sum(axis=(1,2)) / num_pixels
+        pct_blue = 100.0 * (blue & valid).sum(axis=(1,2)) / num_pixels
+    return numpy.minimum(pct_red, pct_blue) * 5000
+
+def filter_regions(img, regions, min_score=4, filter_type='simple', shape=None):
+    '''filter a list of regions using HSV values. If shape is given it is
+    the (w,h) of the image the regions refer to, allowing scoring on a
+    reduced resolution copy of the image'''
+    if is_region_array(regions):
+        unscored = numpy.isnan(regions['score'])
+        if unscored.any():
+            regions['score'][unscored] = rgb_score_many(img, regions[unscored], shape=shape)
+        return regions[regions['score'] >= min_score]
     ret = []
     #img = cv.GetImage(cv.fromarray(img))
     for r in regions:
         if r.score is None:
-            score_region(img, r, filter_type=filter_type)
+            score_region(img, r, filter_type=filter_type, shape=shape)
         if r.score >= min_score:
             ret.append(r)
     return ret
 
 
+def georef_regions(regions, pos, C, width, height, altitude=None):
+    '''set the latlon of the centre of each region in a list, or the lat
+    and lon columns of a region array, given the MavPosition the image
+    was taken at. The camera transform is built once for all the regions'''
+    if is_region_array(regions):
+        x1 = regions['x1']
+        y1 = regions['y1']
+        x2 = regions['x2']
+        y2 = regions['y2']
+    else:
+        x1 = numpy.array([r.x1 for r in regions], dtype=numpy.float64)
+        y1 = numpy.array([r.y1 for r in regions], dtype=numpy.float64)
+        x2 = numpy.array([r.x2 for r in regions], dtype=numpy.float64)
+        y2 = numpy.array([r.y2 for r in regions], dtype=numpy.float64)
+    (lats, lons) = cuav_util.georef_points(pos, C, (x1+x2)*0.5, (y1+y2)*0.5,
+                                           altitude=altitude, shape=(width,height))
+    if is_region_array(regions):
+        regions['lat'] = lats
+        regions['lon'] = lons
+        return regions
+    for (r, lat, lon) in zip(regions, lats, lons):
+        if numpy.isnan(lat):
+            r.latlon = None
+        else:
+            r.latlon = (float(lat), float(lon))
+    return regions
+
 def filter_boundary(regions, boundary, pos=None):
     '''filter a list of regions using a search boundary'''
-    ret = []
-    for r in regions:
+    if not isinstance(boundary, cuav_util.PreparedPolygon):
+        boundary = cuav_util.PreparedPolygon(boundary, grid_size=0)
+    if is_region_array(regions):
         if pos is None:
-            continue
+            return regions[:0]
+        # a lat of nan is never inside
+        outside = ~boundary.contains(regions['lat'], regions['lon'])
         if pos.altitude < 10:
-              r.score = 0
-        #print pos
-        if r.latlon is None or cuav_util.polygon_outside(r.latlon, boundary):
+            outside[:] = True
+        regions['score'][outside] = 0
+        return regions
+    if pos is None:
+        return []
+    lats = [numpy.nan if r.latlon is None else r.latlon[0] for r in regions]
+    lons = [numpy.nan if r.latlon is None else r.latlon[1] for r in regions]
+    inside = boundary.contains(lats, lons)
+    ret = []
+    for (r, r_inside) in zip(regions, inside):
+        if pos.altitude < 10 or not r_inside:
             r.score = 0
         ret.append(r)
     return ret
 
 def filter_radius(regions, latlon, radius):
     '''filter a list of regions using a search boundary'''
+    if is_region_array(regions):
+        dist = cuav_util.gps_distance_many(latlon[0], latlon[1], regions['lat'], regions['lon'])
+        regions['score'][~(dist <= radius)] = 0
+        return regions
+    lats = [numpy.nan if r.latlon is None else r.latlon[0] for r in regions]
+    lons = [numpy.nan if r.latlon is None else r.latlon[1] for r in regions]
+    dist = cuav_util.gps_distance_many(latlon[0], latlon[1], lats, lons)
     ret = []
-    for r in regions:
-        if r.latlon is None or cuav_util.gps_distance(latlon[0], latlon[1], r.latlon[0], r.latlon[1]) > radius:
+    for (r, r_dist) in zip(regions, dist):
+        if not r_dist <= radius:
           r.score = 0
         ret.append(r)
     return ret
 
+def ThumbnailRect(region, thumb_size=100):
+    '''return the (x,y,width,height) source rectangle of the thumbnail
+    for a region. Regions larger than thumb_size get a square rectangle
+    covering the whole region, which is then shrunk to thumb_size'''
+    (x1,y1,x2,y2) = region.tuple()
+    midx = (x1+x2)//2
+    midy = (y1+y2)//2
+    if (x2-x1) > thumb_size or (y2-y1) > thumb_size:
+        rsize = max(x2+1-x1, y2+1-y1)
+    else:
+        rsize = thumb_size
+    return (midx-rsize//2, midy-rsize//2, rsize, rsize)
+
 def CompositeThumbnail(img, regions, thumb_size=100):
     '''extract a composite thumbnail for the regions of an image
 
     The composite will consist of N thumbnails side by side
     '''
-    composite = []
-    for i in range(len(regions)):
-        (x1,y1,x2,y2) = regions[i].tuple()
-        midx = (x1+x2)//2
-        midy = (y1+y2)//2
-
-        if (x2-x1) > thumb_size or (y2-y1) > thumb_size:
-            # we need to shrink the region
-            rsize = max(x2+1-x1, y2+1-y1)
-            src = cuav_util.SubImage(img, (midx-rsize//2,midy-rsize//2,rsize,rsize))
-            thumb = cv2.resize(src, (thumb_size, thumb_size))
-        else:
-            x1 = midx - thumb_size//2
-            y1 = midy - thumb_size//2
-            thumb = cuav_util.SubImage(img, (x1, y1, thumb_size, thumb_size))
-        if composite == []:
-            composite = thumb
-        else:
-            composite = numpy.concatenate((composite, thumb), axis=1)
-    return composite
+    if len(regions) == 0:
+        return []
+    rects = [ThumbnailRect(r, thumb_size) for r in regions]
+    thumbs = scanner.rect_extract_many(numpy.ascontiguousarray(img), rects, thumb_size)
+    # lay the N x size x size x 3 thumbnails out side by side
+    return thumbs.transpose(1, 0, 2, 3).reshape(thumb_size, len(regions)*thumb_size, 3)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 '''common CanberraUAV utility functions'''
 
-import numpy, cv2, math, sys, os, time, struct, calendar, re, datetime
+import numpy, cv2, math, sys, os, time, struct, calendar, re, datetime, collections, threading
 
 import six; from six.moves import cPickle as pickle
 from cuav.camera.cam_params import CameraParams
@@ -14,32 +14,30 @@ def gps_distance(lat1, lon1, lat2, lon2):
     '''return distance between two points in meters,
     coordinates are in degrees
     thanks to http://www.movable-type.co.uk/scripts/latlong.html'''
-    from math import radians, cos, sin, sqrt, atan2
-    lat1 = radians(lat1)
-    lat2 = radians(lat2)
-    lon1 = radians(lon1)
-    lon2 = radians(lon2)
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    lon1 = math.radians(lon1)
+    lon2 = math.radians(lon2)
     dLat = lat2 - lat1
     dLon = lon2 - lon1
     
-    a = sin(0.5*dLat)**2 + sin(0.5*dLon)**2 * cos(lat1) * cos(lat2)
-    c = 2.0 * atan2(sqrt(a), sqrt(1.0-a))
+    a = math.sin(0.5*dLat)**2 + math.sin(0.5*dLon)**2 * math.cos(lat1) * math.cos(lat2)
+    c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0-a))
     return radius_of_earth * c
 
 
 def gps_bearing(lat1, lon1, lat2, lon2):
     '''return bearing between two points in degrees, in range 0-360
     thanks to http://www.movable-type.co.uk/scripts/latlong.html'''
-    from math import sin, cos, atan2, radians, degrees
-    lat1 = radians(lat1)
-    lat2 = radians(lat2)
-    lon1 = radians(lon1)
-    lon2 = radians(lon2)
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    lon1 = math.radians(lon1)
+    lon2 = math.radians(lon2)
     dLat = lat2 - lat1
     dLon = lon2 - lon1    
-    y = sin(dLon) * cos(lat2)
-    x = cos(lat1)*sin(lat2) - sin(lat1)*cos(lat2)*cos(dLon)
-    bearing = degrees(atan2(y, x))
+    y = math.sin(dLon) * math.cos(lat2)
+    x = math.cos(lat1)*math.sin(lat2) - math.sin(lat1)*math.cos(lat2)*math.cos(dLon)
+    bearing = math.degrees(math.atan2(y, x))
     if bearing < 0:
         bearing += 360.0
     return bearing
@@ -49,18 +47,87 @@ def gps_newpos(lat, lon, bearing, distance):
     '''extrapolate latitude/longitude given a heading and distance 
     thanks to http://www.movable-type.co.uk/scripts/latlong.html
     '''
-    from math import sin, asin, cos, atan2, radians, degrees
-
-    lat1 = radians(lat)
-    lon1 = radians(lon)
-    brng = radians(bearing)
+    lat1 = math.radians(lat)
+    lon1 = math.radians(lon)
+    brng = math.radians(bearing)
     dr = distance/radius_of_earth
 
-    lat2 = asin(sin(lat1)*cos(dr) +
-            cos(lat1)*sin(dr)*cos(brng))
-    lon2 = lon1 + atan2(sin(brng)*sin(dr)*cos(lat1), 
-                cos(dr)-sin(lat1)*sin(lat2))
-    return (degrees(lat2), degrees(lon2))
+    lat2 = math.asin(math.sin(lat1)*math.cos(dr) +
+                     math.cos(lat1)*math.sin(dr)*math.cos(brng))
+    lon2 = lon1 + math.atan2(math.sin(brng)*math.sin(dr)*math.cos(lat1), 
+                             math.cos(dr)-math.sin(lat1)*math.sin(lat2))
+    return (math.degrees(lat2), math.degrees(lon2))
+
+
+def gps_distance_many(lat1, lon1, lat2, lon2):
+    '''return the distances in meters between arrays of points, as
+    gps_distance() does for one pair. The arguments are broadcast, so
+    a single lat1,lon1 gives the distances from one point to many.
+    Positions of nan give a distance of nan'''
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    lon1 = numpy.radians(lon1)
+    lon2 = numpy.radians(lon2)
+    dLat = lat2 - lat1
+    dLon = lon2 - lon1
+
+    a = numpy.sin(0.5*dLat)**2 + numpy.sin(0.5*dLon)**2 * numpy.cos(lat1) * numpy.cos(lat2)
+    c = 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.0-a))
+    return radius_of_earth * c
+
+
+def gps_bearing_many(lat1, lon1, lat2, lon2):
+    '''return the bearings in degrees between arrays of points, in range
+    0-360, as gps_bearing() does for one pair'''
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    lon1 = numpy.radians(lon1)
+    lon2 = numpy.radians(lon2)
+    dLon = lon2 - lon1
+    y = numpy.sin(dLon) * numpy.cos(lat2)
+    x = numpy.cos(lat1)*numpy.sin(lat2) - numpy.sin(lat1)*numpy.cos(lat2)*numpy.cos(dLon)
+    bearing = numpy.degrees(numpy.arctan2(y, x))
+    return numpy.where(bearing < 0, bearing + 360.0, bearing)
+
+
+def gps_newpos_many(lat, lon, bearing, distance):
+    '''extrapolate arrays of latitude/longitude given headings and
+    distances, as gps_newpos() does for one point. Returns a
+    (lats, lons) tuple of arrays'''
+    lat1 = numpy.radians(lat)
+    lon1 = numpy.radians(lon)
+    brng = numpy.radians(bearing)
+    dr = numpy.asarray(distance, dtype=numpy.float64)/radius_of_earth
+
+    lat2 = numpy.arcsin(numpy.sin(lat1)*numpy.cos(dr) +
+                        numpy.cos(lat1)*numpy.sin(dr)*numpy.cos(brng))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(brng)*numpy.sin(dr)*numpy.cos(lat1),
+                                numpy.cos(dr)-numpy.sin(lat1)*numpy.sin(lat2))
+    return (numpy.degrees(lat2), numpy.degrees(lon2))
+
+
+class ENUProjector(object):
+    '''project latitude/longitude to meters east and north of an origin
+    on a flat tangent plane, and back again. This is much cheaper than
+    the great circle functions, and is accurate to a few centimeters
+    within a kilometer of the origin'''
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.north_scale = math.radians(radius_of_earth)
+        self.east_scale = self.north_scale * math.cos(math.radians(lat))
+
+    def to_enu(self, lat, lon):
+        '''return (east, north) in meters of lat/lon, which may be arrays'''
+        east = (numpy.asarray(lon, dtype=numpy.float64) - self.lon) * self.east_scale
+        north = (numpy.asarray(lat, dtype=numpy.float64) - self.lat) * self.north_scale
+        return (east, north)
+
+    def from_enu(self, east, north):
+        '''return (lat, lon) of points east and north meters from the origin'''
+        lat = self.lat + numpy.asarray(north, dtype=numpy.float64) / self.north_scale
+        lon = self.lon + numpy.asarray(east, dtype=numpy.float64) / self.east_scale
+        return (lat, lon)
 
 
 
@@ -108,6 +175,90 @@ def pixel_height(height, yresolution=960, lens=4.0, sensorwidth=5.0):
     return groundwidth(height, lens=lens, sensorwidth=sensorwidth)/yresolution
 
 
+class PoseProjection(object):
+    '''the projection of image pixels onto flat ground for one camera
+    pose. The camera transform and undistortion setup are built once, so
+    projecting points only costs a matrix product, plus the undistortion
+    of the points for a lens with distortion'''
+    def __init__(self, height, pitch, roll, yaw, K, D):
+        from cuav.uav.uav import uavxfer
+
+        xfer = uavxfer()
+        xfer.setCameraMatrix(K)
+        xfer.setCameraOrientation( 0.0, 0.0, math.pi/2 )
+        xfer.setFlatEarth(0);
+        xfer.setPlatformPose(0, 0, -height, math.radians(roll), math.radians(pitch), math.radians(yaw))
+
+        self.K = numpy.array(K, dtype=numpy.float64)
+        self.D = numpy.array(D, dtype=numpy.float64)
+        self.distorted = bool(numpy.any(self.D != 0))
+
+        # the direction of a pixel in world coordinates, as in
+        # xfer.imageToWorld()
+        self.M = numpy.dot(xfer.Rp, numpy.dot(xfer.Rc, xfer.Tk_i))[:3,:3]
+        self.Xp = xfer.Xp
+        self.z = xfer.z_earth - xfer.Xp[2]
+
+    def project(self, xpos, ypos):
+        '''return (east, north) arrays of ground offsets in meters, as for
+        pixel_positions()'''
+        xpos = numpy.asarray(xpos, dtype=numpy.float64).ravel()
+        ypos = numpy.asarray(ypos, dtype=numpy.float64).ravel()
+        if self.distorted and len(xpos) > 0:
+            # compute the undistorted points for the ideal camera matrix
+            src = numpy.zeros((len(xpos), 1, 2), numpy.float32)
+            src[:,0,0] = xpos
+            src[:,0,1] = ypos
+            dst = cv2.undistortPoints(src, self.K, self.D, numpy.eye(3), self.K).reshape(-1, 2)
+            xpos = dst[:,0]
+            ypos = dst[:,1]
+
+        v_w = numpy.dot(self.M, numpy.vstack((xpos, ypos, numpy.ones(len(xpos)))))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scale = self.z / v_w[2]
+        north = scale*v_w[0] + self.Xp[0]
+        east = scale*v_w[1] + self.Xp[1]
+
+        # negative scale means camera pointing above horizon
+        # large scale means a long way away also unreliable
+        bad = ~((scale >= 0) & (scale <= 500))
+        north[bad] = numpy.nan
+        east[bad] = numpy.nan
+        return (east, north)
+
+
+# the most recently used pose projections, so all the projections for
+# one frame share the same setup
+pose_cache_size = 32
+_pose_cache = collections.OrderedDict()
+_pose_cache_lock = threading.Lock()
+
+def pose_projection(height, pitch, roll, yaw, C):
+    '''return the PoseProjection for a camera pose, from a small LRU
+    cache keyed on the pose and the camera matrix and distortion'''
+    K = numpy.asarray(C.K, dtype=numpy.float64)
+    D = numpy.asarray(C.D, dtype=numpy.float64)
+    key = (float(height), float(pitch), float(roll), float(yaw), K.tobytes(), D.tobytes())
+    with _pose_cache_lock:
+        proj = _pose_cache.pop(key, None)
+        if proj is None:
+            proj = PoseProjection(height, pitch, roll, yaw, K, D)
+        _pose_cache[key] = proj
+        while len(_pose_cache) > pose_cache_size:
+            _pose_cache.popitem(last=False)
+    return proj
+
+def pixel_positions(xpos, ypos, height, pitch, roll, yaw, C):
+    '''
+    find the offsets on the ground in meters of many pixels in a ground
+    image, as for pixel_position_matt(). xpos and ypos are arrays
+
+    return result is a tuple of arrays, with meters east and north of
+    current GPS position. Pixels looking above the horizon, or too far
+    away to be reliable, are nan
+    '''
+    return pose_projection(height, pitch, roll, yaw, C).project(xpos, ypos)
+
 def pixel_position_matt(xpos, ypos, height, pitch, roll, yaw, C):
     '''
     find the offset on the ground in meters of a pixel in a ground image
@@ -124,40 +275,10 @@ def pixel_position_matt(xpos, ypos, height, pitch, roll, yaw, C):
     return result is a tuple, with meters east and north of current GPS position
 
     '''
-    from numpy import array,eye, zeros, uint64
-    from cuav.uav.uav import uavxfer
-    from math import pi
-  
-    xfer = uavxfer()
-    xfer.setCameraMatrix(C.K)
-    xfer.setCameraOrientation( 0.0, 0.0, pi/2 )
-    xfer.setFlatEarth(0);
-    xfer.setPlatformPose(0, 0, -height, math.radians(roll), math.radians(pitch), math.radians(yaw))
-
-    # compute the undistorted points for the ideal camera matrix
-    #src = numpy.zeros((1,1,2), numpy.uint64) #cv.CreateMat(1, 1, cv.CV_64FC2)
-    src = numpy.zeros((1,1, 2), numpy.float32)
-    src[0,0] = (xpos, ypos)
-    #dst = cv.CreateMat(1, 1, cv.CV_64FC2)
-    R = eye(3)
-    K = C.K
-    D = C.D
-    dst = cv2.undistortPoints(src, K, D, R, K)
-    x = dst[0,0][0]
-    y = dst[0,0][1]
-    #print '(', xpos,',', ypos,') -> (', x, ',', y, ')'
-    # negative scale means camera pointing above horizon
-    # large scale means a long way away also unreliable
-    (joe_w, scale) = xfer.imageToWorld(x, y)
-    if (scale < 0 or scale > 500):
-      return None
-
-    #(te, tn) = pixel_position_tridge(xpos, ypos, height, pitch, roll, yaw, lens, sensorwidth, xresolution, yresolution)
-    #diff = (te-joe_w[1], tn-joe_w[0])
-    #print 'diff: ', diff
-
-    # east and north
-    return (joe_w[1], joe_w[0])
+    (east, north) = pixel_positions([xpos], [ypos], height, pitch, roll, yaw, C)
+    if numpy.isnan(east[0]):
+        return None
+    return (east[0], north[0])
 
 
 def pixel_coordinates(xpos, ypos, latitude, longitude, height, pitch, roll, yaw, C):
@@ -181,15 +302,44 @@ def pixel_coordinates(xpos, ypos, latitude, longitude, height, pitch, roll, yaw,
     '''
 
     
-    pt = pixel_position_matt(xpos, ypos, height, pitch, roll, yaw, C)
-    if pt is None:
+    (east, north) = pixel_positions([xpos], [ypos], height, pitch, roll, yaw, C)
+    (lats, lons) = georef_offsets(latitude, longitude, east, north)
+    if numpy.isnan(lats[0]):
         # its pointing into the sky
         return None
-    (xofs, yofs) = pt
+    return (lats[0], lons[0])
 
-    bearing = math.degrees(math.atan2(xofs, yofs))
-    distance = math.sqrt(xofs**2 + yofs**2)
-    return gps_newpos(latitude, longitude, bearing, distance)
+def georef_points(pos, C, xs, ys, altitude=None, shape=None):
+    '''
+    return the (lats, lons) arrays of the GPS positions of many image
+    x,y positions, given a MavPosition object. The camera transform is
+    built once for all the points
+
+    shape is the (width,height) of the image if it is not the camera
+    resolution. Points which are not on the ground are nan
+    '''
+    if C is None:
+        raise ValueError("camera parameters must be supplied")
+    xs = numpy.array(xs, dtype=numpy.float64).ravel()
+    ys = numpy.array(ys, dtype=numpy.float64).ravel()
+    if pos is None:
+        return (numpy.full(len(xs), numpy.nan), numpy.full(len(xs), numpy.nan))
+    if shape is not None:
+        (width,height) = shape
+        # assume the image came from the same camera but may no longer be original size
+        xs *= float(C.xresolution)/float(width)
+        ys *= float(C.yresolution)/float(height)
+    if altitude is None:
+        altitude = pos.altitude
+    (east, north) = pixel_positions(xs, ys, altitude, pos.pitch, pos.roll, pos.yaw, C)
+    return georef_offsets(pos.lat, pos.lon, east, north)
+
+def georef_offsets(latitude, longitude, east, north):
+    '''return the (lats, lons) arrays of points east and north meters
+    from a GPS position'''
+    bearing = numpy.degrees(numpy.arctan2(east, north))
+    distance = numpy.sqrt(east**2 + north**2)
+    return gps_newpos_many(latitude, longitude, bearing, distance)
 
 def gps_position_from_xy(x, y, pos, C=None, altitude=None, shape=None):
     '''
@@ -200,27 +350,21 @@ def gps_position_from_xy(x, y, pos, C=None, altitude=None, shape=None):
             raise ValueError("camera parameters must be supplied")
     if pos is None:
             return None
-    if shape is not None:
-            (width,height) = shape
-            # assume the image came from the same camera but may no longer be original size
-            scale_x = float(C.xresolution)/float(width)
-            scale_y = float(C.yresolution)/float(height)
-            x *= scale_x
-            y *= scale_y
-    if altitude is None:
-        altitude = pos.altitude
-    return pixel_coordinates(x, y, pos.lat, pos.lon, altitude,
-                             pos.pitch, pos.roll, pos.yaw, C)
+    (lats, lons) = georef_points(pos, C, [x], [y], altitude=altitude, shape=shape)
+    if numpy.isnan(lats[0]):
+        return None
+    return (lats[0], lons[0])
 
 def meters_per_pixel(pos, C):
         '''return meters per pixel scale given a MavPosition'''
         width=C.xresolution
         height=C.yresolution
-        p1 = gps_position_from_xy(0, height/2, pos, C=C)
-        p2 = gps_position_from_xy(width-1, height/2, pos, C=C)
-        if p1 is None or p2 is None:
+        if pos is None:
+                return None
+        (lats, lons) = georef_points(pos, C, [0, width-1], [height/2, height/2])
+        if numpy.isnan(lats).any():
                 return None
-        dist = gps_distance(p1[0], p1[1], p2[0], p2[1])
+        dist = gps_distance(lats[0], lons[0], lats[1], lons[1])
         mpp = dist / float(width)
         return mpp
         
@@ -284,11 +428,18 @@ def parse_frame_time(filename):
 def polygon_outside(P, V):
     '''return true if point is outside polygon
     P is a (x,y) tuple
-    V is a list of (x,y) tuples
+    V is a list of (x,y) tuples, or a PreparedPolygon
 
     The point in polygon algorithm is based on:
     http://www.ecse.rpi.edu/Homepages/wrf/Research/Short_Notes/pnpoly.html
     '''
+    if isinstance(V, PreparedPolygon):
+        return V.outside(P)
+    return _pnpoly_outside(P, V)
+
+
+def _pnpoly_outside(P, V):
+    '''the ray crossing test of polygon_outside()'''
     n = len(V)
     outside = True
     j = n-1
@@ -300,8 +451,8 @@ def polygon_outside(P, V):
     return outside
 
 
-def polygon_load(filename):
-    '''load a polygon from a file'''
+def polygon_load(filename, grid_size=64):
+    '''load a polygon from a file, as a PreparedPolygon'''
     ret = []
     f = open(filename)
     for line in f:
@@ -315,7 +466,7 @@ def polygon_load(filename):
             raise RuntimeError("invalid polygon line: %s" % line)
         ret.append((float(a[0]), float(a[1])))
     f.close()
-    return ret
+    return PreparedPolygon(ret, grid_size=grid_size)
 
 
 def polygon_complete(V):
@@ -329,6 +480,117 @@ def polygon_complete(V):
     return (len(V) >= 4 and V[-1][0] == V[0][0] and V[-1][1] == V[0][1])
 
 
+class PreparedPolygon(tuple):
+    '''a polygon of (x,y) points with its edges kept as arrays, for
+    testing many points at once. The grid_size by grid_size grid over
+    the bounding box marks the cells which are wholly inside or
+    outside, so only points in cells crossed by an edge need the full
+    test. The result is the same as polygon_outside() on the points'''
+
+    # a grid cell is inside, outside, or crossed by an edge
+    CELL_OUTSIDE = 0
+    CELL_INSIDE = 1
+    CELL_BOUNDARY = 2
+
+    def __new__(cls, V, grid_size=64):
+        return tuple.__new__(cls, [tuple(p) for p in V])
+
+    def __init__(self, V, grid_size=64):
+        pts = numpy.array(self, dtype=numpy.float64).reshape(-1, 2)
+        # edge i runs from vertex j=i-1 to vertex i, as in polygon_outside()
+        xi = pts[:,0]
+        yi = pts[:,1]
+        xj = numpy.roll(xi, 1)
+        yj = numpy.roll(yi, 1)
+        # horizontal edges are never crossed
+        keep = yi != yj
+        self.edges = (xi[keep], yi[keep], xj[keep], yj[keep])
+        if len(pts) > 0:
+            self.bounds = (xi.min(), yi.min(), xi.max(), yi.max())
+        else:
+            self.bounds = (0.0, 0.0, -1.0, -1.0)
+        self.grid_size = grid_size
+        self.grid = None
+        if grid_size > 0 and len(pts) > 0:
+            self._make_grid()
+
+    def __getnewargs__(self):
+        return (tuple(self), self.grid_size)
+
+    def _crossings(self, x, y):
+        '''return True for each point with an odd number of edge crossings'''
+        odd = numpy.zeros(numpy.shape(x), dtype=bool)
+        for (xi, yi, xj, yj) in zip(*self.edges):
+            odd ^= ((yi > y) != (yj > y)) & (x < (xj-xi) * (y-yi) / (yj-yi) + xi)
+        return odd
+
+    def _make_grid(self):
+        '''mark each grid cell as inside, outside or on the boundary'''
+        (x1, y1, x2, y2) = self.bounds
+        n = self.grid_size
+        self.cell_w = max((x2 - x1) / n, 1.0e-12)
+        self.cell_h = max((y2 - y1) / n, 1.0e-12)
+        # cells are widened a little so rounding can't hide an edge
+        eps = 1.0e-9 * max(x2 - x1, y2 - y1, 1.0e-12)
+        cx1 = x1 + numpy.arange(n)[:,None] * self.cell_w - eps
+        cy1 = y1 + numpy.arange(n)[None,:] * self.cell_h - eps
+        cx2 = cx1 + self.cell_w + 2*eps
+        cy2 = cy1 + self.cell_h + 2*eps
+        boundary = numpy.zeros((n, n), dtype=bool)
+        (xi, yi, xj, yj) = self.edges
+        for (ax, ay, bx, by) in zip(xi, yi, xj, yj):
+            # the edge crosses a cell if their bounding boxes overlap and
+            # the corners of the cell are not all on one side of it
+            near = ((cx1 <= max(ax, bx)) & (cx2 >= min(ax, bx)) &
+                    (cy1 <= max(ay, by)) & (cy2 >= min(ay, by)))
+            sides = [numpy.sign((bx-ax)*(cy-ay) - (by-ay)*(cx-ax))
+                     for (cx, cy) in [(cx1, cy1), (cx1, cy2), (cx2, cy1), (cx2, cy2)]]
+            one_side = ((sides[0] == sides[1]) & (sides[0] == sides[2]) &
+                        (sides[0] == sides[3]) & (sides[0] != 0))
+            boundary |= near & ~one_side
+        # the rest of each cell is on the same side as its center
+        mx = numpy.broadcast_to(x1 + (numpy.arange(n)[:,None] + 0.5) * self.cell_w, (n, n))
+        my = numpy.broadcast_to(y1 + (numpy.arange(n)[None,:] + 0.5) * self.cell_h, (n, n))
+        self.grid = numpy.where(self._crossings(mx, my), self.CELL_INSIDE, self.CELL_OUTSIDE).astype(numpy.uint8)
+        self.grid[boundary] = self.CELL_BOUNDARY
+
+    def contains(self, x, y):
+        '''return a boolean array which is True for the points (x,y) inside
+        the polygon. x and y may be arrays'''
+        (x, y) = numpy.broadcast_arrays(numpy.asarray(x, dtype=numpy.float64),
+                                        numpy.asarray(y, dtype=numpy.float64))
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        (x1, y1, x2, y2) = self.bounds
+        inside = numpy.zeros(x.shape, dtype=bool)
+        check = (x >= x1) & (x <= x2) & (y >= y1) & (y <= y2)
+        if self.grid is not None:
+            n = self.grid_size
+            gx = numpy.clip(((x[check] - x1) / self.cell_w).astype(numpy.int64), 0, n-1)
+            gy = numpy.clip(((y[check] - y1) / self.cell_h).astype(numpy.int64), 0, n-1)
+            cell = self.grid[gx, gy]
+            inside[check] = cell == self.CELL_INSIDE
+            check[check] = cell == self.CELL_BOUNDARY
+        inside[check] = self._crossings(x[check], y[check])
+        return inside.reshape(shape)
+
+    def outside(self, P):
+        '''return true if the (x,y) point P is outside the polygon'''
+        (x, y) = (P[0], P[1])
+        (x1, y1, x2, y2) = self.bounds
+        if not (x1 <= x <= x2 and y1 <= y <= y2):
+            return True
+        if self.grid is not None:
+            n = self.grid_size
+            gx = min(max(int((x - x1) / self.cell_w), 0), n-1)
+            gy = min(max(int((y - y1) / self.cell_h), 0), n-1)
+            cell = self.grid[gx, gy]
+            if cell != self.CELL_BOUNDARY:
+                return bool(cell == self.CELL_OUTSIDE)
+        return _pnpoly_outside(P, self)
+
+
 def image_shape(img):
     '''return (w,h) of an image, coping with different image formats'''
     height, width = img.shape[:2]
@@ -341,6 +603,89 @@ def image_width(img):
     return getattr(img, 'width')
 
 
+def jpeg_shape(filename):
+    '''return (w,h) of a JPEG file from its frame header, without
+    decoding the image. Returns None if the file is not a JPEG'''
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                if f.read(1) != b'\xff':
+                    return None
+                marker = ord(f.read(1))
+                while marker == 0xff:
+                    # fill bytes before the marker
+                    marker = ord(f.read(1))
+                if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+                    # markers without a segment
+                    continue
+                (seglen,) = struct.unpack('>H', f.read(2))
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    # start of frame: precision, height, width
+                    (height, width) = struct.unpack('>xHH', f.read(5))
+                    return (width, height)
+                f.seek(seglen-2, 1)
+    except (IOError, OSError, TypeError, struct.error):
+        return None
+
+
+class ImageFile(object):
+    '''an image file which is decoded lazily, at the resolution it is
+    needed at. JPEG images are decoded at 1/2, 1/4 or 1/8 scale in the
+    DCT domain, which is much cheaper than a full decode followed by
+    a resize. The full resolution image is only decoded if full() is
+    called'''
+    reduced_flags = {
+        2 : cv2.IMREAD_REDUCED_COLOR_2,
+        4 : cv2.IMREAD_REDUCED_COLOR_4,
+        8 : cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def __init__(self, filename, flags=cv2.IMREAD_COLOR, rotate180=False):
+        self.filename = filename
+        self.flags = flags
+        self.rotate180 = rotate180
+        self.jpeg_shape = jpeg_shape(filename)
+        self.images = {}
+
+    def shape(self):
+        '''return (w,h) of the full resolution image, or None if the
+        image can't be loaded'''
+        if self.jpeg_shape is not None:
+            return self.jpeg_shape
+        img = self.full()
+        if img is None:
+            return None
+        return image_shape(img)
+
+    def full(self):
+        '''return the full resolution image, or None if it can't be loaded'''
+        return self.scaled(1)
+
+    def scaled(self, scale):
+        '''return the image at 1/scale of full resolution, or None if it
+        can't be loaded'''
+        if scale in self.images:
+            return self.images[scale]
+        if scale == 1:
+            img = cv2.imread(self.filename, self.flags)
+            if img is not None and self.rotate180:
+                img = cv2.rotate(img, cv2.ROTATE_180)
+        elif (self.jpeg_shape is not None and scale in self.reduced_flags and
+              1 not in self.images and self.flags in (cv2.IMREAD_COLOR, cv2.IMREAD_UNCHANGED)):
+            img = cv2.imread(self.filename, self.reduced_flags[scale])
+            if img is not None and self.rotate180:
+                img = cv2.rotate(img, cv2.ROTATE_180)
+        else:
+            img = self.full()
+            if img is not None:
+                img = cv2.resize(img, (0,0), fx=1.0/scale, fy=1.0/scale,
+                                 interpolation=cv2.INTER_AREA)
+        self.images[scale] = img
+        return img
+
+
 def SubImage(src, region):
     '''return a subimage as a new image. This allows
     for the region going past the edges.
@@ -2,6 +2,7 @@
 
 import sys, os, time, math, datetime, re
 import fractions
+import numpy
 
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from pymavlink import mavutil
@@ -37,6 +38,27 @@ class MavPosition():
             self.lat, self.lon, self.altitude,
             self.roll, self.pitch, self.yaw)
 
+# the array form of a list of MavPosition objects, from
+# MavInterpolator.position_many(). A lat of nan is a time with no position
+position_dtype = numpy.dtype([('time', numpy.float64),
+                              ('lat', numpy.float64), ('lon', numpy.float64),
+                              ('altitude', numpy.float64),
+                              ('roll', numpy.float64), ('pitch', numpy.float64),
+                              ('yaw', numpy.float64)])
+
+def PositionsFromArray(positions):
+    '''convert an array of position_dtype to a list of MavPosition
+    objects, with None for the times with no position'''
+    ret = []
+    for p in positions:
+        if numpy.isnan(p['lat']):
+            ret.append(None)
+        else:
+            ret.append(MavPosition(float(p['lat']), float(p['lon']), float(p['altitude']),
+                                   float(p['roll']), float(p['pitch']), float(p['yaw']),
+                                   float(p['time'])))
+    return ret
+
 class JitterCorrection():
     def __init__(self):
         self.max_lag_s = 60.0
@@ -98,14 +120,142 @@ class JitterCorrection():
         return estimate_s
     
     
+class MavHistoryMsg(object):
+    '''a message from a MavHistory loaded from a log index, holding
+    the indexed fields of the message'''
+    def __init__(self, type, timestamp, values):
+        self.__dict__.update(values)
+        self._type = type
+        self._timestamp = timestamp
+
+    def get_type(self):
+        return self._type
+
+
+class MavHistory(object):
+    '''the recent history of one type of mavlink message. The timestamps
+    and fields of the messages are kept in parallel numpy arrays so the
+    message at a time can be found with a binary search.
+
+    The arrays hold twice the capacity. When the end is reached the
+    newest messages are moved back to the start, so adding a message
+    is O(1) on average'''
+    def __init__(self, fields, capacity, type=None):
+        self.type = type
+        self.fields = fields
+        self.capacity = max(capacity, 1)
+        size = 2*self.capacity
+        self._timestamps = numpy.zeros(size)
+        self._values = dict((f, numpy.zeros(size)) for f in fields)
+        self._msgs = numpy.empty(size, dtype=object)
+        self._start = 0
+        self._end = 0
+        # number of messages older than the message before them
+        self._unordered = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, i):
+        '''return the i'th oldest message'''
+        i = range(self._start, self._end)[i]
+        if self._msgs is None or self._msgs[i] is None:
+            return MavHistoryMsg(self.type, float(self._timestamps[i]),
+                                 dict((f, float(self._values[f][i])) for f in self.fields))
+        return self._msgs[i]
+
+    def load(self, timestamps, values):
+        '''replace the history with the arrays of timestamps and field
+        values of every message in a log, as from a TlogIndex. The
+        arrays are used in place, so may be memory mapped and read only.
+        They are copied if a message is added later'''
+        self._timestamps = timestamps
+        self._values = dict((f, values[f]) for f in self.fields)
+        self._msgs = None
+        self._start = 0
+        self._end = len(timestamps)
+        self.capacity = max(len(timestamps), 1)
+        self._unordered = int(numpy.count_nonzero(timestamps[1:] < timestamps[:-1]))
+
+    def timestamps(self):
+        '''return the array of message timestamps, oldest first'''
+        return self._timestamps[self._start:self._end]
+
+    def values(self, field):
+        '''return the array of values of a message field, oldest first'''
+        return self._values[field][self._start:self._end]
+
+    def append(self, msg, timestamp):
+        '''add a message with the given timestamp, dropping the oldest
+        message if the history is full'''
+        if self._msgs is None:
+            self._unload()
+        if self._end == len(self._timestamps):
+            self._compact()
+        end = self._end
+        if end > self._start and timestamp < self._timestamps[end-1]:
+            self._unordered += 1
+        self._timestamps[end] = timestamp
+        for f in self.fields:
+            self._values[f][end] = getattr(msg, f)
+        self._msgs[end] = msg
+        self._end += 1
+        if len(self) > self.capacity:
+            start = self._start
+            if self._timestamps[start+1] < self._timestamps[start]:
+                self._unordered -= 1
+            self._msgs[start] = None
+            self._start += 1
+
+    def _unload(self):
+        '''copy loaded arrays into arrays of twice the capacity which
+        can be added to. The loaded messages have no message objects'''
+        n = len(self)
+        size = 2*self.capacity
+        timestamps = numpy.zeros(size)
+        timestamps[:n] = self._timestamps[self._start:self._end]
+        values = {}
+        for f in self.fields:
+            values[f] = numpy.zeros(size)
+            values[f][:n] = self._values[f][self._start:self._end]
+        self._timestamps = timestamps
+        self._values = values
+        self._msgs = numpy.empty(size, dtype=object)
+        self._start = 0
+        self._end = n
+
+    def _compact(self):
+        '''move the messages back to the start of the arrays'''
+        n = len(self)
+        self._timestamps[:n] = self._timestamps[self._start:self._end]
+        for v in self._values.values():
+            v[:n] = v[self._start:self._end]
+        self._msgs[:n] = self._msgs[self._start:self._end]
+        self._msgs[n:] = None
+        self._start = 0
+        self._end = n
+
+    def find(self, t):
+        '''return the index of the newest message at or before time t,
+        or -1 if there is none'''
+        ts = self.timestamps()
+        if self._unordered == 0:
+            return int(numpy.searchsorted(ts, t, side='right')) - 1
+        # only possible without jitter correction
+        idx = numpy.flatnonzero(ts <= t)
+        if len(idx) == 0:
+            return -1
+        return int(idx[-1])
+
+
 class MavInterpolator():
     '''a class to interpolate position and attitude from a
     series of mavlink messages'''
     def __init__(self, backlog=500, gps_lag=0):
         self.backlog = backlog
-        self.attitude = []
-        self.global_position_int = []
-        self.terrain_report = []
+        self.attitude = MavHistory(['roll', 'pitch', 'yaw'], backlog, 'ATTITUDE')
+        self.global_position_int = MavHistory(['lat', 'lon', 'relative_alt'], backlog, 'GLOBAL_POSITION_INT')
+        self.terrain_report = MavHistory(['lat', 'lon', 'current_height'], backlog, 'TERRAIN_REPORT')
         self.msg_map = {
             'GLOBAL_POSITION_INT' : self.global_position_int,
             'ATTITUDE' : self.attitude,
@@ -125,11 +275,11 @@ class MavInterpolator():
         if not type in self.msg_map:
             raise MavInterpolatorException('no msgs of type %s' % type)
         a = self.msg_map[type]
-        for i in range(len(a)-1, -1, -1):
-            if a[i]._timestamp <= t:
-                return i
+        i = a.find(t)
+        if i >= 0:
+            return i
         if len(a) > 0:
-            last_timestamp = time.asctime(time.localtime(a[-1]._timestamp))
+            last_timestamp = time.asctime(time.localtime(a.timestamps()[-1]))
         else:
             last_timestamp = ''
         raise MavInterpolatorException('no msgs of type %s before %s last=%s' % (
@@ -146,12 +296,6 @@ class MavInterpolator():
     def add_msg(self, msg):
         '''add in a mavlink message'''
         type = msg.get_type()
-        if type in self.msg_map:
-            '''add it to the history'''
-            self.msg_map[type].append(msg)
-            '''keep self.backlog messages around of each type'''
-            while len(self.msg_map[type]) > self.backlog:
-                self.msg_map[type].pop(0)
         if self.jitter_correction:
             if type in ['ATTITUDE', 'GLOBAL_POSITION_INT']:
                 timestamp_corrected = self.jitter.correct_timestamp(msg.time_boot_ms*0.001, msg._timestamp)
@@ -159,6 +303,9 @@ class MavInterpolator():
                 msg._timestamp = timestamp_corrected
             else:
                 msg._timestamp = self.jitter.correct_local(msg._timestamp)
+        if type in self.msg_map:
+            '''add it to the history, which keeps self.backlog messages of each type'''
+            self.msg_map[type].append(msg, msg._timestamp)
             
     def _altitude(self, GLOBAL_POSITION_INT, TERRAIN_REPORT):
         '''get height above the ground'''
@@ -191,12 +338,14 @@ class MavInterpolator():
         '''find interpolated value for a field'''
         i = self._find_msg_idx(type, t)
         a = self.msg_map[type]
+        v = a.values(field)
         if i == len(a)-1:
-            return getattr(a[i], field)
-        v1 = getattr(a[i], field)
-        v2 = getattr(a[i+1], field)
-        t1 = a[i]._timestamp
-        t2 = a[i+1]._timestamp
+            return float(v[i])
+        v1 = float(v[i])
+        v2 = float(v[i+1])
+        ts = a.timestamps()
+        t1 = float(ts[i])
+        t2 = float(ts[i+1])
         if max_deltat != 0 and t2 - t1 > max_deltat:
             raise MavInterpolatorDeltaTException('exceeded max_deltat %.1f' % (t2-t1))
         return v1 + ((t-t1)/(t2-t1))*(v2-v1)
@@ -205,17 +354,19 @@ class MavInterpolator():
         '''find interpolated value for a angle field in range -pi to pi'''
         i = self._find_msg_idx(type, t)
         a = self.msg_map[type]
+        v = a.values(field)
         if i == len(a)-1:
-            return getattr(a[i], field)
-        v1 = getattr(a[i], field)
-        v2 = getattr(a[i+1], field)
+            return float(v[i])
+        v1 = float(v[i])
+        v2 = float(v[i+1])
         if abs(v1 - v2) > math.pi:
             if v1 < v2:
                 v1 += 2*math.pi
             else:
                 v2 += 2*math.pi
-        t1 = a[i]._timestamp
-        t2 = a[i+1]._timestamp
+        ts = a.timestamps()
+        t1 = float(ts[i])
+        t2 = float(ts[i+1])
         if max_deltat != 0 and t2 - t1 > max_deltat:
             raise MavInterpolatorDeltaTException('exceeded max_deltat %.1f' % (t2-t1))
         ret = v1 + ((t-t1)/(t2-t1))*(v2-v1)
@@ -279,8 +430,156 @@ class MavInterpolator():
 
         return MavPosition(lat, lon, altitude, roll, pitch, yaw, t)
     
-    def set_logfile(self, filename):
-        '''provide a mavlink logfile for data'''
+    def _find_msg_idx_many(self, type, t):
+        '''find the index of the msg just before each time in the array t,
+        -1 where there is none'''
+        a = self.msg_map[type]
+        if a._unordered == 0:
+            return numpy.searchsorted(a.timestamps(), t, side='right') - 1
+        return numpy.array([a.find(x) for x in t], dtype=numpy.int64)
+
+    def _interpolate_many(self, type, field, t, max_deltat=0, angle=False):
+        '''find interpolated values of a field for an array of times, as
+        interpolate() or interpolate_angle() does for one time. Returns
+        the values and a boolean array of the times which have a value'''
+        a = self.msg_map[type]
+        i = self._find_msg_idx_many(type, t)
+        valid = i >= 0
+        if len(a) == 0:
+            return (numpy.full(len(t), numpy.nan), valid)
+        i = numpy.maximum(i, 0)
+        # past the last message the value of the last message is used
+        i2 = numpy.minimum(i+1, len(a)-1)
+        v = a.values(field)
+        ts = a.timestamps()
+        (v1, v2) = (v[i], v[i2])
+        (t1, t2) = (ts[i], ts[i2])
+        if angle:
+            wrap = numpy.abs(v1 - v2) > math.pi
+            lower = v1 < v2
+            v1 = numpy.where(wrap & lower, v1 + 2*math.pi, v1)
+            v2 = numpy.where(wrap & ~lower, v2 + 2*math.pi, v2)
+        if max_deltat != 0:
+            valid &= ~(t2 - t1 > max_deltat)
+        last = i == i2
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ret = numpy.where(last, v1, v1 + ((t-t1)/(t2-t1))*(v2-v1))
+        if angle:
+            ret = numpy.where(~last & (ret > math.pi), ret - 2*math.pi, ret)
+        return (ret, valid)
+
+    def _stabilise(self, angle, maxangle):
+        '''remove the part of the angles that the camera stabilisation
+        system can take care of'''
+        return numpy.where(numpy.abs(angle) < maxangle, 0.0,
+                           numpy.where(angle >= maxangle, angle - maxangle, angle + maxangle))
+
+    def _position_many(self, t, max_deltat=0, roll=None, pitch=None, maxroll=0, maxpitch=0, pitch_offset=0, roll_offset=0):
+        '''return position_dtype estimates for a sorted array of times
+        using the messages already in the history'''
+        ret = numpy.empty(len(t), dtype=position_dtype)
+        ret['time'] = t
+        if len(self.global_position_int) == 0 or len(self.attitude) == 0:
+            for f in ['lat', 'lon', 'altitude', 'roll', 'pitch', 'yaw']:
+                ret[f] = numpy.nan
+            return ret
+
+        # interpolate our latitude/longitude
+        (lat, valid) = self._interpolate_many('GLOBAL_POSITION_INT', 'lat', t, max_deltat)
+        (lon, _) = self._interpolate_many('GLOBAL_POSITION_INT', 'lon', t, max_deltat)
+        lat *= 1.0e-7
+        lon *= 1.0e-7
+
+        # get altitude
+        gps = self._find_msg_idx_many('GLOBAL_POSITION_INT', t + self.gps_lag)
+        valid &= gps >= 0
+        altitude = self.global_position_int.values('relative_alt')[numpy.maximum(gps, 0)]*0.001
+
+        if len(self.terrain_report) > 0:
+            tr = self._find_msg_idx_many('TERRAIN_REPORT', t)
+            valid &= tr >= 0
+            tr = numpy.maximum(tr, 0)
+            tlat = self.terrain_report.values('lat')[tr]/1.0e7
+            tlon = self.terrain_report.values('lon')[tr]/1.0e7
+            tt = self.terrain_report.timestamps()[tr]
+            # don't use it if its too far away
+            use = ~((cuav_util.gps_distance_many(lat, lon, tlat, tlon) > 150) |
+                    (numpy.abs(tt - t) > 5))
+            altitude = numpy.where(use, self.terrain_report.values('current_height')[tr], altitude)
+
+        # and attitude
+        if roll is None:
+            (roll, roll_valid) = self._interpolate_many('ATTITUDE', 'roll', t, max_deltat, angle=True)
+            roll = numpy.degrees(roll)
+            valid &= roll_valid
+        roll = self._stabilise(numpy.broadcast_to(numpy.float64(roll), t.shape), maxroll)
+        if pitch is None:
+            (pitch, pitch_valid) = self._interpolate_many('ATTITUDE', 'pitch', t, max_deltat, angle=True)
+            pitch = numpy.degrees(pitch)
+            valid &= pitch_valid
+        pitch = self._stabilise(numpy.broadcast_to(numpy.float64(pitch), t.shape), maxpitch)
+        (yaw, yaw_valid) = self._interpolate_many('ATTITUDE', 'yaw', t, max_deltat, angle=True)
+        valid &= yaw_valid
+
+        ret['lat'] = lat
+        ret['lon'] = lon
+        ret['altitude'] = altitude
+        # add pitch and roll offset
+        ret['roll'] = roll + roll_offset
+        ret['pitch'] = pitch + pitch_offset
+        ret['yaw'] = numpy.degrees(yaw)
+        for f in ['lat', 'lon', 'altitude', 'roll', 'pitch', 'yaw']:
+            ret[f][~valid] = numpy.nan
+        return ret
+
+    def position_many(self, times, max_deltat=0, roll=None, pitch=None, maxroll=0, maxpitch=0, pitch_offset=0, roll_offset=0):
+        '''return an array of position_dtype estimates for an array of
+        times, in the same order. Each position is the one position()
+        gives for that time, with the log read forward once for the
+        times in time order. Times with no position have a lat of nan'''
+        times = numpy.asarray(times, dtype=numpy.float64).ravel()
+        order = numpy.argsort(times, kind='mergesort')
+        t = times[order]
+        ret = numpy.empty(len(t), dtype=position_dtype)
+        i = 0
+        while i < len(t):
+            if self.advance_log(t[i]) is not None or self.mlog is None:
+                # no more messages will arrive
+                j = len(t)
+            elif len(self.global_position_int) == 0 or len(self.attitude) == 0:
+                j = i+1
+            else:
+                # the history now covers every time up to the newest
+                # messages, so position() would not read any more of the log
+                newest = min(self.global_position_int.timestamps()[-1], self.attitude.timestamps()[-1])
+                j = max(int(numpy.searchsorted(t, newest, side='right')), i+1)
+            ret[order[i:j]] = self._position_many(t[i:j], max_deltat, roll, pitch, maxroll, maxpitch,
+                                                  pitch_offset, roll_offset)
+            i = j
+        return ret
+
+    def set_logfile(self, filename, use_index=False):
+        '''provide a mavlink logfile for data
+
+        With use_index the log is indexed once with tlog_index, and the
+        whole log is then available for any time without reading it.
+        The index is kept in a LOG.idx directory beside the log. It is
+        built with the jitter_correction setting at the time of the call'''
+        if use_index:
+            from cuav.lib import tlog_index
+            types = dict((type, h.fields) for (type, h) in self.msg_map.items())
+            try:
+                index = tlog_index.load_index(filename, types=types)
+            except (IOError, OSError) as e:
+                print("Unable to index %s: %s" % (filename, e))
+                index = None
+            if index is not None:
+                self.mlog = None
+                for (type, h) in self.msg_map.items():
+                    if type in index:
+                        timestamps = index.timestamps(type, corrected=self.jitter_correction)
+                        h.load(timestamps, dict((f, index.column(type, f)) for f in h.fields))
+                return
         self.mlog = mavutil.mavlogfile(filename)
         
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+a columnar index of the messages in a telemetry log
+
+The numeric fields of each message type are stored as one .npy file
+per field in a directory beside the log, which is memory mapped when
+it is loaded. The index remembers the size and modification time of
+the log, and is rebuilt when the log changes. This makes loading a
+log O(1), and any time in the log can be found with a binary search
+'''
+
+import os, json, array, numbers, numpy
+from pymavlink import mavutil
+from cuav.lib import mav_position
+
+index_version = 1
+
+# message types whose timestamps are corrected with the time_boot_ms
+# of the message, as in MavInterpolator.add_msg()
+jitter_types = ['ATTITUDE', 'GLOBAL_POSITION_INT']
+
+
+def index_path(filename):
+    '''return the directory holding the index of a log'''
+    return filename + '.idx'
+
+
+def _log_stat(filename):
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
+
+def _numeric_fields(msg):
+    '''return the fields of a message which are plain numbers'''
+    ret = []
+    for f in msg.get_fieldnames():
+        v = getattr(msg, f, None)
+        if isinstance(v, numbers.Real) and not isinstance(v, bool):
+            ret.append(f)
+    return ret
+
+
+def interpolator_types():
+    '''return the message types and fields MavInterpolator uses'''
+    return dict((type, h.fields) for (type, h) in mav_position.MavInterpolator().msg_map.items())
+
+
+class TlogIndex(object):
+    '''the index of a telemetry log. For each message type there is a
+    column of the log timestamps, the timestamps corrected for link
+    jitter, and each indexed field'''
+    def __init__(self, filename, path, meta):
+        self.filename = filename
+        self.path = path
+        self.meta = meta
+        self.types = meta['types']
+        self._columns = {}
+
+    def __contains__(self, type):
+        return type in self.types
+
+    def count(self, type):
+        '''return the number of messages of a type'''
+        if not type in self.types:
+            return 0
+        return self.types[type]['count']
+
+    def fields(self, type):
+        '''return the indexed fields of a message type'''
+        return self.types[type]['fields']
+
+    def column(self, type, field):
+        '''return the memory mapped array of a field of a message type'''
+        key = (type, field)
+        if not key in self._columns:
+            fname = os.path.join(self.path, '%s.%s.npy' % (type, field))
+            self._columns[key] = numpy.load(fname, mmap_mode='r')
+        return self._columns[key]
+
+    def timestamps(self, type, corrected=True):
+        '''return the array of message timestamps of a type. The
+        corrected timestamps are those MavInterpolator uses with jitter
+        correction enabled'''
+        if corrected:
+            return self.column(type, 'timestamp')
+        return self.column(type, '_timestamp')
+
+    def find(self, type, t, corrected=True):
+        '''return the index of the last message of a type at or before
+        time t, or -1 if there is none'''
+        return int(numpy.searchsorted(self.timestamps(type, corrected), t, side='right')) - 1
+
+    def covers(self, types):
+        '''return True if the index holds the fields of a dictionary of
+        message types to field lists, for the types in the log'''
+        if self.meta.get('all_types', False):
+            return True
+        for (type, fields) in types.items():
+            if type in self.types and fields is not None and not set(fields).issubset(self.types[type]['fields']):
+                return False
+            if not type in self.types and not type in self.meta['requested']:
+                return False
+        return True
+
+
+def build_index(filename, types=None, path=None):
+    '''index a telemetry log, returning a TlogIndex. types is a
+    dictionary of message types to the fields to index, or None for all
+    the numeric fields of every message type. A field list of None
+    indexes all the numeric fields of that type'''
+    if path is None:
+        path = index_path(filename)
+    (size, mtime) = _log_stat(filename)
+
+    mlog = mavutil.mavlink_connection(filename)
+    jitter = mav_position.JitterCorrection()
+    fields = {}
+    # one array of doubles per column, filled as the log is read
+    columns = {}
+    while True:
+        msg = mlog.recv_match()
+        if msg is None:
+            break
+        type = msg.get_type()
+        # the timestamps are corrected as MavInterpolator.add_msg() does
+        if type in jitter_types:
+            timestamp = jitter.correct_timestamp(msg.time_boot_ms*0.001, msg._timestamp)
+        else:
+            timestamp = jitter.correct_local(msg._timestamp)
+        if type == 'BAD_DATA':
+            continue
+        if types is not None and not type in types:
+            continue
+        if not type in fields:
+            if types is None or types[type] is None:
+                fields[type] = _numeric_fields(msg)
+            else:
+                fields[type] = list(types[type])
+            columns[type] = [array.array('d') for i in range(len(fields[type])+2)]
+        cols = columns[type]
+        cols[0].append(msg._timestamp)
+        cols[1].append(timestamp)
+        for i in range(len(fields[type])):
+            cols[i+2].append(getattr(msg, fields[type][i]))
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    meta = {
+        'version' : index_version,
+        'size' : size,
+        'mtime' : mtime,
+        'all_types' : types is None,
+        'requested' : sorted(types.keys()) if types is not None else [],
+        'types' : {}
+        }
+    for (type, cols) in columns.items():
+        names = ['_timestamp', 'timestamp'] + fields[type]
+        for i in range(len(names)):
+            a = numpy.frombuffer(cols[i], dtype=numpy.float64)
+            numpy.save(os.path.join(path, '%s.%s.npy' % (type, names[i])), a)
+        meta['types'][type] = {
+            'fields' : fields[type],
+            'count' : len(cols[0]),
+            }
+    # the metadata is written last, so a partly written index is never used
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return TlogIndex(filename, path, meta)
+
+
+def load_index(filename, types=None, path=None, build=True):
+    '''return the TlogIndex of a log, building it if there is no index
+    or the log has changed since it was indexed. types is a dictionary
+    of the message types and fields that are needed, or None for all of
+    them. A new index only holds the types asked for. Returns None if
+    there is no usable index and build is False'''
+    if path is None:
+        path = index_path(filename)
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        index = TlogIndex(filename, path, meta)
+        if (meta['version'] == index_version and
+            (meta['size'], meta['mtime']) == _log_stat(filename) and
+            (types is None and meta['all_types'] or types is not None and index.covers(types))):
+            return index
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    if not build:
+        return None
+    return build_index(filename, types=types, path=path)
@@ -11,7 +11,7 @@ them in realtime, geotags and sends to the GCS'''
 #    - add ability to lower score and get past images sent
 
 import time, threading, sys, os, numpy, pickle
-import functools, cv2, pkg_resources
+import functools, cv2, pkg_resources, collections
 
 try:
     # py2
@@ -46,6 +46,8 @@ class CameraAirModule(mp_module.MPModule):
         self.handled_timestamps = {}
         self.imagefilenamemapping = {}
         self.posmapping = {}
+        # intermediate scan images of recent frames, oldest first
+        self.captured_stages = collections.OrderedDict()
         self.is_armed = True
         self.lz = cuav_landingregion.LandingZone()
 
@@ -62,6 +64,10 @@ class CameraAirModule(mp_module.MPModule):
               MPSetting('filter_type', str, 'simple', 'Filter Type',
                         choice=['simple'], tab='Imaging'),
               MPSetting('blue_emphasis', bool, False, 'BlueEmphasis', tab='Imaging'),
+              MPSetting('scan_threads', int, 1, 'Scanner threads', range=(1,16), increment=1, tab='Imaging'),
+              MPSetting('scan_pyramid', int, 1, 'Scan downsample factor', choice=[1,2,4], tab='Imaging'),
+              MPSetting('scan_scale', int, 1, 'Scan at reduced decode resolution', choice=[1,2,4], tab='Imaging'),
+              MPSetting('scan_capture', int, 0, 'Frames to keep intermediate scan images of', range=(0,20), increment=1, tab='Imaging'),
               MPSetting('use_capture_time', bool, True, 'Use Capture Time (false for sim)', tab='Simulation'),
               MPSetting('target_latitude', float, 0, 'filter detected images to latitude', tab='Filter to Location'),
               MPSetting('target_longitude', float, 0, 'filter detected images to longitude', tab='Filter to Location'),
@@ -93,6 +99,7 @@ class CameraAirModule(mp_module.MPModule):
               MPSetting('MaxRegionSize', float, 1.0, range=(0,100), increment=0.1, digits=1, tab='Image Processing'),
               MPSetting('MaxRarityPct',  float, 0.02, range=(0,100), increment=0.01, digits=2, tab='Image Processing'),
               MPSetting('RegionMergeSize', float, 1.0, range=(0,100), increment=0.1, digits=1, tab='Image Processing'),
+              MPSetting('HistogramDecay', float, 0.0, range=(0,0.99), increment=0.05, digits=2, tab='Image Processing'),
               ],
             title='Image Settings')
 
@@ -102,6 +109,8 @@ class CameraAirModule(mp_module.MPModule):
         self.error_msg = None
         self.region_count = 0
         self.scan_fps = 0
+        self.scanner = None
+        self.scanner_parms = None
         self.scan_queue = multiproc.Queue()
         self.transmit_queue = multiproc.Queue()
         self.have_set_gps_time = False
@@ -171,7 +180,7 @@ class CameraAirModule(mp_module.MPModule):
                 return
             if self.running == False:
                 self.running = True
-                self.joelog = cuav_joe.JoeLog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'), append=self.continue_mode)
+                self.open_joelog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'))
                 self.capture_thread = self.start_thread(self.capture_threadfunc)
                 self.scan_thread = self.start_thread(self.scan_threadfunc)
                 self.transmit_thread = self.start_thread(self.transmit_threadfunc)
@@ -216,7 +225,7 @@ class CameraAirModule(mp_module.MPModule):
                 return
             if self.airstart_triggered == False:
                 self.airstart_triggered = True
-                self.joelog = cuav_joe.JoeLog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'), append=self.continue_mode)
+                self.open_joelog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'))
                 self.transmit_thread = self.start_thread(self.transmit_threadfunc)
                 time.sleep(0.1)
                 self.send_message("cuav airstart ready")
@@ -278,6 +287,7 @@ class CameraAirModule(mp_module.MPModule):
             for name in self.image_settings.list():
                 scan_parms[name] = self.image_settings.get(name)
             scan_parms['BlueEmphasis'] = float(self.camera_settings.blue_emphasis)
+            scan_parms['Pyramid'] = float(self.camera_settings.scan_pyramid)
 
             if self.terrain_alt is not None:
                 altitude = self.terrain_alt
@@ -287,34 +297,48 @@ class CameraAirModule(mp_module.MPModule):
                                                                      self.c_params.xresolution,
                                                                      self.c_params.lens,
                                                                      self.c_params.sensorwidth)
+                # scanning at reduced resolution makes each pixel bigger
+                scan_parms['MetersPerPixel'] *= self.camera_settings.scan_scale
 
             t1 = time.time()
+            # JPEG images are decoded at the scan resolution, the full
+            # resolution is only decoded if thumbnails are sent
+            source = cuav_util.ImageFile(im, -1, rotate180=self.camera_settings.rotate180)
             try:
-                img_scan = cv2.imread(im, -1)
+                img_scan = source.scaled(self.camera_settings.scan_scale)
+                full_shape = source.shape()
             except Exception:
                 continue
             if img_scan is None:
                 continue
-            (h, w) = img_scan.shape[:2]
-            if self.camera_settings.rotate180:
-                M = cv2.getRotationMatrix2D(center, angle180, scale)
-                img_scan = cv2.warpAffine(img_scan, M, (w, h))
-            im_numpy = numpy.ascontiguousarray(img_scan)
-            regions = scanner.scan(im_numpy, scan_parms)
-            regions = cuav_region.RegionsConvert(regions,
-                                                 cuav_util.image_shape(img_scan),
-                                                 cuav_util.image_shape(img_scan))
+            (w, h) = full_shape
+            scan_shape = cuav_util.image_shape(img_scan)
+            if self.scanner is None or (self.scanner.width, self.scanner.height) != scan_shape:
+                # scan buffers are re-used for every image of the same size
+                self.scanner = scanner.Scanner(scan_shape[0], scan_shape[1], scan_parms)
+            elif scan_parms != self.scanner_parms:
+                self.scanner.update_params(scan_parms)
+            self.scanner_parms = scan_parms
+            self.scanner.threads = self.camera_settings.scan_threads
+            self.scanner.capture = 1 if self.camera_settings.scan_capture > 0 else 0
+            regions = self.scanner.scan(img_scan, as_array=True)
+            self.keep_stages(frame_time)
+            regions = cuav_region.RegionsConvert(regions, scan_shape, full_shape)
             t2 = time.time()
             self.scan_fps = 1.0 / (t2-t1)
             self.scan_count += 1
 
+            # score and filter the regions as an array, then only
+            # create Region objects for the ones that are left
             regions = cuav_region.filter_regions(img_scan, regions,
                                                  min_score=self.camera_settings.minscore,
-                                                 filter_type=self.camera_settings.filter_type)
+                                                 filter_type=self.camera_settings.filter_type,
+                                                 shape=full_shape)
+            regions = cuav_region.RegionsFromArray(regions, full_shape)
             self.region_count += len(regions)
 
             # possibly send a preview image
-            self.send_preview(img_scan)
+            self.send_preview(img_scan, self.camera_settings.scan_scale)
             
             if self.camera_settings.roll_stabilised:
                 roll=0
@@ -325,8 +349,7 @@ class CameraAirModule(mp_module.MPModule):
                 self.posmapping[str(frame_time)] = pos
 
             # this adds the latlon field to the regions (georeferencing)
-            for r in regions:
-                r.latlon = cuav_util.gps_position_from_image_region(r, pos, w, h, altitude=None, C=self.c_params)
+            regions = cuav_region.georef_regions(regions, pos, self.c_params, w, h)
 
             if self.joelog:
                 self.log_joe_position(pos, frame_time, regions)
@@ -344,7 +367,8 @@ class CameraAirModule(mp_module.MPModule):
                 
             #filter by minscore
             regions = cuav_region.filter_regions(img_scan, regions, min_score=self.camera_settings.minscore,
-                                                 filter_type=self.camera_settings.filter_type)
+                                                 filter_type=self.camera_settings.filter_type,
+                                                 shape=full_shape)
             high_score = 1
             for r in regions:
                 if r.score > high_score:
@@ -365,7 +389,7 @@ class CameraAirModule(mp_module.MPModule):
                     
             if len(regions) > 0 and self.camera_settings.transmit:
                 # send a region message with thumbnails to the ground station
-                thumb_img = cuav_region.CompositeThumbnail(img_scan, regions,
+                thumb_img = cuav_region.CompositeThumbnail(source.full(), regions,
                                                            thumb_size=self.camera_settings.thumbsize)
                 encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
                 (result, thumb) = cv2.imencode('.jpg', thumb_img, encode_param)
@@ -379,6 +403,14 @@ class CameraAirModule(mp_module.MPModule):
                     self.send_message("Warning: image Tx queue too long")
                     print("Warning: image Tx queue too long")
 
+    def keep_stages(self, frame_time):
+        '''keep the intermediate images of the last scan, so the GCS
+        can request them'''
+        while len(self.captured_stages) >= max(self.camera_settings.scan_capture, 1):
+            self.captured_stages.popitem(last=False)
+        if self.camera_settings.scan_capture > 0:
+            self.captured_stages[str(frame_time)] = self.scanner.intermediates()
+
     def get_plane_position(self, frame_time,roll=None):
         '''get a MavPosition object for the planes position if possible'''
         try:
@@ -448,7 +480,7 @@ class CameraAirModule(mp_module.MPModule):
                 self.bandwidth_used.append(self.msend.get_bandwidth_used())
                 self.rtt_estimate.append(self.msend.get_rtt_estimate())
 
-    def send_image(self, img, frame_time, priority, pos, linktosend):
+    def send_image(self, img, frame_time, priority, pos, linktosend, stage=None):
         '''send an image object to the GCS'''
         encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.camera_settings.qualitysend]
         (result, jpeg) = cv2.imencode('.jpg', img, encode_param)
@@ -456,17 +488,18 @@ class CameraAirModule(mp_module.MPModule):
         # keep filtered image size
         self.jpeg_size = 0.95 * self.jpeg_size + 0.05 * len(jpeg)
 
-        pkt = cuav_command.ImagePacket(frame_time, jpeg, pos, priority)
+        pkt = cuav_command.ImagePacket(frame_time, jpeg, pos, priority, stage=stage)
         self.transmit_queue.put((pkt, priority, self.get_bsend_index(linktosend)))
 
-    def send_preview(self, img):
-        '''send a preview image object to the GCS'''
+    def send_preview(self, img, img_scale=1):
+        '''send a preview image object to the GCS. img_scale is how much
+        img has already been reduced from full resolution'''
         if not self.camera_settings.preview or self.transmit_queue.qsize() > 3:
             # only send when link is nearly idle
             return
         if self.scan_count % self.camera_settings.previewfreq != 0:
             return
-        scale = 1.0 / self.camera_settings.previewscale
+        scale = min(float(img_scale) / self.camera_settings.previewscale, 1.0)
         small_img = cv2.resize(img, (0,0), fx=scale, fy=scale)
         encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.camera_settings.previewquality]
         (result, jpeg) = cv2.imencode('.jpg', small_img, encode_param)
@@ -504,6 +537,14 @@ class CameraAirModule(mp_module.MPModule):
             self.msend = block_xmit.BlockSender(mss=96, sock=self.msocket, dest_ip='mavlink', dest_port=0, backlog=5, debug=False)
             self.msend.set_bandwidth(self.camera_settings.m_bandwidth)
 
+    def open_joelog(self, filename):
+        '''open the joe log, re-using the open log if it is the same file'''
+        if self.joelog is not None:
+            if self.joelog.filename == filename and self.joelog.log is not None:
+                return
+            self.joelog.close()
+        self.joelog = cuav_joe.JoeLog(filename, append=self.continue_mode)
+
     def start_thread(self, fn):
         '''start a thread running'''
         t = threading.Thread(target=fn)
@@ -519,6 +560,8 @@ class CameraAirModule(mp_module.MPModule):
             self.capture_thread.join(1.0)
             self.scan_thread.join(1.0)
             self.transmit_thread.join(1.0)
+        if self.joelog:
+            self.joelog.close()
         print('camera unload OK')
 
     def check_commands(self, bsend):
@@ -569,7 +612,7 @@ class CameraAirModule(mp_module.MPModule):
             #if the airstart is triggered and we're flying, then start capture
             if m.airspeed > self.camera_settings.minspeed or m.groundspeed > self.camera_settings.minspeed:
                 self.running = True
-                self.joelog = cuav_joe.JoeLog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'), append=self.continue_mode)
+                self.open_joelog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'))
                 self.capture_thread = self.start_thread(self.capture_threadfunc)
                 self.scan_thread = self.start_thread(self.scan_threadfunc)
                 self.send_message("Started cuav running")
@@ -609,6 +652,15 @@ class CameraAirModule(mp_module.MPModule):
     def handle_image_request(self, obj, bsend):
         '''handle ImageRequest from GCS. Only sends to the requesting GCS'''
         strname = str(obj.frame_time)
+        stage = getattr(obj, 'stage', None)
+        if stage is not None:
+            stages = self.captured_stages.get(strname, {})
+            if not stage in stages:
+                print("No %s image captured for %s" % (stage, strname))
+                return
+            print("Sending %s image %s" % (stage, strname))
+            self.send_image(stages[stage], obj.frame_time, 10000, None, bsend, stage=stage)
+            return
         if not strname in self.imagefilenamemapping:
             print("Unknown image %s" % strname)
             return
@@ -616,17 +668,18 @@ class CameraAirModule(mp_module.MPModule):
         if not os.path.exists(filename):
             print("No file: %s" % filename)
             return
+        source = cuav_util.ImageFile(filename, -1)
         try:
-            img = cv2.imread(filename, -1)
+            if obj.fullres:
+                img = source.full()
+            else:
+                img = source.scaled(2)
         except Exception:
             return
         if img is None:
             print("Bad image: %s" % filename)
             return
 
-        if not obj.fullres:
-            im_small = cv2.resize(img, (0,0), fx=0.5, fy=0.5)
-            img = im_small
         print("Sending image %s" % filename)
         pos = self.posmapping.get(str(obj.frame_time), None)
         self.send_image(img, obj.frame_time, 10000, pos, bsend)
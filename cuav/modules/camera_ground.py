@@ -80,7 +80,7 @@ class CameraGroundModule(mp_module.MPModule):
 
         self.add_command('camera', self.cmd_camera,
                          'camera control',
-                         ['<status|view|boundary>',
+                         ['<status|view|boundary|joes>',
                           'set (CAMERASETTING)'])
         self.add_command('remote', self.cmd_remote, "remote command", ['(COMMAND)'])
         self.add_command('remotem', self.cmd_remotem, "remote command over mavlink", ['(COMMAND)'])
@@ -94,7 +94,7 @@ class CameraGroundModule(mp_module.MPModule):
 
     def cmd_camera(self, args):
         '''camera commands'''
-        usage = "usage: camera <status|view|boundary|set>"
+        usage = "usage: camera <status|view|boundary|set|stage|joes>"
         if len(args) == 0:
             print(usage)
             return
@@ -115,14 +115,21 @@ class CameraGroundModule(mp_module.MPModule):
                 return
             if not self.viewing:
                 print("Starting image viewer")
-            self.joelog = cuav_joe.JoeLog(os.path.join(self.camera_dir,
-                                                       'joe_ground.log'),
-                                          append=self.continue_mode)
+            self.open_joelog(os.path.join(self.camera_dir, 'joe_ground.log'))
             if self.view_thread is None:
                 self.view_thread = self.start_thread(self.view_threadfunc)
             self.viewing = True
         elif args[0] == "set":
             self.camera_settings.command(args[1:])
+        elif args[0] == "stage":
+            if len(args) != 3:
+                print("usage: camera stage <frame_time> <1original|1unquantised|2thresholded|3neighbours|4regions|5prunelarge|6merged|7pruned|8refined>")
+                return
+            # needs scan_capture set on the aircraft
+            pkt = cuav_command.ImageRequest(float(args[1]), True, stage=args[2])
+            self.send_packet(pkt)
+        elif args[0] == "joes":
+            self.cmd_joes(args[1:])
         elif args[0] == "boundary":
             if len(args) != 2:
                 print("boundary=%s" % self.boundary)
@@ -135,6 +142,25 @@ class CameraGroundModule(mp_module.MPModule):
                                                                        layer=1, linewidth=2,
                                                                        colour=(0, 0, 255)))
 
+    def cmd_joes(self, args):
+        '''list the joes near the last map click'''
+        if len(args) != 1:
+            print("usage: camera joes <radius>")
+            return
+        if self.joelog is None or self.joelog.index is None:
+            print("No joes - use camera view first")
+            return
+        if self.mpstate.click_location is None:
+            print("No map click position")
+            return
+        (lat, lon) = self.mpstate.click_location
+        idxs = self.joelog.index.radius(lat, lon, float(args[0]))
+        if len(idxs) == 0:
+            print("No joes within %.0fm" % float(args[0]))
+            return
+        for joe in cuav_joe.read_joes(self.joelog.filename, idxs):
+            print(joe)
+
     def cmd_remote(self, args):
         '''camera remove commands over UDP'''
         cmd = " ".join(args)
@@ -170,7 +196,7 @@ class CameraGroundModule(mp_module.MPModule):
         joes = []
         if os.path.isfile(self.joelog.filename):
             joes = cuav_joe.JoeIterator(self.joelog.filename)
-        for joe in joes.getjoes():
+        for joe in joes:
             if joe.thumb_filename == last_thumbfile or last_thumbfile is None:
                 regions.append(joe.r)
                 last_joe = joe
@@ -367,12 +393,20 @@ class CameraGroundModule(mp_module.MPModule):
 
             #save to file
             imagedec = cv2.imdecode(obj.jpeg, 1)
-            ff = os.path.join(self.view_dir, cuav_util.frame_time(obj.frame_time)) + ".jpg"
+            stage = getattr(obj, 'stage', None)
+            ff = os.path.join(self.view_dir, cuav_util.frame_time(obj.frame_time))
+            if stage is not None:
+                # an intermediate scan image, which is not shown in the mosaic
+                ff += "_" + stage
+            ff += ".jpg"
             write_param = [int(cv2.IMWRITE_JPEG_QUALITY), 99]
             cv2.imwrite(ff, imagedec, write_param)
-            self.mosaic.tag_image(obj.frame_time)
+            if stage is not None:
+                print("Saved %s" % ff)
+            else:
+                self.mosaic.tag_image(obj.frame_time)
 
-            if obj.pos is not None:
+            if obj.pos is not None and stage is None:
                 self.mosaic.add_image(obj.frame_time, ff, obj.pos)
             
             # update console
@@ -450,6 +484,14 @@ class CameraGroundModule(mp_module.MPModule):
         for the positions of the identified image regions'''
         return self.joelog.add_regions(frame_time, regions, pos, filename, thumb_filename)
 
+    def open_joelog(self, filename):
+        '''open the joe log, re-using the open log if it is the same file'''
+        if self.joelog is not None:
+            if self.joelog.filename == filename and self.joelog.log is not None:
+                return
+            self.joelog.close()
+        self.joelog = cuav_joe.JoeLog(filename, append=self.continue_mode, index=True)
+
     def start_thread(self, fn):
         '''start a thread running'''
         t = threading.Thread(target=fn)
@@ -462,6 +504,8 @@ class CameraGroundModule(mp_module.MPModule):
         self.unload_event.set()
         if self.view_thread is not None:
             self.view_thread.join(1.0)
+        if self.joelog is not None:
+            self.joelog.close()
         #shutil.rmtree(self.camera_dir)
         print('camera unload OK')
 
@@ -11,10 +11,12 @@ from MAVProxy.modules.lib.mp_menu import *
 
 slipmap = None
 
-def show_image(view, selected_image, im_bgr, fname):
-    '''show a image view'''
+def show_image(view, stages, selected_image, fname):
+    '''show an intermediate image of the last scan'''
     view.set_title("%s %s" % (selected_image, fname))
-    im = cv2.imread(selected_image,1)
+    im = stages.get(selected_image)
+    if im is None:
+        return
     view.set_image(cv2.cvtColor(im, cv2.COLOR_BGR2RGB))
 
 def file_list(directory, extensions):
@@ -57,14 +59,14 @@ def process(folderfile):
     )
 
     menu = MPMenuSubMenu('View', items=[
-        MPMenuItem('Original Image', 'Original Image', '_1original.pnm'),
-        MPMenuItem('Unquantised Image', 'Unquantised Image', '_1unquantised.pnm'),
-        MPMenuItem('Thresholded Image', 'Thresholded Image', '_2thresholded.pnm'),
-        MPMenuItem('Neighbours Image', 'Neighbours Image', '_3neighbours.pnm'),
-        MPMenuItem('Regions Image', 'Regions Image', '_4regions.pnm'),
-        MPMenuItem('Prune Large Image', 'Prune Large Image', '_5prunelarge.pnm'),
-        MPMenuItem('Merged Image', 'Merged Large', '_6merged.pnm'),
-        MPMenuItem('Pruned Image', 'Pruned Image', '_7pruned.pnm'),
+        MPMenuItem('Original Image', 'Original Image', '1original'),
+        MPMenuItem('Unquantised Image', 'Unquantised Image', '1unquantised'),
+        MPMenuItem('Thresholded Image', 'Thresholded Image', '2thresholded'),
+        MPMenuItem('Neighbours Image', 'Neighbours Image', '3neighbours'),
+        MPMenuItem('Regions Image', 'Regions Image', '4regions'),
+        MPMenuItem('Prune Large Image', 'Prune Large Image', '5prunelarge'),
+        MPMenuItem('Merged Image', 'Merged Large', '6merged'),
+        MPMenuItem('Pruned Image', 'Pruned Image', '7pruned'),
         MPMenuItem('Fit Window', 'Fit Window', 'fitWindow'),
         MPMenuItem('Full Zoom',  'Full Zoom', 'fullSize'),
         MPMenuItem('Next Image', 'Next Image', 'nextImage'),
@@ -80,7 +82,8 @@ def process(folderfile):
 
     dlg = wxsettings.WXSettings(settings)
 
-    selected_image = "_1original.pnm"
+    selected_image = '1original'
+    stages = {}
     
     while dlg.is_alive() and view.is_alive():
         last_change = settings.last_change()
@@ -91,19 +94,23 @@ def process(folderfile):
                 'MaxRegionSize' : settings.MaxRegionSize,
                 'MaxRarityPct'  : settings.MaxRarityPct,
                 'RegionMergeSize' : settings.RegionMergeSize,
-                'SaveIntermediate' : 1.0,
                 'MetersPerPixel' : settings.MetersPerPixel
         }
 
+        # keep the intermediate images of the scan in memory
+        (w,h) = cuav_util.image_shape(im_numpy)
+        img_scanner = scanner.Scanner(w, h, scan_parms)
+        img_scanner.capture = 1
         t0 = time.time()
-        regions = scanner.scan(im_numpy, scan_parms)
+        regions = img_scanner.scan(im_numpy)
+        stages = img_scanner.intermediates()
         regions = cuav_region.RegionsConvert(regions,
                                              cuav_util.image_shape(im_orig),
                                              cuav_util.image_shape(im_orig), False)    
         t1=time.time()
         print("Processing %s took %.2f seconds" % (fname, t1-t0))
-        show_image(view, str(file_index+1) + selected_image, im_orig, fname)
-        
+        show_image(view, stages, selected_image, fname)
+
 
         while last_change == settings.last_change() and dlg.is_alive():
             new_index = file_index
@@ -113,9 +120,9 @@ def process(folderfile):
                         new_index = (file_index + 1) % len(files)
                     elif event.returnkey == 'previousImage':
                         new_index = (file_index - 1) % len(files)
-                    elif event.returnkey.endswith("pnm"):
+                    elif event.returnkey in stages:
                         selected_image = event.returnkey
-                        show_image(view, str(file_index+1) + selected_image, im_orig, fname)
+                        show_image(view, stages, selected_image, fname)
                 if new_index != file_index:
                     file_index = new_index
                     fname = files[file_index]
@@ -123,14 +130,7 @@ def process(folderfile):
                     im_numpy = numpy.ascontiguousarray(im_orig)
                     break
                 time.sleep(0.1)
-        #remove all the pnm's
-        directory = os.getcwd()
-        lst = os.listdir( directory )
-
-        for item in lst:
-            if item.endswith(".pnm"):
-                os.remove(os.path.join(directory, item ))
-         
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Algorithm tester")
@@ -3,7 +3,7 @@
 benchmark the base cuav operations
 """
 
-import numpy, os, time, cv2, sys, cPickle, pickle
+import numpy, os, time, cv2, sys, pickle, multiprocessing
 import argparse
 
 from cuav.image import scanner
@@ -81,6 +81,43 @@ def process(filename, repeat):
         print('scan_full: %.1f fps' % (repeat/(t1-t0)))
     else:
         print('scan_full: (inf) fps')
+
+    # with more threads than cpus the threads only share the same cores,
+    # so these numbers show the threading overhead, not the scaling
+    cpus = multiprocessing.cpu_count()
+    fps1 = None
+    for threads in [1, 2, 4]:
+        note = ''
+        if threads > cpus:
+            note = ' (only %u cpus)' % cpus
+        t0 = time.time()
+        for i in range(repeat):
+            scanner.scan(colour, threads=threads)
+        t1 = time.time()
+        if t1 > t0:
+            fps = repeat/(t1-t0)
+            if threads == 1:
+                fps1 = fps
+            elif threads <= cpus and fps1 is not None:
+                note = ' (%.2fx)' % (fps / fps1)
+            print('scan_full threads=%u: %.1f fps%s' % (threads, fps, note))
+        else:
+            print('scan_full threads=%u: (inf) fps%s' % (threads, note))
+    if cpus < 2:
+        print('scan_full threads: no scaling data on %u cpu, the scanner defaults to 1 thread' % cpus)
+
+    simd = scanner.get_simd()
+    for kernels in scanner.simd_selftest():
+        scanner.set_simd(kernels)
+        t0 = time.time()
+        for i in range(repeat):
+            scanner.scan(colour)
+        t1 = time.time()
+        if t1 > t0:
+            print('scan_full simd=%s: %.1f fps' % (kernels, repeat/(t1-t0)))
+        else:
+            print('scan_full simd=%s: (inf) fps' % kernels)
+    scanner.set_simd(simd)
         
     #if not hasattr(scanner, 'jpeg_compress'):
     #    return
@@ -64,6 +64,9 @@ class MissionGenerator():
             if name.startswith(missionBoundaryMask):
                 self.missionBounds.append((lat, lon))
 
+        # the search pattern probes test many points against the area
+        self.searchArea = cuav_util.PreparedPolygon(self.searchArea)
+
         #print "Search Area = " + str(self.searchArea)
         #print "Mission Boundary = " + str(self.missionBounds)
 
@@ -80,7 +83,7 @@ class MissionGenerator():
             if point[1] > self.boundingBoxLong[1]:
                 self.boundingBoxLong[1] = point[1]  
 
-        self.boundingBox = [(self.boundingBoxLat[0], self.boundingBoxLong[0]), (self.boundingBoxLat[1], self.boundingBoxLong[0]), (self.boundingBoxLat[0], self.boundingBoxLong[1]), (self.boundingBoxLat[1], self.boundingBoxLong[1])] 
+        self.boundingBox = cuav_util.PreparedPolygon([(self.boundingBoxLat[0], self.boundingBoxLong[0]), (self.boundingBoxLat[1], self.boundingBoxLong[0]), (self.boundingBoxLat[0], self.boundingBoxLong[1]), (self.boundingBoxLat[1], self.boundingBoxLong[1])])
         #print "Bounding box is: " + str(self.boundingBoxLat) + " ... " + str(self.boundingBoxLong)
 
         #for point in self.searchArea:
@@ -122,22 +125,12 @@ class MissionGenerator():
 
         #find the nearest point to Airfield Home - use this as a starting point (if entry lanes are not used)
         if len(self.entryPoints) == 0:
-            nearestdist = cuav_util.gps_distance(self.airfieldHome[0], self.airfieldHome[1], self.searchArea[0][0], self.searchArea[0][1])
-            nearest = self.searchArea[0]
-            for point in self.searchArea:
-                newdist = cuav_util.gps_distance(self.airfieldHome[0], self.airfieldHome[1], point[0], point[1])
-                if newdist < nearestdist:
-                    nearest = point
-                    nearestdist = newdist
+            start = self.airfieldHome
         else:
-            nearestdist = cuav_util.gps_distance(self.entryPoints[0][0], self.entryPoints[0][1], self.searchArea[0][0], self.searchArea[0][1])
-            nearest = self.searchArea[0]
-            for point in self.searchArea:
-                newdist = cuav_util.gps_distance(self.entryPoints[0][0], self.entryPoints[0][1], point[0], point[1])
-                #print "dist = " + str(newdist)
-                if newdist < nearestdist:
-                    nearest = point
-                    nearestdist = newdist
+            start = self.entryPoints[0]
+        area = numpy.array(self.searchArea, dtype=numpy.float64)
+        distances = cuav_util.gps_distance_many(start[0], start[1], area[:,0], area[:,1])
+        nearest = self.searchArea[int(numpy.argmin(distances))]
 
         #print "Start = " + str(nearest) + ", dist = " + str(nearestdist)
 
@@ -121,8 +121,7 @@ def process(args):
   if args.camera_params:
     C_params = cam_params.CameraParams.fromfile(args.camera_params)
   else:
-    im_orig = cv2.imread(files[0])
-    (w,h) = cuav_util.image_shape(im_orig)
+    (w,h) = cuav_util.ImageFile(files[0]).shape()
     C_params = cam_params.CameraParams(lens=args.lens, sensorwidth=args.sensorwidth, xresolution=w, yresolution=h)
 
   if args.target:
@@ -162,6 +161,7 @@ def process(args):
       MPSetting('MaxRegionSize', float, 1.0, range=(0,100), increment=0.1, digits=1),
       MPSetting('MaxRarityPct',  float, 0.02, range=(0,100), increment=0.01, digits=2),
       MPSetting('RegionMergeSize', float, 1.0, range=(0,100), increment=0.1, digits=1),
+      MPSetting('HistogramDecay', float, 0.0, range=(0,0.99), increment=0.05, digits=2),
       MPSetting('BlueEmphasis', bool, args.blue_emphasis),
       MPSetting('SaveIntermediate', bool, args.debug)
       ],
@@ -182,8 +182,32 @@ def process(args):
   if args.view:
     viewer = mp_image.MPImage(title='Image', can_zoom=True, can_drag=True)
 
+  img_scanner = None
+  last_scan_parms = None
+
+  if mpos:
+    # get the positions by interpolating telemetry data from the MAVLink log file
+    # this assumes that the filename contains the timestamp
+    frame_times = []
+    for f in files:
+      if gamma is not None:
+        frame_times.append(parse_gamma_time(f, gamma) + args.time_offset)
+      else:
+        frame_times.append(cuav_util.parse_frame_time(f) + args.time_offset)
+    if camera_settings.roll_stabilised:
+      roll = 0
+    else:
+      roll = None
+    if camera_settings.pitch_stabilised:
+      pitch = 0
+    else:
+      pitch = None
+    positions = mav_position.PositionsFromArray(mpos.position_many(frame_times, roll=roll, pitch=pitch,
+                                                                   roll_offset=camera_settings.roll_offset,
+                                                                   pitch_offset=camera_settings.pitch_offset))
+
   start_time = time.time()
-  for f in files:
+  for (fidx, f) in enumerate(files):
       if not mosaic.started():
         print("Waiting for startup")
         if args.start:
@@ -193,27 +217,9 @@ def process(args):
           time.sleep(0.01)
 
       if mpos:
-        # get the position by interpolating telemetry data from the MAVLink log file
-        # this assumes that the filename contains the timestamp
-        if gamma is not None:
-          frame_time = parse_gamma_time(f, gamma)
-        else:
-          frame_time = cuav_util.parse_frame_time(f)
-        frame_time += args.time_offset
-        if camera_settings.roll_stabilised:
-          roll = 0
-        else:
-          roll = None
-        if camera_settings.pitch_stabilised:
-          pitch = 0
-        else:
-          pitch = None
-        try:
-          pos = mpos.position(frame_time, roll=roll, pitch=pitch,
-                              roll_offset=camera_settings.roll_offset,
-                              pitch_offset=camera_settings.pitch_offset)
-        except Exception:
-          print("No position available for %s" % frame_time)
+        pos = positions[fidx]
+        if pos is None:
+          print("No position available for %s" % frame_times[fidx])
           # skip this frame
           continue
       elif kmzpos is not None:
@@ -235,23 +241,22 @@ def process(args):
       slipmap.check_events()
       mosaic.check_events()
 
-      #im_orig = cuav_util.LoadImage(f, rotate180=camera_settings.rotate180)
-      im_orig = cv2.imread(f)
-
-      if im_orig is None:
-        continue
-      (w,h) = cuav_util.image_shape(im_orig)
-
+      # with --downsample the JPEG is decoded directly at half
+      # resolution, and the full image only for thumbnails
+      source = cuav_util.ImageFile(f)
       if args.downsample:
-        im_full = cv2.resize(im_orig, (0,0), fx=0.5, fy=0.5)
+        img_scan = source.scaled(2)
       else:
-        im_full = im_orig
+        img_scan = source.full()
+
+      if img_scan is None:
+        continue
+      (w,h) = source.shape()
 
       count = 0
       total_time = 0
 
       t0=time.time()
-      img_scan = im_full
 
       scan_parms = {}
       for name in image_settings.list():
@@ -259,33 +264,41 @@ def process(args):
       scan_parms['SaveIntermediate'] = float(scan_parms['SaveIntermediate'])
       scan_parms['BlueEmphasis'] = float(scan_parms['BlueEmphasis'])
 
+      (sw,sh) = cuav_util.image_shape(img_scan)
       if pos is not None:
-        (sw,sh) = cuav_util.image_shape(img_scan)
         altitude = pos.altitude
         if altitude < camera_settings.minalt:
           altitude = camera_settings.minalt
         scan_parms['MetersPerPixel'] = camera_settings.mpp100 * altitude / 100.0
-
-        regions = scanner.scan(img_scan, scan_parms)
       else:
-        regions = scanner.scan(img_scan)
-      regions = cuav_region.RegionsConvert(regions, cuav_util.image_shape(img_scan), cuav_util.image_shape(im_full))
+        scan_parms = None
+
+      # re-use the scan buffers while the image size stays the same
+      if img_scanner is None or (img_scanner.width, img_scanner.height) != (sw, sh):
+        img_scanner = scanner.Scanner(sw, sh, scan_parms, threads=args.scan_threads)
+      elif scan_parms != last_scan_parms:
+        img_scanner.update_params(scan_parms)
+      last_scan_parms = scan_parms
+      regions = img_scanner.scan(img_scan)
+      regions = cuav_region.RegionsConvert(regions, cuav_util.image_shape(img_scan), (w,h))
       count += 1
       t1=time.time()
 
       frame_time = pos.time
 
       if pos:
-        for r in regions:
-          r.latlon = cuav_util.gps_position_from_image_region(r, pos, w, h, altitude=altitude, C=C_params)
+        regions = cuav_region.georef_regions(regions, pos, C_params, w, h, altitude=altitude)
 
         if camera_settings.target_radius > 0 and pos is not None:
           regions = cuav_region.filter_radius(regions, (camera_settings.target_lattitude,
                                                         camera_settings.target_longitude),
                                               camera_settings.target_radius)
 
-      regions = cuav_region.filter_regions(im_full, regions, min_score=camera_settings.minscore,
-                                           filter_type=camera_settings.filter_type)
+      # regions are scored on the full resolution image whatever the
+      # scan resolution, which is only decoded if there are regions
+      if len(regions) > 0:
+        regions = cuav_region.filter_regions(source.full(), regions, min_score=camera_settings.minscore,
+                                             filter_type=camera_settings.filter_type)
 
       scan_count += 1
 
@@ -310,7 +323,7 @@ def process(args):
       region_count += len(regions)
 
       if len(regions) > 0:
-          composite = cuav_region.CompositeThumbnail(im_full, regions)
+          composite = cuav_region.CompositeThumbnail(source.full(), regions)
           thumbs = cuav_mosaic.ExtractThumbs(composite, len(regions))
           thumbsRGB = []
 
@@ -375,6 +388,7 @@ def parse_args():
     parser.add_argument("--blue-emphasis", default=False, action='store_true', help="enable blue emphasis in scanner")
     parser.add_argument("--start", default=False, action='store_true', help="start straight away")
     parser.add_argument("--downsample", default=False, action='store_true', help="downsample image before scanning")
+    parser.add_argument("--scan-threads", default=1, type=int, help="number of threads for the image scanner. The multi-core speedup is unmeasured")
     parser.add_argument("--showlz", default=False, action='store_true', help="Show calculated landing zone from regions")
     return parser.parse_args()
 
@@ -70,32 +70,22 @@ def process(args):
   print("num_files=%u" % num_files)
 
   mpos = mav_position.MavInterpolator(gps_lag=args.gps_lag)
-  mpos.set_logfile(os.path.join(os.getcwd(), args.mavlog))
-
-  frame_time = 0
+  mpos.set_logfile(os.path.join(os.getcwd(), args.mavlog), use_index=True)
 
   if args.destdir:
     cuav_util.mkdir_p(args.destdir)
 
-  for f in files:
-    #timestamp is in filename
-    timestamp = (os.path.splitext(os.path.basename(f))[0])
-    m = re.search("\d", timestamp)
-    if m :
-        timestamp = timestamp[m.start():]
-    
-    frame_time = datetime.datetime.strptime(timestamp, "%Y%m%d%H%M%S%fZ")
-    frame_time = mav_position.datetime_to_float(frame_time)
+  # timestamp is in filename
+  frame_times = [cuav_util.parse_frame_time(f) for f in files]
+  if args.roll_stabilised:
+    roll = 0
+  else:
+    roll = None
+  positions = mav_position.PositionsFromArray(mpos.position_many(frame_times, args.max_deltat, roll=roll))
 
-    try:
-      if args.roll_stabilised:
-        roll = 0
-      else:
-        roll = None
-      pos = mpos.position(frame_time, args.max_deltat,roll=roll)
-    except mav_position.MavInterpolatorException as e:
-      print(e)
-      pos = None
+  for (f, pos) in zip(files, positions):
+    if pos is None:
+      print("No position available for %s" % f)
 
     if pos:
 
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+'''
+convert pickle format joe logs to the binary joe log format
+
+the old log is kept as LOG.pickle, and the binary log takes its name
+'''
+
+import os, glob, argparse, time
+
+from cuav.lib import cuav_joe
+
+
+def convert(filename, keep=True):
+    '''convert one joe log, returning the number of joes converted'''
+    if cuav_joe.is_binary_log(filename):
+        print("%s: already in the binary format" % filename)
+        return 0
+    t0 = time.time()
+    tmpfile = filename + '.tmp'
+    count = cuav_joe.convert_log(filename, tmpfile)
+    if keep:
+        os.rename(filename, filename + '.pickle')
+    os.rename(tmpfile, filename)
+    os.rename(cuav_joe.names_filename(tmpfile), cuav_joe.names_filename(filename))
+    print("%s: converted %u joes in %.1f seconds" % (filename, count, time.time() - t0))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("joe log converter")
+    parser.add_argument("--no-keep", action='store_true', default=False, help="don't keep the pickle format log")
+    parser.add_argument("logs", metavar="LOG", nargs="+")
+    args = parser.parse_args()
+
+    for pattern in args.logs:
+        for filename in glob.glob(pattern):
+            convert(filename, keep=not args.no_keep)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+reproducible benchmark of the image scanner
+
+synthetic terrain frames with planted targets are scanned at several
+resolutions, timing each stage of the scanner. The results can be
+saved as JSON and compared against a baseline saved earlier, to catch
+scanner regressions before flying
+"""
+
+import numpy, time, cv2, sys, json, platform, multiprocessing
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 has no tracemalloc, so there are no Python heap figures
+    tracemalloc = None
+
+from cuav.image import scanner
+
+# target colours, in BGR. These are rare against the terrain palette
+target_colours = [(255, 40, 40), (40, 40, 255), (40, 255, 255), (255, 255, 255), (255, 40, 255)]
+
+# scan parameters, as the camera module defaults
+default_params = {
+    'MinRegionArea' : 0.15,
+    'MaxRegionArea' : 1.0,
+    'MinRegionSize' : 0.2,
+    'MaxRegionSize' : 1.0,
+    'MaxRarityPct' : 0.02,
+    'RegionMergeSize' : 1.0,
+}
+
+# stages which have to be slower than this to count as a regression,
+# as shorter times are mostly noise
+min_regression_seconds = 0.0002
+
+
+def parse_resolution(s):
+    '''parse a WIDTHxHEIGHT resolution'''
+    (w, h) = s.lower().split('x')
+    return (int(w), int(h))
+
+
+def meters_per_pixel(width):
+    '''ground size of a pixel, as for a camera at a fixed height with
+    0.1 meters per pixel at a width of 1280'''
+    return 0.1 * 1280.0 / width
+
+
+def synthetic_frame(width, height, num_targets=10, seed=0):
+    '''return a synthetic terrain frame with planted targets as a BGR
+    image, and the (x1,y1,x2,y2) bounds of the targets. The same seed
+    always gives the same frame'''
+    rand = numpy.random.RandomState(seed)
+
+    # smooth variation in brightness and tint, like patches of grass,
+    # scrub and soil, with per pixel noise on top
+    coarse = rand.uniform(0.0, 1.0, (max(height//64, 2), max(width//64, 2), 1)).astype(numpy.float32)
+    patches = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC).reshape(height, width, 1)
+    grass = numpy.array([40, 110, 70], dtype=numpy.float32)
+    soil = numpy.array([60, 100, 140], dtype=numpy.float32)
+    img = grass + (soil - grass) * numpy.clip(patches, 0, 1)
+    img *= rand.uniform(0.85, 1.15, (height, width, 1)).astype(numpy.float32)
+    img += rand.normal(0, 4, (height, width, 3)).astype(numpy.float32)
+    img = numpy.clip(img, 0, 255).astype(numpy.uint8)
+
+    # targets are 0.4 to 0.9 meters across
+    mpp = meters_per_pixel(width)
+    targets = []
+    for i in range(num_targets):
+        size = max(int(rand.uniform(0.4, 0.9) / mpp), 2)
+        x1 = rand.randint(0, width - size)
+        y1 = rand.randint(0, height - size)
+        colour = target_colours[i % len(target_colours)]
+        cv2.rectangle(img, (x1, y1), (x1+size-1, y1+size-1), colour, -1)
+        targets.append((x1, y1, x1+size-1, y1+size-1))
+    return (img, targets)
+
+
+def targets_found(regions, targets):
+    '''count the targets which overlap a scanned region'''
+    found = 0
+    for (tx1, ty1, tx2, ty2) in targets:
+        for (x1, y1, x2, y2, score) in regions:
+            if x1 <= tx2 and tx1 <= x2 and y1 <= ty2 and ty1 <= y2:
+                found += 1
+                break
+    return found
+
+
+def benchmark_resolution(width, height, num_targets=10, frames=4, repeat=20,
+                         params=None, threads=1):
+    '''scan synthetic frames at one resolution, returning a dict of
+    results with the time of each scanner stage in milliseconds'''
+    if params is None:
+        params = default_params
+    params = dict(params)
+    params['MetersPerPixel'] = meters_per_pixel(width)
+    images = [synthetic_frame(width, height, num_targets, seed) for seed in range(frames)]
+    s = scanner.Scanner(width, height, params, threads)
+
+    # the first scan allocates the region buffers
+    s.scan(images[0][0])
+
+    stages = dict.fromkeys(s.timings(), 0.0)
+    found = 0
+    num_regions = 0
+    # the scanner counts its own buffer allocations, which tracemalloc
+    # can't see, as they don't come from the Python heap
+    allocs = s.allocations()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        (start_bytes, _) = tracemalloc.get_traced_memory()
+    t0 = time.time()
+    for i in range(repeat):
+        (img, targets) = images[i % frames]
+        regions = s.scan(img)
+        for (stage, seconds) in s.timings().items():
+            stages[stage] += seconds
+        num_regions += len(regions)
+        found += targets_found(regions, targets)
+    t1 = time.time()
+    if tracemalloc is not None:
+        (end_bytes, peak_bytes) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    allocs2 = s.allocations()
+
+    frame_seconds = (t1 - t0) / repeat
+    ret = {
+        'width' : width,
+        'height' : height,
+        'targets' : num_targets,
+        'frames' : repeat,
+        'fps' : 1.0 / frame_seconds if frame_seconds > 0 else float('inf'),
+        'frame_ms' : frame_seconds * 1000,
+        'stages_ms' : dict((k, v * 1000 / repeat) for (k, v) in stages.items()),
+        'regions' : num_regions / float(repeat),
+        'targets_found' : found / float(repeat),
+        'scan_allocs' : allocs2['count'] - allocs['count'],
+        'scan_alloc_bytes' : allocs2['bytes'] - allocs['bytes'],
+    }
+    if tracemalloc is not None:
+        ret['py_alloc_peak_bytes'] = peak_bytes - start_bytes
+        ret['py_alloc_growth_bytes'] = end_bytes - start_bytes
+    return ret
+
+
+def run_benchmark(resolutions, num_targets=10, frames=4, repeat=20, params=None, threads=1):
+    '''benchmark the scanner at each (width,height) resolution'''
+    results = {}
+    for (width, height) in resolutions:
+        results['%ux%u' % (width, height)] = benchmark_resolution(width, height, num_targets,
+                                                                  frames, repeat, params, threads)
+    return {
+        'machine' : platform.machine(),
+        'node' : platform.node(),
+        'python' : platform.python_version(),
+        'simd' : scanner.get_simd(),
+        'threads' : threads,
+        'cpus' : multiprocessing.cpu_count(),
+        'params' : params,
+        'results' : results,
+    }
+
+
+def compare_baseline(report, baseline, tolerance=0.1):
+    '''compare a benchmark report with a baseline report, returning a list
+    of regression messages. Times may be up to tolerance slower than
+    the baseline'''
+    regressions = []
+    for (res, r) in report['results'].items():
+        if res not in baseline['results']:
+            continue
+        b = baseline['results'][res]
+        times = [('frame', r['frame_ms'], b['frame_ms'])]
+        for (stage, ms) in r['stages_ms'].items():
+            times.append((stage, ms, b['stages_ms'].get(stage, ms)))
+        for (name, ms, base_ms) in times:
+            if ms > base_ms * (1 + tolerance) and ms - base_ms > min_regression_seconds * 1000:
+                regressions.append('%s %s: %.2f ms, baseline %.2f ms' % (res, name, ms, base_ms))
+        if r.get('scan_allocs', 0) > b.get('scan_allocs', 0):
+            regressions.append('%s scanner allocations: %u, baseline %u' % (
+                res, r['scan_allocs'], b.get('scan_allocs', 0)))
+        if r['targets_found'] < b['targets_found']:
+            regressions.append('%s targets found: %.1f, baseline %.1f' % (
+                res, r['targets_found'], b['targets_found']))
+    return regressions
+
+
+def show_report(report):
+    '''print a benchmark report'''
+    print('simd=%s threads=%u cpus=%s' % (report['simd'], report['threads'], report.get('cpus', '?')))
+    if report['threads'] > report.get('cpus', report['threads']):
+        print('more threads than cpus: the times show threading overhead, not scaling')
+    for (res, r) in report['results'].items():
+        print('%s: %.1f fps %.2f ms/frame %.1f/%u targets found' % (
+            res, r['fps'], r['frame_ms'], r['targets_found'], r['targets']))
+        heap = ''
+        if 'py_alloc_peak_bytes' in r:
+            heap = ' %u Python heap bytes' % r['py_alloc_peak_bytes']
+        print('   %u scanner allocations of %u bytes%s' % (r['scan_allocs'], r['scan_alloc_bytes'], heap))
+        print('   ' + ' '.join(['%s=%.2f' % (k, v) for (k, v) in r['stages_ms'].items() if v > 0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("scanner benchmark")
+    parser.add_argument("--resolutions", default="640x480,1280x960,2048x1536",
+                        help="comma separated list of WIDTHxHEIGHT resolutions")
+    parser.add_argument("--targets", type=int, default=10, help="targets per frame")
+    parser.add_argument("--frames", type=int, default=4, help="number of different frames")
+    parser.add_argument("--repeat", type=int, default=20, help="scans per resolution")
+    parser.add_argument("--threads", type=int, default=1, help="scanner threads")
+    parser.add_argument("--pyramid", type=int, default=1, help="pyramid downsample factor")
+    parser.add_argument("--simd", default=None, help="scanner kernels to use")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown from the baseline")
+    args = parser.parse_args()
+
+    if args.simd is not None:
+        scanner.set_simd(args.simd)
+    params = dict(default_params)
+    params['Pyramid'] = float(args.pyramid)
+    resolutions = [parse_resolution(r) for r in args.resolutions.split(',')]
+
+    report = run_benchmark(resolutions, args.targets, args.frames, args.repeat, params, args.threads)
+    show_report(report)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(report, baseline, args.tolerance)
+        for r in regressions:
+            print('REGRESSION: %s' % r)
+        if regressions:
+            sys.exit(1)
@@ -57,8 +57,7 @@ def process(args):
         if args.camera_params:
             C_params = cam_params.CameraParams.fromfile(args.camera_params.name)
         else:
-            im_orig = cv2.imread(files[0])
-            (w,h) = cuav_util.image_shape(im_orig)
+            (w,h) = cuav_util.ImageFile(files[0]).shape()
             C_params = cam_params.CameraParams(lens=args.lens, sensorwidth=args.sensorwidth, xresolution=w, yresolution=h)
         mosaic = cuav_mosaic.Mosaic(slipmap, C=C_params)
         if boundary is not None:
@@ -95,21 +94,25 @@ def process(args):
     }
 
     filenum = 0
+    img_scanner = None
+
+    if mpos:
+        frame_times = [cuav_util.parse_frame_time(f) for f in files]
+        if args.roll_stabilised:
+            roll = 0
+        else:
+            roll = None
+        positions = mav_position.PositionsFromArray(mpos.position_many(frame_times, args.max_deltat, roll=roll))
         
     for f in files:
         filenum += 1
         if mpos:
-            frame_time = cuav_util.parse_frame_time(f)
-            try:
-                if args.roll_stabilised:
-                    roll = 0
-                else:
-                    roll = None
-                pos = mpos.position(frame_time, args.max_deltat,roll=roll)
+            frame_time = frame_times[filenum-1]
+            pos = positions[filenum-1]
+            if pos is not None:
                 slipmap.set_position('plane', (pos.lat, pos.lon), rotation=pos.yaw)
-            except mav_position.MavInterpolatorException as e:
-                print(e)
-                pos = None
+            else:
+                print("No position available for %s" % f)
         else:
               pos = None
 
@@ -118,33 +121,40 @@ def process(args):
             slipmap.check_events()
             mosaic.check_events()
 
-        im_orig = cv2.imread(f)
-        (w,h) = cuav_util.image_shape(im_orig)
-        im_full = im_orig
-        im_half = cv2.resize(im_orig, (0,0), fx=0.5, fy=0.5)
-        im_half = numpy.ascontiguousarray(im_half)
-        im_full = numpy.ascontiguousarray(im_full)
+        # when scanning at half resolution the JPEG is decoded at that
+        # resolution, and the full image only for thumbnails
+        source = cuav_util.ImageFile(f)
+        if args.fullres:
+            img_scan = source.full()
+        else:
+            img_scan = source.scaled(2)
+        if img_scan is None:
+            continue
+        img_scan = numpy.ascontiguousarray(img_scan)
+        (w,h) = source.shape()
 
         count = 0
         total_time = 0
-        if args.fullres:
-            img_scan = im_full
-        else:
-            img_scan = im_half
+
+        (sw,sh) = cuav_util.image_shape(img_scan)
+        if img_scanner is None or (img_scanner.width, img_scanner.height) != (sw, sh):
+            img_scanner = scanner.Scanner(sw, sh, scan_parms, threads=args.scan_threads)
 
         t0=time.time()
         for i in range(args.repeat):
-            regions = scanner.scan(img_scan, scan_parms)
-            regions = cuav_region.RegionsConvert(regions, cuav_util.image_shape(img_scan), cuav_util.image_shape(im_full))
+            regions = img_scanner.scan(img_scan)
+            regions = cuav_region.RegionsConvert(regions, cuav_util.image_shape(img_scan), (w,h))
             count += 1
         t1=time.time()
 
-        if args.filter:
-            regions = cuav_region.filter_regions(im_full, regions, min_score=args.minscore,
+        # regions are scored on the full resolution image whatever the
+        # scan resolution, which is only decoded if there are regions
+        if args.filter and len(regions) > 0:
+            regions = cuav_region.filter_regions(source.full(), regions, min_score=args.minscore,
                                            filter_type=args.filter_type)
 
         if len(regions) > 0 and args.debug:
-            composite = cuav_region.CompositeThumbnail(im_full, regions, thumb_size=args.thumb_size)
+            composite = cuav_region.CompositeThumbnail(source.full(), regions, thumb_size=args.thumb_size)
             thumbs = cuav_mosaic.ExtractThumbs(composite, len(regions))
             thumb_num = 0
             for thumb in thumbs:
@@ -173,15 +183,12 @@ def process(args):
         region_count += len(regions)
 
         if args.mosaic and len(regions) > 0 and pos:
-            composite = cuav_region.CompositeThumbnail(im_full, regions)
+            composite = cuav_region.CompositeThumbnail(source.full(), regions)
             thumbs = cuav_mosaic.ExtractThumbs(composite, len(regions))
             mosaic.add_regions(regions, thumbs, f, pos)
 
         if args.view:
-            if args.fullres:
-                img_view = im_full
-            else:
-                img_view = img_scan
+            img_view = img_scan
             #mat = cv.fromarray(img_view)
             for r in regions:
                 r.draw_rectangle(img_view, colour=(255,0,0), linewidth=min(max(w/600,1),3), offset=max(w/200,1))
@@ -227,6 +234,7 @@ if __name__ == '__main__':
     parser.add_argument("--camera-params", default=None, type=file, help="camera calibration json file from OpenCV")
     parser.add_argument("--debug", default=False, action='store_true', help="enable debug info")
     parser.add_argument("--thumb-size", default=100, type=int, help="thumbnail size")
+    parser.add_argument("--scan-threads", default=1, type=int, help="number of threads for the image scanner. The multi-core speedup is unmeasured")
 
     args = parser.parse_args()
     process(args)
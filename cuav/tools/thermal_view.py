@@ -23,17 +23,37 @@ def show_mask(raw, w, h):
     print("Min=%u max=%u" % (minv, maxv))
     
 
+# the last thermal image loaded, so a settings change doesn't reload it
+raw_cache = {}
+
+def load_raw(filename):
+    '''load a 16 bit thermal image, re-using the last image loaded
+
+    the camera words are saved as they arrive, so reading the file
+    unchanged gives the big endian layout thermal_scan expects'''
+    if filename not in raw_cache:
+        im_orig = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if len(im_orig.shape) == 3:
+            im_orig = cv2.cvtColor(im_orig, cv2.COLOR_BGR2GRAY)
+        (w,h) = cuav_util.image_shape(im_orig)
+        show_mask(im_orig, w, h)
+        img = numpy.array(im_orig, dtype=numpy.uint16)
+        raw_cache.clear()
+        raw_cache[filename] = numpy.ascontiguousarray(img)
+    return raw_cache[filename]
+
 def convert_image(filename, threshold, blue_threshold, green_threshold):
     '''convert a file'''
-    im_orig = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
-    (w,h) = cuav_util.image_shape(im_orig)
+    img = load_raw(filename)
+    (w,h) = cuav_util.image_shape(img)
     im2 = numpy.zeros((h,w,3),dtype='uint8')
-    show_mask(im_orig, w, h)
-    img = numpy.array(im_orig, dtype=numpy.uint16)
-    img = numpy.ascontiguousarray(img)
     scanner.thermal_convert(img, im2, threshold, blue_threshold, green_threshold)
     return im2
 
+def hot_regions(filename, threshold):
+    '''find the regions at or above the threshold in a file'''
+    return scanner.thermal_scan(load_raw(filename), threshold)
+
 def settings_callback(setting):
     '''called on a changed setting'''
     global changed
@@ -41,7 +61,7 @@ def settings_callback(setting):
 
 
 def show_value(x,y, filename):
-    raw_image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    raw_image = load_raw(filename)
     try:
         v = raw_image[y][x]
     except Exception:
@@ -108,6 +128,8 @@ if __name__ == "__main__":
             filename = files[image_idx]
             view_image.set_title('View: %s' % filename)
             color_img = convert_image(filename, settings.threshold, settings.blue_threshold, settings.green_threshold)
+            for (x1, y1, x2, y2, score) in hot_regions(filename, settings.threshold):
+                cv2.rectangle(color_img, (x1-2, y1-2), (x2+2, y2+2), (255,255,255), 1)
             view_image.set_image(color_img, bgr=True)
             changed = False
         if view_image.is_alive():
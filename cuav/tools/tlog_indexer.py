@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''
+index telemetry logs for the offline tools
+
+each log gets a LOG.idx directory beside it holding the columns of
+its messages. geotag loads the index instead of parsing the log, as
+does MavInterpolator.set_logfile() with use_index, and an index is
+rebuilt when its log changes
+'''
+
+import glob, argparse, time
+
+from cuav.lib import tlog_index
+
+
+def index_log(filename, force=False, types=None):
+    '''index one log, returning the TlogIndex'''
+    if not force:
+        index = tlog_index.load_index(filename, types=types, build=False)
+        if index is not None:
+            print("%s: index is up to date" % filename)
+            return index
+    t0 = time.time()
+    index = tlog_index.build_index(filename, types=types)
+    print("%s: indexed %u message types in %.1f seconds" % (filename, len(index.types), time.time() - t0))
+    return index
+
+
+def show_index(index):
+    '''print the message counts of an index'''
+    for type in sorted(index.types.keys()):
+        print("  %-30s %8u %s" % (type, index.count(type), ' '.join(index.fields(type))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("tlog indexer")
+    parser.add_argument("--force", action='store_true', default=False, help="rebuild existing indexes")
+    parser.add_argument("--types", default=None,
+                        help="comma separated list of message types to index, or 'all'. " +
+                        "Default the types MavInterpolator uses")
+    parser.add_argument("--show", action='store_true', default=False, help="show the message counts")
+    parser.add_argument("logs", metavar="LOG", nargs="+")
+    args = parser.parse_args()
+
+    if args.types is None:
+        types = tlog_index.interpolator_types()
+    elif args.types == 'all':
+        types = None
+    else:
+        # index all the numeric fields of the chosen types
+        types = dict((t, None) for t in args.types.split(','))
+
+    for pattern in args.logs:
+        for filename in glob.glob(pattern):
+            index = index_log(filename, args.force, types)
+            if args.show:
+                show_index(index)
@@ -39,31 +39,21 @@ def process(args):
   mpos = mav_position.MavInterpolator(gps_lag=args.gps_lag)
   mpos.set_logfile(os.path.join(os.getcwd(), args.mavlog))
 
-  frame_time = 0
-
   poshash = {}
-    
-  for f in files:
-    #timestamp is in filename
-    timestamp = (os.path.splitext(os.path.basename(f))[0])
-    m = re.search("\d", timestamp)
-    if m :
-        timestamp = timestamp[m.start():]
-    
-    frame_time = cuav_util.parse_frame_time(f)
-
-    try:
-      if args.roll_stabilised:
-        roll = 0
-      else:
-        roll = None
-      pos = mpos.position(frame_time, roll=roll)
-    except mav_position.MavInterpolatorException as e:
-      print(e)
-      pos = None
 
+  # timestamp is in filename
+  frame_times = [cuav_util.parse_frame_time(f) for f in files]
+  if args.roll_stabilised:
+    roll = 0
+  else:
+    roll = None
+  positions = mav_position.PositionsFromArray(mpos.position_many(frame_times, roll=roll))
+
+  for (f, pos) in zip(files, positions):
     if pos:
         poshash[os.path.basename(f)] = pos
+    else:
+        print("No position available for %s" % f)
 
   dirname = os.path.dirname(f)
   mavpos = os.path.join(dirname, "mavpos.dat")
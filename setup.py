@@ -7,18 +7,21 @@ version = '1.5.0'
 
 ext_modules = []
 
+extra_link_args = []
 if platform.system() == 'Windows':
     extra_compile_args=["-std=gnu99", "-O3"]
 else:
     if platform.machine().find('arm') != -1:
-        extra_compile_args=["-std=gnu99", "-O3", "-mfpu=neon"]
+        extra_compile_args=["-std=gnu99", "-O3", "-mfpu=neon", "-pthread"]
     else:
-        extra_compile_args=["-std=gnu99", "-O3"]
+        extra_compile_args=["-std=gnu99", "-O3", "-pthread"]
+    extra_link_args=["-pthread"]
 
 scanner = Extension('cuav.image.scanner',
                     sources = ['cuav/image/scanner.c', 'cuav/image/imageutil.c'],
                     libraries = [],
-                    extra_compile_args=extra_compile_args)
+                    extra_compile_args=extra_compile_args,
+                    extra_link_args=extra_link_args)
 #                    extra_compile_args=extra_compile_args + ['-O0'])
 ext_modules.append(scanner)
 
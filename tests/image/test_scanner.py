@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+'''Test the image scanner
+'''
+
+import sys
+import pytest
+import os
+import cv2
+import numpy
+from cuav.image import scanner
+
+scan_parms = {
+    'MetersPerPixel' : 0.1,
+    'MinRegionArea' : 0.15,
+    'MaxRegionArea' : 1.0,
+    'MinRegionSize' : 0.2,
+    'MaxRegionSize' : 1.0,
+    'MaxRarityPct' : 0.02,
+    'RegionMergeSize' : 1.0,
+}
+
+def load_image(name='test-8bit.png'):
+    return cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', name))
+
+def test_scan():
+    im = load_image()
+    regions = scanner.scan(im, scan_parms)
+    assert len(regions) > 0
+    for (x1, y1, x2, y2, score) in regions:
+        assert 0 <= x1 <= x2 < 1280
+        assert 0 <= y1 <= y2 < 960
+        assert score >= 0
+
+def test_scan_regions():
+    # the regions found in the test images. The size limits apply to
+    # the bounding box areas of the labelled regions, not pixel counts
+    expected = {
+        ('test-8bit.png', 0.1) : [(1115, 481, 1121, 485), (1054, 887, 1061, 892)],
+        ('test-8bit.png', 0.2) : [(1100, 501, 1101, 502), (1089, 514, 1092, 516),
+                                  (1088, 518, 1089, 519), (1080, 523, 1083, 525)],
+        ('raw2016111223465160Z.png', 0.2) : [(737, 211, 738, 212), (693, 253, 701, 257),
+                                             (622, 293, 623, 294), (602, 309, 603, 310),
+                                             (566, 347, 571, 351), (522, 375, 528, 377),
+                                             (502, 380, 516, 393), (409, 490, 410, 491),
+                                             (310, 559, 322, 575), (292, 568, 296, 571),
+                                             (278, 577, 286, 586)],
+        ('raw2016111223465213Z.png', 0.1) : [(812, 364, 868, 409), (712, 437, 772, 486),
+                                             (606, 525, 644, 559), (496, 597, 550, 635)],
+        }
+    for ((name, mpp), bounds) in expected.items():
+        regions = scanner.scan(load_image(name), dict(scan_parms, MetersPerPixel=mpp))
+        assert [r[:4] for r in regions] == bounds
+
+def test_Scanner():
+    im = load_image()
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert (s.width, s.height) == (1280, 960)
+    assert s.scan(im) == scanner.scan(im, scan_parms)
+    # buffers are re-used between frames
+    im2 = load_image('raw2016111223465160Z.png')
+    assert s.scan(im2) == scanner.scan(im2, scan_parms)
+    assert s.scan(im) == scanner.scan(im, scan_parms)
+
+def test_Scanner_allocations():
+    im = load_image()
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert s.allocations() == {'count' : 0, 'bytes' : 0}
+    s.scan(im)
+    allocs = s.allocations()
+    assert allocs['count'] > 0 and allocs['bytes'] > 0
+    # the buffers are kept, so the same scan allocates nothing more
+    s.scan(im)
+    assert s.allocations() == allocs
+    s.update_params(dict(scan_parms, Pyramid=2.0))
+    s.scan(im)
+    assert s.allocations()['bytes'] > allocs['bytes']
+
+def test_Scanner_update_params():
+    im = load_image()
+    s = scanner.Scanner(1280, 960)
+    assert s.scan(im) == scanner.scan(im)
+    s.update_params(scan_parms)
+    assert s.scan(im) == scanner.scan(im, scan_parms)
+    s.update_params(None)
+    assert s.scan(im) == scanner.scan(im)
+
+def test_Scanner_bad_image():
+    s = scanner.Scanner(640, 480, scan_parms)
+    with pytest.raises(scanner.error):
+        s.scan(load_image())
+    with pytest.raises(TypeError):
+        s.update_params(3)
+    # a scanner which was never initialised
+    s = scanner.Scanner.__new__(scanner.Scanner)
+    for f in [s.timings, s.allocations, s.reset_history]:
+        with pytest.raises(scanner.error):
+            f()
+
+def test_scan_threads():
+    im = load_image('raw2016111223465213Z.png')
+    regions = scanner.scan(im, scan_parms)
+    for threads in [2, 3, 4, 16]:
+        assert scanner.scan(im, scan_parms, threads=threads) == regions
+    s = scanner.Scanner(1280, 960, scan_parms, threads=4)
+    assert s.threads == 4
+    assert s.scan(im) == regions
+    s.threads = 1
+    assert s.scan(im) == regions
+
+def test_scan_busy():
+    # a low rarity threshold gives many thousands of candidate pixels
+    im = load_image('raw2016111223465213Z.png')
+    parms = dict(scan_parms, MaxRarityPct=0.2)
+    regions = scanner.scan(im, parms)
+    assert len(regions) > 0
+    for (x1, y1, x2, y2, score) in regions:
+        assert 0 <= x1 <= x2 < 1280
+        assert 0 <= y1 <= y2 < 960
+    s = scanner.Scanner(1280, 960, parms)
+    assert s.scan(im) == regions
+    assert scanner.scan(im, parms, threads=4) == regions
+
+def test_scan_many_regions():
+    # a textured scene with thousands of small coloured patches
+    rng = numpy.random.RandomState(1)
+    im = (rng.rand(960, 1280, 3)*40+100).astype(numpy.uint8)
+    for i in range(2000):
+        x, y = rng.randint(0, 1270), rng.randint(0, 950)
+        im[y:y+rng.randint(1, 10), x:x+rng.randint(1, 10)] = rng.randint(0, 255, 3)
+    parms = dict(scan_parms, MaxRarityPct=1.0, MinRegionArea=0.01, MinRegionSize=0.01)
+    regions = scanner.scan(im, parms)
+    assert len(regions) > 10
+    for (x1, y1, x2, y2, score) in regions:
+        assert 0 <= x1 <= x2 < 1280
+        assert 0 <= y1 <= y2 < 960
+    assert scanner.Scanner(1280, 960, parms).scan(im) == regions
+
+def test_scan_as_array():
+    im = load_image()
+    regions = scanner.scan(im, scan_parms)
+    arr = scanner.scan(im, scan_parms, as_array=True)
+    assert arr.dtype == scanner.region_dtype
+    assert arr.dtype.names == ('x1', 'y1', 'x2', 'y2', 'score', 'pixel_count')
+    assert [tuple(r)[:4] + (float(r['score']),) for r in arr] == regions
+    assert (arr['pixel_count'] > 0).all()
+    area = (arr['x2'].astype(int) - arr['x1'] + 1) * (arr['y2'].astype(int) - arr['y1'] + 1)
+    assert (arr['pixel_count'] <= area).all()
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert (s.scan(im, as_array=True) == arr).all()
+    assert s.scan(im) == regions
+
+def test_simd():
+    kernels = scanner.simd_selftest()
+    assert kernels[-1] == 'scalar'
+    assert scanner.get_simd() in kernels
+    simd = scanner.get_simd()
+    im = load_image('raw2016111223465213Z.png')
+    parms = dict(scan_parms, BlueEmphasis=1.0)
+    try:
+        scanner.set_simd('scalar')
+        expected = [scanner.scan(im, scan_parms), scanner.scan(im, parms)]
+        for k in kernels:
+            scanner.set_simd(k)
+            assert scanner.get_simd() == k
+            assert [scanner.scan(im, scan_parms), scanner.scan(im, parms)] == expected
+    finally:
+        scanner.set_simd(simd)
+    with pytest.raises(scanner.error):
+        scanner.set_simd('mmx')
+
+def test_scan_view():
+    # a strided view scans the same as a contiguous copy
+    im = load_image('raw2016111223465213Z.png')
+    big = numpy.zeros((960, 1400, 3), dtype=numpy.uint8)
+    big[:, 60:1340] = im
+    view = big[:, 60:1340]
+    assert not view.flags['C_CONTIGUOUS']
+    regions = scanner.scan(im, scan_parms)
+    assert scanner.scan(view, scan_parms) == regions
+    assert scanner.scan(view, scan_parms, threads=4) == regions
+    assert scanner.Scanner(1280, 960, scan_parms).scan(view) == regions
+
+def test_scan_roi():
+    im = load_image('raw2016111223465213Z.png')
+    regions = scanner.scan(im, scan_parms)
+    assert scanner.scan(im, scan_parms, roi=(0, 0, 1280, 960)) == regions
+    roi = (320, 240, 640, 480)
+    sub = scanner.scan(im, scan_parms, roi=roi)
+    for (x1, y1, x2, y2, score) in sub:
+        assert 320 <= x1 <= x2 < 960
+        assert 240 <= y1 <= y2 < 720
+    arr = scanner.scan(im, scan_parms, roi=roi, as_array=True)
+    assert [tuple(r)[:4] + (float(r['score']),) for r in arr] == sub
+    # a Scanner is sized for the whole frame
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert s.scan(im, roi=roi) == sub
+    assert s.scan(im) == regions
+
+def test_scan_mask():
+    im = load_image('raw2016111223465213Z.png')
+    regions = scanner.scan(im, scan_parms)
+    assert len(regions) > 0
+    mask = numpy.zeros((960, 1280), dtype=numpy.uint8)
+    assert scanner.scan(im, scan_parms, mask=mask) == regions
+    (x1, y1, x2, y2, score) = regions[0]
+    mask[max(y1-5, 0):y2+6, max(x1-5, 0):x2+6] = 1
+    masked = scanner.scan(im, scan_parms, mask=mask)
+    for (mx1, my1, mx2, my2, score) in masked:
+        assert not mask[my1:my2+1, mx1:mx2+1].all()
+    assert regions[0][:4] not in [r[:4] for r in masked]
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert s.scan(im, mask=mask) == masked
+
+def test_scan_bad_roi_mask():
+    im = load_image()
+    with pytest.raises(scanner.error):
+        scanner.scan(im, scan_parms, roi=(1000, 0, 640, 480))
+    with pytest.raises(scanner.error):
+        scanner.scan(im, scan_parms, mask=numpy.zeros((480, 640), dtype=numpy.uint8))
+    with pytest.raises(scanner.error):
+        scanner.scan(im, scan_parms, mask=numpy.zeros((960, 1280), dtype=numpy.float32))
+    with pytest.raises(scanner.error):
+        scanner.Scanner(1280, 960, scan_parms).scan(im, roi=(0, 0, 1281, 960))
+
+def test_scan_pyramid():
+    im = load_image()
+    target = scanner.scan(im, scan_parms)[-1]
+    for pyramid in [2.0, 4.0]:
+        parms = dict(scan_parms, Pyramid=pyramid)
+        regions = scanner.scan(im, parms)
+        # the target is found again, with bounds refined at full resolution
+        found = [r for r in regions if r[0] <= target[2] and target[0] <= r[2] and
+                 r[1] <= target[3] and target[1] <= r[3]]
+        assert len(found) == 1
+        assert abs(found[0][0] - target[0]) <= 2 and abs(found[0][2] - target[2]) <= 2
+        assert found[0][4] > 0
+        assert scanner.scan(im, parms, threads=4) == regions
+        assert scanner.Scanner(1280, 960, parms).scan(im) == regions
+        # masking the target removes it
+        mask = numpy.zeros((960, 1280), dtype=numpy.uint8)
+        mask[target[1]-4:target[3]+5, target[0]-4:target[2]+5] = 1
+        masked = scanner.scan(im, parms, mask=mask)
+        assert found[0] not in masked
+        for (x1, y1, x2, y2, score) in scanner.scan(im, parms, roi=(960, 720, 320, 240)):
+            assert 960 <= x1 <= x2 < 1280
+            assert 720 <= y1 <= y2 < 960
+
+def test_scan_pyramid_too_large():
+    # a 14 pixel target is over MaxRegionSize at 0.1m/px. The coarse
+    # scan allows it, but it is dropped at full resolution
+    rng = numpy.random.RandomState(2)
+    im = rng.randint(90, 110, (960, 1280, 3)).astype(numpy.uint8)
+    im[400:414, 400:414] = (20, 20, 230)
+    im[600:606, 700:706] = (230, 20, 20)
+    assert [r[:4] for r in scanner.scan(im, scan_parms)] == [(700, 600, 705, 605)]
+    for pyramid in [2.0, 4.0]:
+        regions = scanner.scan(im, dict(scan_parms, Pyramid=pyramid))
+        assert [r[:4] for r in regions] == [(700, 600, 705, 605)]
+    # regions from the test image keep within the full resolution limits
+    max_size = scan_parms['MaxRegionSize'] / scan_parms['MetersPerPixel']
+    for pyramid in [2.0, 4.0]:
+        for (x1, y1, x2, y2, score) in scanner.scan(load_image(), dict(scan_parms, Pyramid=pyramid)):
+            assert x2 - x1 <= max_size and y2 - y1 <= max_size
+
+def test_scan_histogram_decay():
+    im = load_image('raw2016111223465213Z.png')
+    im2 = load_image('raw2016111223465160Z.png')
+    regions = scanner.scan(im, scan_parms)
+    parms = dict(scan_parms, HistogramDecay=0.8)
+    # the first frame has no history
+    assert scanner.scan(im, parms) == regions
+    s = scanner.Scanner(1280, 960, parms)
+    assert s.scan(im) == regions
+    # a steady scene keeps the same histogram and colour bins
+    for i in range(3):
+        assert s.scan(im) == regions
+        assert s.scan(im, roi=(320, 240, 640, 480)) == scanner.scan(im, parms, roi=(320, 240, 640, 480))
+    # a new scene is judged against the history until it is reset
+    s.scan(im2)
+    s.reset_history()
+    assert s.scan(im2) == scanner.scan(im2, scan_parms)
+    assert scanner.Scanner(1280, 960, parms, threads=4).scan(im) == regions
+
+def test_scan_histogram_decay_update_params():
+    im = load_image('raw2016111223465213Z.png')
+    im2 = load_image('raw2016111223465160Z.png')
+    parms = dict(scan_parms, HistogramDecay=0.8)
+    parms2 = dict(parms, MetersPerPixel=0.12)
+    s = scanner.Scanner(1280, 960, parms)
+    s.scan(im)
+    # a new MetersPerPixel, as given for each frame, keeps the history
+    s.update_params(parms2)
+    s2 = scanner.Scanner(1280, 960, parms2)
+    s2.scan(im)
+    regions = s.scan(im2)
+    assert regions == s2.scan(im2)
+    assert regions != scanner.scan(im2, parms2)
+    # a setting that changes the histogram restarts it
+    parms3 = dict(parms2, HistogramDecay=0.5)
+    s.update_params(parms3)
+    assert s.scan(im2) == scanner.scan(im2, parms3)
+    s.update_params(dict(parms3, BlueEmphasis=1.0))
+    assert s.scan(im) == scanner.scan(im, dict(parms3, BlueEmphasis=1.0))
+
+def test_scan_capture():
+    im = load_image()
+    im2 = load_image('raw2016111223465213Z.png')
+    s = scanner.Scanner(1280, 960, scan_parms)
+    assert s.capture == 0
+    regions = s.scan(im)
+    with pytest.raises(scanner.error):
+        s.intermediates()
+    s.capture = 2
+    assert s.scan(im) == regions
+    stages = s.intermediates()
+    assert sorted(stages.keys()) == ['1original', '1unquantised', '2thresholded', '3neighbours',
+                                     '4regions', '5prunelarge', '6merged', '7pruned']
+    for img in stages.values():
+        assert img.shape == (960, 1280, 3)
+        assert img.dtype == numpy.uint8
+    assert (stages['1original'] == im).all()
+    # a bounded ring of recent scans
+    s.scan(im2)
+    assert (s.intermediates()['1original'] == im2).all()
+    assert (s.intermediates(1)['1original'] == im).all()
+    s.scan(im2)
+    with pytest.raises(scanner.error):
+        s.intermediates(2)
+    s.capture = 0
+    with pytest.raises(scanner.error):
+        s.intermediates()
+    # the coarse stages of a pyramid scan are at the downsampled size
+    s = scanner.Scanner(1280, 960, dict(scan_parms, Pyramid=2.0))
+    s.capture = 1
+    s.scan(im)
+    stages = s.intermediates()
+    assert stages['1original'].shape == (480, 640, 3)
+    assert stages['8refined'].shape == (960, 1280, 3)
+
+def test_scan_timings():
+    im = load_image()
+    s = scanner.Scanner(1280, 960, scan_parms)
+    s.scan(im)
+    t = s.timings()
+    assert t['quantise'] > 0 and t['histogram'] > 0
+    assert t['downsample'] == 0 and t['refine'] == 0
+    s.update_params(dict(scan_parms, Pyramid=2.0))
+    s.scan(im)
+    t = s.timings()
+    assert t['downsample'] > 0 and t['refine'] > 0
+
+def thermal_image(values):
+    '''a 16 bit big endian thermal image from 14 bit values'''
+    return (numpy.asarray(values) << 2).astype('>u2').view(numpy.uint16)
+
+def test_thermal_convert():
+    rng = numpy.random.RandomState(2)
+    im = thermal_image(rng.randint(5000, 7000, (120, 160)))
+    out = numpy.zeros((120, 160, 3), dtype=numpy.uint8)
+    scanner.thermal_convert(im, out, 6100, 0.75, 0.4)
+    values = (im.astype('<u2').byteswap() >> 2).astype(int)
+    # hot pixels are red and cold pixels are dark
+    assert (out[values >= 6100][:, 2] == 255).all()
+    assert (out[values == values.min()] == 0).all()
+    # the same values always give the same colour
+    out2 = numpy.zeros((120, 160, 3), dtype=numpy.uint8)
+    scanner.thermal_convert(im, out2, 6100, 0.75, 0.4)
+    assert (out == out2).all()
+    scanner.thermal_convert(im, out2, 6500, 0.5, 0.2)
+    assert (out != out2).any()
+    with pytest.raises(scanner.error):
+        scanner.thermal_convert(im, numpy.zeros((100, 160, 3), dtype=numpy.uint8), 6100, 0.75, 0.4)
+
+def test_thermal_scan():
+    rng = numpy.random.RandomState(3)
+    values = rng.randint(5000, 5400, (512, 640))
+    values[100:106, 200:207] = 7000
+    values[300:303, 50:60] = 8000
+    values[400, 400] = 9000
+    im = thermal_image(values)
+    regions = scanner.thermal_scan(im, 6100)
+    assert [r[:4] for r in regions] == [(200, 100, 206, 105), (50, 300, 59, 302)]
+    # hotter regions score higher
+    assert 0 < regions[0][4] < regions[1][4]
+    arr = scanner.thermal_scan(im, 6100, as_array=True)
+    assert [tuple(r)[:4] + (float(r['score']),) for r in arr] == regions
+    assert list(arr['pixel_count']) == [42, 30]
+    assert scanner.thermal_scan(im, 9500) == []
+    with pytest.raises(scanner.error):
+        scanner.thermal_scan(numpy.zeros((512, 640), dtype=numpy.uint8), 6100)
+
+def test_rect_extract_many():
+    im = load_image()
+    rects = [(100, 200, 50, 50), (-10, -20, 50, 50), (1260, 950, 50, 50), (300, 300, 150, 150)]
+    thumbs = scanner.rect_extract_many(im, rects, 50)
+    assert thumbs.shape == (4, 50, 50, 3)
+    assert (thumbs[0] == im[200:250, 100:150]).all()
+    # past the edges of the image is black
+    assert (thumbs[1][20:, 10:] == im[:30, :40]).all()
+    assert not thumbs[1][:20].any() and not thumbs[1][:, :10].any()
+    assert (thumbs[2][:10, :20] == im[950:, 1260:]).all()
+    assert not thumbs[2][10:].any() and not thumbs[2][:, 20:].any()
+    # larger rectangles are shrunk to fit
+    shrunk = cv2.resize(im[300:450, 300:450], (50, 50))
+    assert numpy.abs(thumbs[3].astype(int) - shrunk).max() <= 1
+    assert scanner.rect_extract_many(im, [], 50).shape == (0, 50, 50, 3)
+    with pytest.raises(scanner.error):
+        scanner.rect_extract_many(im, [(0, 0, 10)], 50)
@@ -3,9 +3,10 @@
 test program for cuav_joe
 '''
 
-import sys, os, time, random, functools
+import sys, os, time, random, functools, pickle
 import pytest
-from cuav.lib import cuav_joe, cuav_region, mav_position
+import numpy
+from cuav.lib import cuav_joe, cuav_region, mav_position, cuav_util
 from cuav.camera.cam_params import CameraParams
 
 
@@ -27,5 +28,155 @@ def test_JoeLog_JoeIterator():
     assert joeret[0] == "JoePosition(lat=-30.000235 lon=144.999639 MavPosition(pos -30.000000 145.000000 alt=34.6 roll=20.0 pitch=-56.7 yaw=345.0) img2017111312451230Z.png None (10, 10, 25, 23) latlon=(-30.000235126851315, 144.9996388367703) score=None Sat Nov 12 23:46:03 2016 2016111212460300Z)" or "JoePosition(lat=-30.000235 lon=144.999639 MavPosition(pos -30.000000 145.000000 alt=34.6 roll=20.0 pitch=-56.7 yaw=345.0) img2017111312451230Z.png None (10, 10, 25, 23) latlon=(-30.000235126851315, 144.9996388367703) score=None Sat Nov 12 12:46:03 2016 2016111212460300Z)"
     assert joeret[1] == "JoePosition(lat=-30.000367 lon=144.999711 MavPosition(pos -30.000000 145.000000 alt=34.6 roll=20.0 pitch=-56.7 yaw=345.0) img2017111312451230Z.png None (200, 205, 252, 236) latlon=(-30.000366794010567, 144.9997107272955) score=None Sat Nov 12 23:46:03 2016 2016111212460300Z)" or "JoePosition(lat=-30.000367 lon=144.999711 MavPosition(pos -30.000000 145.000000 alt=34.6 roll=20.0 pitch=-56.7 yaw=345.0) img2017111312451230Z.png None (200, 205, 252, 236) latlon=(-30.000366794010567, 144.9997107272955) score=None Sat Nov 12 12:46:03 2016 2016111212460300Z)"
     
+    joelog.close()
     os.remove(os.path.join('.', 'joe.log'))
-    
+    os.remove(cuav_joe.names_filename(os.path.join('.', 'joe.log')))
+
+
+def make_joes():
+    frame_time = 1478954763.0
+    pos = mav_position.MavPosition(-30, 145, 34.56, 20, -56.67, 345, frame_time)
+    r1 = cuav_region.Region(10, 10, 25, 23, (640, 480), scan_score=450)
+    r1.latlon = (-30.0002, 144.9996)
+    r1.score = 87.5
+    r2 = cuav_region.Region(200, 205, 252, 236, None, scan_score=420)
+    r2.latlon = (-30.0003, 144.9995)
+    return [((-30.0002, 144.9996), frame_time, r1, pos, 'img1.png', 'thumb1.jpg'),
+            ((-30.0003, 144.9995), frame_time+1, r2, None, 'img2.png', None)]
+
+
+def check_joes(joes):
+    expected = make_joes()
+    assert len(joes) == len(expected)
+    for (joe, e) in zip(joes, expected):
+        assert str(joe) == str(cuav_joe.JoePosition(*e))
+        assert joe.r.scan_shape == e[2].scan_shape
+        assert joe.r.scan_score == e[2].scan_score
+
+
+def test_JoeLog_binary(tmp_path):
+    logfile = str(tmp_path / 'joe.log')
+    joelog = cuav_joe.JoeLog(logfile, append=False)
+    for joe in make_joes():
+        joelog.add(*joe)
+    assert cuav_joe.is_binary_log(logfile)
+    # records are readable as soon as they are added
+    check_joes(cuav_joe.JoeIterator(logfile).getjoes())
+    joelog.close()
+
+    # appending reuses the filename ids
+    joelog = cuav_joe.JoeLog(logfile)
+    joelog.add(*make_joes()[0])
+    joelog.close()
+    assert cuav_joe.read_names(logfile) == ['img1.png', 'thumb1.jpg', 'img2.png']
+    recs = cuav_joe.read_records(logfile)
+    assert len(recs) == 3
+    assert recs['image_id'][2] == 0
+
+    # a partly written record is ignored
+    with open(logfile, 'ab') as f:
+        f.write(b'\0' * 10)
+    assert len(cuav_joe.JoeIterator(logfile).getjoes()) == 3
+
+
+def test_JoeLog_torn_write(tmp_path):
+    logfile = str(tmp_path / 'joe.log')
+    joelog = cuav_joe.JoeLog(logfile, append=False)
+    joelog.add(*make_joes()[0])
+    joelog.close()
+    # a record and a filename were being written when the program stopped
+    with open(logfile, 'ab') as f:
+        f.write(b'\0' * 10)
+    with open(cuav_joe.names_filename(logfile), 'a') as f:
+        f.write('img')
+    joelog = cuav_joe.JoeLog(logfile)
+    joelog.add(*make_joes()[1])
+    joelog.close()
+    check_joes(cuav_joe.JoeIterator(logfile).getjoes())
+    assert cuav_joe.read_names(logfile) == ['img1.png', 'thumb1.jpg', 'img2.png']
+
+    # a partly written header is started again
+    with open(logfile, 'wb') as f:
+        f.write(cuav_joe.joe_magic[:5])
+    joelog = cuav_joe.JoeLog(logfile)
+    assert not joelog.legacy
+    joelog.add(*make_joes()[0])
+    joelog.close()
+    assert len(cuav_joe.JoeIterator(logfile).getjoes()) == 1
+
+
+def test_JoeLog_pickle(tmp_path):
+    logfile = str(tmp_path / 'joe.log')
+    with open(logfile, 'wb') as f:
+        for joe in make_joes():
+            pickle.dump(cuav_joe.JoePosition(*joe), f)
+    assert not cuav_joe.is_binary_log(logfile)
+    check_joes(cuav_joe.JoeIterator(logfile).getjoes())
+
+    newfile = str(tmp_path / 'joe2.log')
+    assert cuav_joe.convert_log(logfile, newfile) == 2
+    check_joes(cuav_joe.JoeIterator(newfile).getjoes())
+
+    # an old log is appended to in the old format
+    joelog = cuav_joe.JoeLog(logfile)
+    joelog.add(*make_joes()[0])
+    joelog.close()
+    assert not cuav_joe.is_binary_log(logfile)
+    assert len(cuav_joe.JoeIterator(logfile).getjoes()) == 3
+
+
+def test_JoeIndex():
+    rng = numpy.random.RandomState(1)
+    lat = -35.36 + rng.uniform(-0.01, 0.01, 5000)
+    lon = 149.16 + rng.uniform(-0.01, 0.01, 5000)
+    lat[::10] = numpy.nan
+    t = 1478954763.0 + rng.uniform(0, 100, 5000)
+    index = cuav_joe.JoeIndex(cell_size=30)
+    assert len(index.nearest(-35.36, 149.16, 3)) == 0
+    index.add_many(lat[:4000], lon[:4000], t[:4000])
+    for i in range(4000, 5000):
+        assert index.add(lat[i], lon[i], t[i]) == i
+    assert len(index) == 5000
+
+    for (qlat, qlon) in [(-35.36, 149.16), (-35.368, 149.151), (-35.2, 149.3)]:
+        distances = cuav_util.gps_distance_many(qlat, qlon, lat, lon)
+        assert numpy.array_equal(index.radius(qlat, qlon, 80), numpy.flatnonzero(distances <= 80))
+        distances[numpy.isnan(distances)] = numpy.inf
+        expected = numpy.argsort(distances, kind='mergesort')[:7]
+        assert numpy.array_equal(index.nearest(qlat, qlon, 7), expected)
+    inside = (lat >= -35.362) & (lat <= -35.358) & (lon >= 149.155) & (lon <= 149.157)
+    assert numpy.array_equal(index.bbox(-35.358, 149.157, -35.362, 149.155), numpy.flatnonzero(inside))
+
+    (t1, t2) = sorted([t[7], t[8]])
+    found = index.time_range(t1, t2)
+    assert numpy.array_equal(numpy.sort(found), numpy.flatnonzero((t >= t1) & (t <= t2)))
+    assert (numpy.diff(t[found]) >= 0).all()
+    assert numpy.array_equal(numpy.sort(index.time_range(1478954800.0, None)), numpy.flatnonzero(t >= 1478954800.0))
+    assert (numpy.diff(t[index.time_range(None, None)]) >= 0).all()
+
+    # moving an entry moves it in the grid
+    index.update(5, -35.2, 149.3, t[5])
+    assert index.nearest(-35.2, 149.3)[0] == 5
+    assert not 5 in index.radius(lat[5], lon[5], 1.0)
+    index.update(5, None, None, t[5])
+    assert index.position(5) == (None, None, t[5])
+    assert index.nearest(-35.2, 149.3)[0] != 5
+
+
+def test_JoeLog_index(tmp_path):
+    logfile = str(tmp_path / 'joe.log')
+    joelog = cuav_joe.JoeLog(logfile, append=False, index=True)
+    for joe in make_joes():
+        joelog.add(*joe)
+    joelog.close()
+    # the index of an existing log is rebuilt when it is appended to
+    joelog = cuav_joe.JoeLog(logfile, index=True)
+    joe = make_joes()[1]
+    joelog.add((-30.1, 145.1), joe[1]+10, joe[2], joe[3], joe[4], joe[5])
+    assert len(joelog.index) == 3
+    assert list(joelog.index.radius(-30.0002, 144.9996, 20)) == [0, 1]
+    assert list(joelog.index.nearest(-30.1, 145.1, 1)) == [2]
+    assert list(joelog.index.time_range(1478954764.0, None)) == [1, 2]
+    joes = cuav_joe.read_joes(logfile, joelog.index.radius(-30.0002, 144.9996, 20))
+    check_joes(joes)
+    joelog.close()
@@ -45,3 +45,22 @@ def test_calcLandingZone():
     assert ret == True
 
 
+
+def test_LandingZone_outliers():
+    lz = cuav_landingregion.LandingZone()
+    for i in range(20):
+        r = cuav_region.Region(1020, 658, 1050, 678, (30, 30))
+        r.latlon = (-35.0 + 0.00001*(i%3), 149.0)
+        if i == 7:
+            # far away
+            r.latlon = (-35.01, 149.0)
+        r.score = 100 + i
+        pos = mav_position.MavPosition(r.latlon[0], r.latlon[1], 80, i % 4, 0, 0, 1)
+        lz.checkaddregion(r, pos)
+    assert len(lz.regions) == 20
+    assert lz.regions[5].angle == 1 and lz.regions[5].yaw == 0
+    ret = lz.calclandingzone()
+    assert ret.numregions < 20
+    assert abs(ret.latlon[0] + 35.0) < 0.00002
+    assert ret.maxrange < 15
+    assert lz.calclandingzone() is ret
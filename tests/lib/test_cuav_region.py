@@ -6,6 +6,7 @@ test program for cuav_region
 import sys, os, time, random, functools, cv2
 import pytest
 import numpy as np
+import pickle
 from cuav.lib import cuav_region, cuav_util
 from cuav.lib.cuav_util import SubImage
 from cuav.lib import mav_position
@@ -52,6 +53,18 @@ def test_raw_hsv_score():
     assert score[5] > 0
     assert score[6] > 0
 
+def test_raw_hsv_score_classes():
+    # blue, red, yellow, bright, saturated and plain pixels
+    hsv = np.array([[(10, 100, 100), (120, 200, 200), (88, 200, 200),
+                     (40, 150, 200), (75, 150, 100), (40, 20, 200)]], dtype=np.uint8)
+    (score, scorix, blue_count, red_count, avg_v, s_range, v_range) = cuav_region.raw_hsv_score(hsv)
+    assert list(scorix[0]) == [3, 1, 1, 1, 1, 0]
+    assert score == 500 * 7.0 / 6
+    assert (blue_count, red_count) == (1, 2)
+    assert avg_v == 1000 / 6.0
+    assert (s_range, v_range) == (180, 100)
+    assert cuav_region.image_whiteness(hsv) == 1 / 6.0
+
 def test_log_scaling():
     assert cuav_region.log_scaling(20, 2) == 5.991464547107982
     assert cuav_region.log_scaling(1, 20) == 20
@@ -103,6 +116,18 @@ def test_filter_boundary():
     assert ret[1].score == 32
 
 
+def test_filter_boundary_array():
+    OBC_boundary = cuav_util.polygon_load(os.path.join(os.getcwd(), 'tests', 'testdata', 'OBC_boundary.txt'))
+    regions = np.zeros(3, dtype=cuav_region.region_dtype)
+    regions['score'] = (20, 32, 5)
+    regions['lat'] = (-26.6398870, -26.6418700, np.nan)
+    regions['lon'] = (151.8220000, 151.8709260, np.nan)
+    pos = mav_position.MavPosition(-30, 145, 34.56, 20, -56.67, 345, frame_time=None)
+    ret = cuav_region.filter_boundary(regions, list(OBC_boundary), pos)
+    assert list(ret['score']) == [0, 32, 0]
+    assert len(cuav_region.filter_boundary(regions, OBC_boundary)) == 0
+
+
 def test_filter_radius():
     regions = []
     regOne = cuav_region.Region(1020, 658, 1050, 678, (30, 30))
@@ -126,3 +151,121 @@ def test_CompositeThumbnail():
     im_orig = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'test-8bit.png'))
     composite = cuav_region.CompositeThumbnail(im_orig, regions)
     assert cuav_util.image_shape(composite) == (300, 100)
+
+def test_RegionsConvert_array():
+    regions = np.zeros(2, dtype=[('x1', 'u2'), ('y1', 'u2'), ('x2', 'u2'), ('y2', 'u2'),
+                                 ('score', 'f4'), ('pixel_count', 'u4')])
+    regions[0] = (200, 100, 204, 103, 200, 12)
+    regions[1] = (250, 150, 254, 153, 10, 20)
+    regionsout = cuav_region.RegionsConvert(regions, (640, 480), (1280, 960))
+    assert regionsout.dtype == cuav_region.region_dtype
+    assert len(regionsout) == 2
+    assert tuple(regionsout[0])[:6] == (400, 200, 408, 206, 200, 12)
+    assert np.isnan(regionsout['score']).all()
+    ret = cuav_region.RegionsFromArray(regionsout, (640, 480))
+    assert ret[1].tuple() == (500, 300, 508, 306)
+    assert ret[1].scan_score == 10
+    assert ret[1].score is None and ret[1].latlon is None
+
+def test_filter_regions_array():
+    im_orig = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'test-8bit.png'))
+    regions = [cuav_region.Region(1020, 658, 1050, 678, (30, 30), scan_score=20),
+               cuav_region.Region(30, 54, 50, 74, (20, 20), scan_score=15),
+               cuav_region.Region(1270, 950, 1279, 959, (20, 20), scan_score=15)]
+    arr = np.zeros(len(regions), dtype=cuav_region.region_dtype)
+    for i, r in enumerate(regions):
+        arr[i] = r.tuple() + (r.scan_score, 1, np.nan, np.nan, np.nan)
+    expected = cuav_region.filter_regions(im_orig, regions, min_score=0)
+    ret = cuav_region.filter_regions(im_orig, arr, min_score=0)
+    assert np.allclose(ret['score'], [r.score for r in expected])
+    ret = cuav_region.filter_regions(im_orig, arr, filter_type='simple')
+    assert len(ret) == 1
+    assert ret[0]['scan_score'] == 20
+    assert ret[0]['score'] > 4
+
+def test_filter_radius_array():
+    regions = np.zeros(3, dtype=cuav_region.region_dtype)
+    regions['score'] = (20, 32, 5)
+    regions['lat'] = (-26.6398870, -26.6418700, np.nan)
+    regions['lon'] = (151.8220000, 151.8709260, np.nan)
+    ret = cuav_region.filter_radius(regions, (-26.6415, 151.8715), 200)
+    assert len(ret) == 3
+    assert list(ret['score']) == [0, 32, 0]
+
+def test_georef_regions():
+    from cuav.camera.cam_params import CameraParams
+    C = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1024, yresolution=800)
+    pos = mav_position.MavPosition(-50, 145, 120, 0, 0, 90, 1478954763.0)
+    regions = [cuav_region.Region(10, 10, 25, 23, None, scan_score=450),
+               cuav_region.Region(500, 390, 524, 410, None, scan_score=20)]
+    arr = np.zeros(len(regions), dtype=cuav_region.region_dtype)
+    for i, r in enumerate(regions):
+        arr[i] = r.tuple() + (r.scan_score, 1, np.nan, np.nan, np.nan)
+    expected = [cuav_util.gps_position_from_image_region(r, pos, 1024, 800, C=C) for r in regions]
+    ret = cuav_region.georef_regions(regions, pos, C, 1024, 800)
+    ret_arr = cuav_region.georef_regions(arr, pos, C, 1024, 800)
+    for i in range(len(regions)):
+        assert np.allclose(ret[i].latlon, expected[i], rtol=0, atol=1.0e-9)
+        assert np.allclose((ret_arr['lat'][i], ret_arr['lon'][i]), expected[i], rtol=0, atol=1.0e-9)
+    ret = cuav_region.georef_regions(regions, None, C, 1024, 800)
+    assert ret[0].latlon is None and ret[1].latlon is None
+    assert cuav_region.georef_regions([], pos, C, 1024, 800) == []
+
+def test_Region_pickle():
+    r = cuav_region.Region(1020, 658, 1050, 678, (1280, 960), scan_score=20)
+    r.latlon = (-26.64, 151.87)
+    r.angle = 5
+    r2 = pickle.loads(pickle.dumps(r))
+    assert r2.tuple() == r.tuple() and r2.latlon == r.latlon and r2.angle == 5
+    assert not hasattr(r2, 'yaw')
+
+def test_RegionSet():
+    rs = cuav_region.RegionSet()
+    for i in range(40):
+        r = cuav_region.Region(i, 10, i+5, 20, (1280, 960), scan_score=i)
+        r.score = 2*i
+        if i % 2:
+            r.latlon = (-35.0, 149.0+i)
+        rs.append(r, angle=i/10.0)
+    assert len(rs) == 40
+    v = rs[3]
+    assert v.tuple() == (3, 10, 8, 20) and v.center() == (5, 15)
+    assert v.scan_shape == (1280, 960)
+    assert (v.scan_score, v.score, v.latlon, v.angle, v.yaw) == (3, 6, (-35.0, 152.0), 0.3, None)
+    assert rs[2].latlon is None
+    assert rs[-1].x1 == 39
+    # views write through to the set
+    v.score = None
+    assert np.isnan(rs['score'][3])
+    assert [r.x1 for r in rs][:3] == [0, 1, 2]
+    # pickling a view gives a plain Region
+    r = pickle.loads(pickle.dumps(v))
+    assert isinstance(r, cuav_region.Region)
+    assert r.tuple() == v.tuple() and r.score is None and r.angle == 0.3
+    rs2 = pickle.loads(pickle.dumps(rs))
+    assert (rs2['x1'] == rs['x1']).all()
+    assert [str(r) for r in rs2.regions()] == [str(r) for r in rs]
+
+def test_RegionSet_no_scan_shape():
+    rs = cuav_region.RegionSet()
+    r = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    v = rs.append(r)
+    assert v.scan_shape is None
+    assert v.region().scan_shape is None
+    v.scan_shape = (640, 480)
+    assert rs[0].scan_shape == (640, 480)
+    v.scan_shape = None
+    assert rs[0].scan_shape is None
+    rs.extend(np.zeros(1, dtype=cuav_region.region_dtype))
+    assert rs[1].scan_shape is None
+
+def test_RegionSet_array():
+    regions = np.zeros(2, dtype=cuav_region.region_dtype)
+    regions[0] = (200, 100, 204, 103, 200, 12, np.nan, np.nan, np.nan)
+    regions[1] = (250, 150, 254, 153, 10, 20, 5, -35, 149)
+    rs = cuav_region.RegionSet(cuav_region.RegionSet())
+    rs.extend(regions, (1280, 960))
+    assert len(rs) == 2
+    assert rs[0].score is None and rs[0].latlon is None and rs[0].whiteness is None
+    assert rs[1].score == 5 and rs[1].latlon == (-35, 149)
+    assert rs[1].scan_shape == (1280, 960)
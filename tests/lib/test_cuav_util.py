@@ -5,6 +5,7 @@ tests for cuav_util.py
 
 import sys, os, time, random, functools, math, cv2
 import pytest
+import numpy
 from cuav.lib.cuav_util import *
 from cuav.camera.cam_params import CameraParams
 from cuav.lib import mav_position, cuav_region
@@ -43,6 +44,43 @@ def test_gps_newpos():
     assert abs(-50.47527 - newlat) < 0.001
     assert abs(145.27276 - newlon) < 0.001
 
+def test_gps_many():
+    rand = numpy.random.RandomState(1)
+    lat1 = rand.uniform(-60, 60, 50)
+    lon1 = rand.uniform(-180, 180, 50)
+    lat2 = lat1 + rand.uniform(-0.5, 0.5, 50)
+    lon2 = lon1 + rand.uniform(-0.5, 0.5, 50)
+    bearing = rand.uniform(0, 360, 50)
+    distance = rand.uniform(0, 5000, 50)
+    dist = gps_distance_many(lat1, lon1, lat2, lon2)
+    bearings = gps_bearing_many(lat1, lon1, lat2, lon2)
+    (newlat, newlon) = gps_newpos_many(lat1, lon1, bearing, distance)
+    for i in range(50):
+        assert abs(dist[i] - gps_distance(lat1[i], lon1[i], lat2[i], lon2[i])) < 1.0e-6
+        assert abs(bearings[i] - gps_bearing(lat1[i], lon1[i], lat2[i], lon2[i])) < 1.0e-9
+        (lat, lon) = gps_newpos(lat1[i], lon1[i], bearing[i], distance[i])
+        assert abs(newlat[i] - lat) < 1.0e-9
+        assert abs(newlon[i] - lon) < 1.0e-9
+
+    # one to many, with a missing position
+    dist = gps_distance_many(-50.5, 145.34, [-50.51, -50.1, numpy.nan], [145.37, 145.1, numpy.nan])
+    assert abs(2398 - dist[0]) < 1
+    assert abs(47685 - dist[1]) < 1
+    assert numpy.isnan(dist[2])
+
+def test_ENUProjector():
+    proj = ENUProjector(-35.36, 149.16)
+    (lats, lons) = gps_newpos_many(-35.36, 149.16, [0, 90, 225, 300], [1000, 500, 800, 10])
+    (east, north) = proj.to_enu(lats, lons)
+    assert numpy.allclose(numpy.hypot(east, north), [1000, 500, 800, 10], atol=0.05)
+    assert abs(north[0] - 1000) < 0.05 and abs(east[0]) < 0.01
+    assert abs(east[1] - 500) < 0.05
+    (lat, lon) = proj.from_enu(east, north)
+    assert numpy.allclose(lat, lats, rtol=0, atol=1.0e-12)
+    assert numpy.allclose(lon, lons, rtol=0, atol=1.0e-12)
+    (east, north) = proj.to_enu(-35.36, 149.16)
+    assert east == 0 and north == 0
+
 def test_angle_of_view():
     angle = angle_of_view(lens=4.0, sensorwidth=5.0)
     assert abs(64.01076 - angle) < 0.00001
@@ -125,6 +163,48 @@ def test_gps_position_from_image_region():
     assert abs(-49.99934 - lat) < 0.00001
     assert abs(145.00078 - lon) < 0.00001
     
+def test_georef_points():
+    C = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1024, yresolution=800)
+    pos = mav_position.MavPosition(-50, 145, 85, 3, 1, 45, 1478954763.0)
+    xs = [0, 200, 512, 1023, 700]
+    ys = [0, 100, 400, 799, 20]
+    (lats, lons) = georef_points(pos, C, xs, ys)
+    for i in range(len(xs)):
+        (lat, lon) = gps_position_from_xy(xs[i], ys[i], pos, C=C)
+        assert abs(lat - lats[i]) < 1.0e-9
+        assert abs(lon - lons[i]) < 1.0e-9
+
+    # half size image, and looking at the sky
+    (lats, lons) = georef_points(pos, C, [100, 256], [50, 200], shape=(512, 400))
+    assert abs(gps_position_from_xy(100, 50, pos, C=C, shape=(512, 400))[0] - lats[0]) < 1.0e-9
+    pos = mav_position.MavPosition(-50, 145, 85, 0, 80, 45, 1478954763.0)
+    (lats, lons) = georef_points(pos, C, [512, 512], [0, 799])
+    assert numpy.isnan(lats[0]) and numpy.isnan(lons[0])
+    assert gps_position_from_xy(512, 0, pos, C=C) is None
+    assert not numpy.isnan(lats[1])
+    assert numpy.isnan(georef_points(None, C, [1, 2], [3, 4])[0]).all()
+
+def test_pose_projection():
+    C = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1024, yresolution=768)
+    proj = pose_projection(123, 0.1, 2, 0, C)
+    assert pose_projection(123, 0.1, 2, 0, C) is proj
+    assert pose_projection(123, 0.1, 2, 1, C) is not proj
+    (east, north) = proj.project([100, 0], [100, 130])
+    assert abs(-67.3798 - east[0]) < 0.001
+    assert abs(43.6719 - north[0]) < 0.001
+
+    # the camera matrix and distortion are part of the key
+    C2 = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1024, yresolution=768,
+                      D=numpy.array([[-0.2, 0.05, 0.0, 0.0, 0.0]]))
+    proj2 = pose_projection(123, 0.1, 2, 0, C2)
+    assert proj2 is not proj and proj2.distorted
+    (east2, north2) = proj2.project([100], [100])
+    assert abs(east2[0] - east[0]) > 1
+
+    for i in range(pose_cache_size + 10):
+        pose_projection(100, 0, 0, i, C)
+    assert pose_projection(123, 0.1, 2, 0, C) is not proj
+
 def test_mkdir_p():
     dirry = os.path.join(os.getcwd(), 'tests1')
     assert os.path.isdir(dirry) == False
@@ -182,6 +262,31 @@ def test_polygon_outside():
     for lat, lon, outside in test_points:
         assert outside == polygon_outside((lat, lon), OBC_boundary)
 
+def test_PreparedPolygon():
+    OBC_boundary = polygon_load(os.path.join(os.getcwd(), 'tests', 'testdata', 'OBC_boundary.txt'))
+    assert isinstance(OBC_boundary, PreparedPolygon)
+    V = list(OBC_boundary)
+    (x1, y1, x2, y2) = OBC_boundary.bounds
+    rand = numpy.random.RandomState(1)
+    lats = rand.uniform(x1 - 0.01, x2 + 0.01, 5000)
+    lons = rand.uniform(y1 - 0.01, y2 + 0.01, 5000)
+    # points on the vertices and edges
+    t = numpy.linspace(0, 1, 20)
+    for i in range(len(V)-1):
+        lats = numpy.append(lats, V[i][0] + (V[i+1][0] - V[i][0]) * t)
+        lons = numpy.append(lons, V[i][1] + (V[i+1][1] - V[i][1]) * t)
+    expected = [not polygon_outside((lat, lon), V) for (lat, lon) in zip(lats, lons)]
+    for grid_size in [0, 8, 64]:
+        poly = PreparedPolygon(V, grid_size=grid_size)
+        assert list(poly.contains(lats, lons)) == expected
+        assert [not polygon_outside((lat, lon), poly) for (lat, lon) in zip(lats, lons)] == expected
+    assert OBC_boundary.contains(lats.reshape(-1, 10), lons.reshape(-1, 10)).shape == (len(lats)//10, 10)
+    # a self intersecting polygon
+    bowtie = [(0, 0), (1, 0), (0, 1), (1, 1)]
+    pts = rand.uniform(-0.2, 1.2, (2000, 2))
+    assert list(PreparedPolygon(bowtie).contains(pts[:,0], pts[:,1])) == [
+        not polygon_outside(p, bowtie) for p in pts]
+
 def test_polygon_complete():
     OBC_boundary = polygon_load(os.path.join(os.getcwd(), 'tests', 'testdata', 'OBC_boundary.txt'))
     assert polygon_complete(OBC_boundary)
@@ -240,3 +345,31 @@ def test_set_system_clock():
     #assert time.time() - curtime < 1
     
 
+
+def test_jpeg_shape(tmp_path):
+    im = cv2.imread(os.path.join('tests', 'testdata', 'test-8bit.png'))
+    fname = str(tmp_path / 'test.jpg')
+    cv2.imwrite(fname, im)
+    assert jpeg_shape(fname) == (1280, 960)
+    assert jpeg_shape(os.path.join('tests', 'testdata', 'test-8bit.png')) is None
+    assert jpeg_shape(str(tmp_path / 'missing.jpg')) is None
+
+def test_ImageFile(tmp_path):
+    im = cv2.imread(os.path.join('tests', 'testdata', 'test-8bit.png'))
+    fname = str(tmp_path / 'test.jpg')
+    cv2.imwrite(fname, im)
+    source = ImageFile(fname)
+    assert source.shape() == (1280, 960)
+    for scale in [2, 4, 8]:
+        assert image_shape(source.scaled(scale)) == (1280//scale, 960//scale)
+    # the full image has not been decoded
+    assert 1 not in source.images
+    assert (source.full() == cv2.imread(fname)).all()
+    assert source.scaled(2) is source.scaled(2)
+    # other formats are resized from the full image
+    png = ImageFile(os.path.join('tests', 'testdata', 'test-8bit.png'))
+    assert png.shape() == (1280, 960)
+    assert image_shape(png.scaled(2)) == (640, 480)
+    rotated = ImageFile(fname, rotate180=True)
+    assert (rotated.scaled(2) == source.scaled(2)[::-1, ::-1]).all()
+    assert ImageFile(str(tmp_path / 'missing.jpg')).full() is None
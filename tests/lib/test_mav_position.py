@@ -5,6 +5,7 @@ tests for rotmat.py
 
 import sys, os, time, random, functools, math, datetime, fractions
 import pytest
+import numpy
 from cuav.lib import mav_position
             
 
@@ -31,6 +32,84 @@ def test_MavInterpolator():
     posss = mpos.position(1478998416.34, 0,roll=None)
     assert posss.lat == -35.07964313826459 and posss.lon == 149.92248564626732
 
+class FakeMsg(object):
+    def __init__(self, t, **kw):
+        self._timestamp = t
+        self.__dict__.update(kw)
+
+def test_MavHistory():
+    h = mav_position.MavHistory(['roll'], 10)
+    assert len(h) == 0 and h.find(5) == -1
+    for i in range(95):
+        h.append(FakeMsg(i*0.5, roll=i), i*0.5)
+    # only the last 10 are kept, after the arrays have wrapped
+    assert len(h) == 10
+    assert list(h.values('roll')) == list(range(85, 95))
+    assert h[0].roll == 85 and h[-1].roll == 94
+    assert h.find(42.4) == -1
+    assert h.find(42.5) == 0
+    assert h.find(44.9) == 4
+    assert h.find(1000) == 9
+
+    # messages out of time order are found as with a linear search
+    h.append(FakeMsg(44.2, roll=100), 44.2)
+    assert h.find(46.9) == 9
+    assert h.find(44.1) == 2
+    for i in range(10):
+        h.append(FakeMsg(100+i, roll=i), 100+i)
+    assert h.find(104.5) == 4
+
+def test_position_many():
+    times = [1478994400.3, 1478994350.2, 1478994380.75, 1478994300.0, 1478994420.1]
+    mpos = mav_position.MavInterpolator(gps_lag=0)
+    mpos.set_logfile(os.path.join(os.getcwd(), 'tests', 'testdata', 'flight.tlog'))
+    positions = mpos.position_many(times, maxroll=3, pitch_offset=1)
+    assert positions.dtype == mav_position.position_dtype
+    assert list(positions['time']) == times
+
+    mpos = mav_position.MavInterpolator(gps_lag=0)
+    mpos.set_logfile(os.path.join(os.getcwd(), 'tests', 'testdata', 'flight.tlog'))
+    expected = {}
+    for t in sorted(times):
+        try:
+            expected[t] = mpos.position(t, maxroll=3, pitch_offset=1)
+        except mav_position.MavInterpolatorException:
+            expected[t] = None
+    ret = mav_position.PositionsFromArray(positions)
+    assert ret[3] is None
+    for (t, pos) in zip(times, ret):
+        if expected[t] is None:
+            assert pos is None
+            continue
+        for f in ['lat', 'lon', 'altitude', 'roll', 'pitch', 'yaw']:
+            assert abs(getattr(pos, f) - getattr(expected[t], f)) < 1.0e-9
+
+def test_position_many_angles():
+    mpos = mav_position.MavInterpolator()
+    mpos.jitter_correction = False
+    class Msg(FakeMsg):
+        def get_type(self):
+            return self.type
+    # yaw crossing from +179 to -179 degrees
+    for (t, yaw) in [(10, 3.0), (11, -3.0), (12, 3.1), (14, -3.1)]:
+        mpos.add_msg(Msg(t, type='ATTITUDE', roll=math.radians(t), pitch=0.0, yaw=yaw))
+        mpos.add_msg(Msg(t, type='GLOBAL_POSITION_INT', lat=-353600000+t, lon=1491600000, relative_alt=50000))
+    times = [9.0, 10.25, 11.5, 13.5, 15.0]
+    positions = mpos.position_many(times, maxroll=10.5, max_deltat=1.5)
+    assert numpy.isnan(positions['lat'][0])
+    # more than max_deltat between the messages
+    assert numpy.isnan(positions['lat'][3])
+    for (t, p) in zip(times, positions):
+        if numpy.isnan(p['lat']):
+            continue
+        pos = mpos.position(t, maxroll=10.5, max_deltat=1.5)
+        assert abs(pos.yaw - p['yaw']) < 1.0e-9
+        assert abs(pos.roll - p['roll']) < 1.0e-9
+        assert abs(pos.lat - p['lat']) < 1.0e-12
+        assert pos.altitude == p['altitude']
+    assert positions['roll'][1] == 0
+    assert abs(positions['roll'][2] - 1) < 1.0e-9
+
 def test_Fraction():
     fr = mav_position.Fraction(0.3)
     assert fr == fractions.Fraction(3, 10)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+tests for tlog_index.py
+'''
+
+import sys, os, time, shutil
+import pytest
+import numpy
+from pymavlink import mavutil
+from cuav.lib import tlog_index, mav_position
+
+flight_log = os.path.join(os.getcwd(), 'tests', 'testdata', 'flight.tlog')
+
+
+def test_build_index(tmp_path):
+    logfile = str(tmp_path / 'flight.tlog')
+    shutil.copy(flight_log, logfile)
+    index = tlog_index.build_index(logfile)
+    assert os.path.isdir(logfile + '.idx')
+
+    mlog = mavutil.mavlink_connection(logfile)
+    attitude = []
+    while True:
+        msg = mlog.recv_match(type='ATTITUDE')
+        if msg is None:
+            break
+        attitude.append((msg._timestamp, msg.roll, msg.yaw))
+    attitude = numpy.array(attitude)
+    assert index.count('ATTITUDE') == len(attitude)
+    assert 'roll' in index.fields('ATTITUDE')
+    assert numpy.array_equal(index.timestamps('ATTITUDE', corrected=False), attitude[:,0])
+    assert numpy.array_equal(index.column('ATTITUDE', 'roll'), attitude[:,1])
+    assert numpy.array_equal(index.column('ATTITUDE', 'yaw'), attitude[:,2])
+    # the jitter corrected timestamps never go backwards
+    assert (numpy.diff(index.timestamps('ATTITUDE')) >= 0).all()
+    assert index.count('NO_SUCH_MESSAGE') == 0
+
+    t = attitude[100,0]
+    assert index.find('ATTITUDE', t, corrected=False) == 100
+    assert index.find('ATTITUDE', attitude[0,0] - 1, corrected=False) == -1
+
+
+def test_load_index(tmp_path):
+    logfile = str(tmp_path / 'flight.tlog')
+    shutil.copy(flight_log, logfile)
+    assert tlog_index.load_index(logfile, build=False) is None
+
+    # an index of some types is rebuilt when other types are needed
+    index = tlog_index.build_index(logfile, types={'ATTITUDE' : ['roll']})
+    assert index.fields('ATTITUDE') == ['roll']
+    assert tlog_index.load_index(logfile, types={'ATTITUDE' : ['roll']}, build=False) is not None
+    assert tlog_index.load_index(logfile, types={'ATTITUDE' : ['yaw']}, build=False) is None
+    index = tlog_index.load_index(logfile, types={'ATTITUDE' : ['yaw']})
+    # only the types asked for are indexed
+    assert index.fields('ATTITUDE') == ['yaw']
+    assert 'GLOBAL_POSITION_INT' not in index
+    assert tlog_index.load_index(logfile, build=False) is None
+    types = tlog_index.interpolator_types()
+    index = tlog_index.load_index(logfile, types=types)
+    assert set(index.types.keys()) == set(types.keys())
+    assert tlog_index.load_index(logfile, types=types, build=False) is not None
+
+    # and when the log changes
+    with open(logfile, 'ab') as f:
+        f.write(b'\0' * 10)
+    assert tlog_index.load_index(logfile, types=types, build=False) is None
+    assert tlog_index.load_index(logfile, types=types) is not None
+    assert tlog_index.load_index(logfile, types=types, build=False) is not None
+
+
+def test_MavInterpolator_index(tmp_path):
+    logfile = str(tmp_path / 'flight.tlog')
+    shutil.copy(flight_log, logfile)
+    times = numpy.arange(1478994350.0, 1478994470.0, 3.7)
+    mpos = mav_position.MavInterpolator()
+    mpos.set_logfile(logfile)
+    assert not os.path.exists(logfile + '.idx')
+    expected = []
+    for t in times:
+        try:
+            expected.append(mpos.position(t))
+        except mav_position.MavInterpolatorException:
+            # the start of the log is not always found reading forwards
+            expected.append(None)
+    assert expected.count(None) < len(times) // 2
+
+    mpos = mav_position.MavInterpolator()
+    mpos.set_logfile(logfile, use_index=True)
+    assert mpos.mlog is None
+    # the whole log is available, in any order
+    for i in reversed(range(len(times))):
+        pos = mpos.position(times[i])
+        if expected[i] is None:
+            continue
+        for f in ['lat', 'lon', 'altitude', 'roll', 'pitch', 'yaw']:
+            assert abs(getattr(pos, f) - getattr(expected[i], f)) < 1.0e-9
+
+def test_MavInterpolator_index_add_msg(tmp_path):
+    logfile = str(tmp_path / 'flight.tlog')
+    shutil.copy(flight_log, logfile)
+    mpos = mav_position.MavInterpolator()
+    mpos.set_logfile(logfile, use_index=True)
+    mpos.jitter_correction = False
+    attitude = mpos.msg_map['ATTITUDE']
+    n = len(attitude)
+    second = float(attitude.timestamps()[1])
+    t = attitude.timestamps()[-1] + 1
+
+    class Msg(object):
+        def __init__(self, t, **kw):
+            self._timestamp = t
+            self.__dict__.update(kw)
+        def get_type(self):
+            return 'ATTITUDE'
+    # messages can still be added to a history loaded from the index
+    msg = Msg(t, roll=0.1, pitch=0.2, yaw=0.3)
+    mpos.add_msg(msg)
+    assert len(attitude) == n
+    assert attitude[-1] is msg
+    assert attitude.find(t) == n-1
+    assert attitude.values('yaw')[-1] == 0.3
+    # the oldest loaded message is dropped
+    assert attitude[0]._timestamp == second
+    assert attitude[0].roll == attitude.values('roll')[0]
+    for i in range(n+5):
+        mpos.add_msg(Msg(t+1+i, roll=0.0, pitch=0.0, yaw=float(i)))
+    assert len(attitude) == n
+    assert attitude.values('yaw')[-1] == n+4
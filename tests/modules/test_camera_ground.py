@@ -86,6 +86,10 @@ def test_camera_commands(mpstate):
 
     time.sleep(1.0)
     assert loadedModule.view_thread is not None
+    # a repeated view keeps the open joe log
+    joelog = loadedModule.joelog
+    loadedModule.cmd_camera(["view"])
+    assert loadedModule.joelog is joelog
 
     loadedModule.cmd_camera(["boundary", bnd])
 
@@ -93,6 +97,7 @@ def test_camera_commands(mpstate):
     time.sleep(1.0)
 
     assert loadedModule.boundary_polygon is not None
+    assert joelog.log is None
 
 
 def test_camera_thumbs(mpstate, image_file):
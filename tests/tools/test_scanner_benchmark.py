@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+'''Test the scanner benchmark
+'''
+
+import sys
+import pytest
+import os
+import numpy
+import cuav.tools.scanner_benchmark as scanner_benchmark
+
+
+def test_synthetic_frame():
+    (img, targets) = scanner_benchmark.synthetic_frame(320, 240, 5, seed=3)
+    assert img.shape == (240, 320, 3)
+    assert len(targets) == 5
+    for (x1, y1, x2, y2) in targets:
+        assert 0 <= x1 <= x2 < 320
+        assert 0 <= y1 <= y2 < 240
+    (img2, targets2) = scanner_benchmark.synthetic_frame(320, 240, 5, seed=3)
+    assert (img == img2).all() and targets == targets2
+
+def test_scanner_benchmark():
+    report = scanner_benchmark.run_benchmark([(640, 480)], frames=2, repeat=4)
+    assert report['cpus'] >= 1
+    r = report['results']['640x480']
+    assert r['fps'] > 0
+    assert r['targets_found'] > 0
+    assert r['stages_ms']['quantise'] > 0
+    assert r['scan_allocs'] >= 0 and r['scan_alloc_bytes'] >= 0
+    assert scanner_benchmark.compare_baseline(report, report) == []
+    slower = dict(r, frame_ms=r['frame_ms']*2+1, targets_found=r['targets_found']-1)
+    regressions = scanner_benchmark.compare_baseline({'results' : {'640x480' : slower}}, report)
+    assert len(regressions) == 2
+    growing = dict(r, scan_allocs=r['scan_allocs']+1)
+    regressions = scanner_benchmark.compare_baseline({'results' : {'640x480' : growing}}, report)
+    assert len(regressions) == 1
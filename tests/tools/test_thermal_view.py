@@ -6,6 +6,8 @@
 import sys
 import pytest
 import os
+import cv2
+import numpy
 import cuav.tools.thermal_view as thermal_view
 
 def test_convert_image():
@@ -23,3 +25,15 @@ def test_file_list():
     assert len(files) == 6
 
 
+
+def test_hot_regions(tmp_path):
+    values = numpy.full((512, 640), 5200)
+    values[100:106, 200:207] = 7000
+    values[300:303, 50:60] = 8000
+    # the camera words are big endian, and are written out unchanged
+    im = (values << 2).astype('>u2').view(numpy.uint16)
+    infile = str(tmp_path / 'raw20161112234651.png')
+    cv2.imwrite(infile, im)
+    regions = thermal_view.hot_regions(infile, 6100)
+    assert [r[:4] for r in regions] == [(200, 100, 206, 105), (50, 300, 59, 302)]
+    assert thermal_view.hot_regions(infile, 8500) == []